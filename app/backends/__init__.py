@@ -0,0 +1,171 @@
+# app/backends/__init__.py
+"""
+Выбор хранилища и функции, через которые к нему обращаются хендлеры
+
+STORAGE_BACKEND: file (CSV/JSON в data/, по умолчанию), database (таблицы
+app/database по DATABASE_URL — те же, куда переносит migrate_to_database.py)
+или memory (в памяти процесса — тесты и бенчмарки). Хендлеры и сервисы
+импортируют функции отсюда; их имена и сигнатуры те же, что в app.storage,
+так что смена хранилища не требует правок в коде, который его вызывает.
+"""
+import os
+import threading
+from datetime import date
+
+from app.backends.base import StorageBackend
+from app.utils import format_money as fmt_money
+
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "file")
+
+_backend = None
+_backend_lock = threading.Lock()
+
+
+def create_backend(name: str) -> StorageBackend:
+    """Новый экземпляр хранилища по имени"""
+    if name == "file":
+        from app.backends.file import FileBackend
+        return FileBackend()
+    if name == "database":
+        from app.backends.database import DatabaseBackend
+        return DatabaseBackend()
+    if name == "memory":
+        from app.backends.memory import MemoryBackend
+        return MemoryBackend()
+    raise ValueError(f"Неизвестное хранилище STORAGE_BACKEND={name!r} (file, database, memory)")
+
+
+def get_backend() -> StorageBackend:
+    """Текущее хранилище (создаётся при первом обращении по STORAGE_BACKEND)"""
+    global _backend
+    if _backend is None:
+        with _backend_lock:
+            if _backend is None:
+                _backend = create_backend(STORAGE_BACKEND)
+    return _backend
+
+
+def set_backend(backend: StorageBackend | None):
+    """Подменить хранилище (тесты, бенчмарки); None — снова по STORAGE_BACKEND"""
+    global _backend
+    with _backend_lock:
+        _backend = backend
+
+
+async def flush_on_shutdown(application=None):
+    """Хук post_shutdown для telegram Application"""
+    get_backend().flush()
+
+
+# ──────────────────────────────────────────────────────────────────────────────
+# ЗАПИСИ
+# ──────────────────────────────────────────────────────────────────────────────
+def ensure_csv(user_id: int):
+    return get_backend().ensure_csv(user_id)
+
+def read_rows(user_id: int, start: date = None, end: date = None):
+    return get_backend().read_rows(user_id, start=start, end=end)
+
+def iter_rows(user_id: int, start: date = None, end: date = None,
+              currency: str = None, category: str = None):
+    return get_backend().iter_rows(user_id, start=start, end=end, currency=currency, category=category)
+
+def rows_since(user_id: int, marks: dict = None):
+    return get_backend().rows_since(user_id, marks)
+
+def append_row_csv(user_id: int, data: dict, source: str = ""):
+    return get_backend().append_row_csv(user_id, data, source=source)
+
+def append_rows_csv(user_id: int, rows, source: str = "", update_balances: bool = True):
+    return get_backend().append_rows_csv(user_id, rows, source=source, update_balances=update_balances)
+
+def apply_batch(user_id: int, rows=(), accounts: dict = None, source: str = "", balances: dict = None):
+    return get_backend().apply_batch(user_id, rows, accounts=accounts, source=source, balances=balances)
+
+def undo_last_row(user_id: int):
+    return get_backend().undo_last_row(user_id)
+
+def update_last_row(user_id: int, **changes):
+    return get_backend().update_last_row(user_id, **changes)
+
+def update_row_from_end(user_id: int, n: int, **changes):
+    return get_backend().update_row_from_end(user_id, n, **changes)
+
+def delete_row_from_end(user_id: int, n: int):
+    return get_backend().delete_row_from_end(user_id, n)
+
+def update_row_by_id(user_id: int, row_id: int, **changes):
+    return get_backend().update_row_by_id(user_id, row_id, **changes)
+
+def delete_row_by_id(user_id: int, row_id: int):
+    return get_backend().delete_row_by_id(user_id, row_id)
+
+def find_last_row(user_id: int, predicate):
+    return get_backend().find_last_row(user_id, predicate)
+
+def csv_export_path(user_id: int):
+    return get_backend().csv_export_path(user_id)
+
+# ──────────────────────────────────────────────────────────────────────────────
+# БАЛАНСЫ
+# ──────────────────────────────────────────────────────────────────────────────
+def get_balances(user_id: int):
+    return get_backend().get_balances(user_id)
+
+def set_balance(user_id: int, data, currency: str = None, category: str = None):
+    return get_backend().set_balance(user_id, data, currency=currency, category=category)
+
+def dec_balance(user_id: int, amount: float, currency: str | None, category: str | None):
+    return get_backend().dec_balance(user_id, amount, currency, category)
+
+def rebalance_on_edit(user_id: int, old_row: dict, new_row: dict):
+    return get_backend().rebalance_on_edit(user_id, old_row, new_row)
+
+# ──────────────────────────────────────────────────────────────────────────────
+# СЧЕТА
+# ──────────────────────────────────────────────────────────────────────────────
+def list_accounts(user_id: int) -> dict:
+    return get_backend().list_accounts(user_id)
+
+def add_account(user_id: int, name: str, currency: str, amount: float = 0.0):
+    return get_backend().add_account(user_id, name, currency, amount)
+
+def set_account_amount(user_id: int, name: str, amount: float):
+    return get_backend().set_account_amount(user_id, name, amount)
+
+def dec_account(user_id: int, name: str, amount: float):
+    return get_backend().dec_account(user_id, name, amount)
+
+def inc_account(user_id: int, name: str, amount: float):
+    return get_backend().inc_account(user_id, name, amount)
+
+def adjust_accounts(user_id: int, pairs):
+    return get_backend().adjust_accounts(user_id, pairs)
+
+def delete_account(user_id: int, name: str):
+    return get_backend().delete_account(user_id, name)
+
+def update_account_currency(user_id: int, name: str, currency: str):
+    return get_backend().update_account_currency(user_id, name, currency)
+
+def find_accounts_by_currency(user_id: int, currency: str) -> list[str]:
+    return get_backend().find_accounts_by_currency(user_id, currency)
+
+def format_accounts(user_id: int) -> str:
+    return get_backend().format_accounts(user_id)
+
+def transfer_between_accounts(user_id: int, from_account: str, to_account: str, amount: float,
+                              second_amount: float = None):
+    return get_backend().transfer_between_accounts(user_id, from_account, to_account, amount, second_amount)
+
+# ──────────────────────────────────────────────────────────────────────────────
+# ПРАВИЛА И СЛУЖЕБНОЕ
+# ──────────────────────────────────────────────────────────────────────────────
+def load_rules(user_id: int):
+    return get_backend().load_rules(user_id)
+
+def save_rules(user_id: int, rules):
+    return get_backend().save_rules(user_id, rules)
+
+def user_lock(user_id: int):
+    return get_backend().user_lock(user_id)
@@ -0,0 +1,312 @@
+# app/backends/base.py
+"""
+Протокол хранилища и общая часть реализаций
+
+StorageBackend — то, что хендлеры и сервисы ожидают от хранилища: записи
+(TransactionRecord), счета, балансы и правила. Имена и семантика методов
+совпадают с функциями app.storage, первым аргументом всегда идёт user_id.
+
+BaseBackend реализует всё, что выражается через несколько абстрактных
+примитивов (чтение/изменение записей, _state_get/_post_events для счетов и
+балансов, правила). Проводка и тексты берутся из app.ledger, как и в
+app.storage: одни и те же данные дают одинаковый результат на любом хранилище.
+"""
+import os
+import abc
+import csv
+import asyncio
+from datetime import date
+from typing import Protocol, Iterator, Optional, runtime_checkable
+
+from app.models import TransactionRecord
+from app.ledger import (
+    CSV_FIELDS, make_row, apply_changes, apply_event, diff_events,
+    balance_deltas, rebalance_pairs, post_rows, render_accounts, transfer_rows,
+)
+from app.storage import user_dir
+
+
+@runtime_checkable
+class StorageBackend(Protocol):
+    """Хранилище данных пользователей"""
+    name: str
+
+    # ── записи ──
+    def ensure_csv(self, user_id: int) -> None: ...
+    def read_rows(self, user_id: int, start: date = None, end: date = None) -> list: ...
+    def iter_rows(self, user_id: int, start: date = None, end: date = None,
+                  currency: str = None, category: str = None) -> Iterator[TransactionRecord]: ...
+    def rows_since(self, user_id: int, marks: dict = None): ...
+    def append_row_csv(self, user_id: int, data: dict, source: str = "") -> None: ...
+    def append_rows_csv(self, user_id: int, rows, source: str = "", update_balances: bool = True) -> int: ...
+    def apply_batch(self, user_id: int, rows=(), accounts: dict = None, source: str = "",
+                    balances: dict = None) -> None: ...
+    def undo_last_row(self, user_id: int) -> bool: ...
+    def update_last_row(self, user_id: int, **changes): ...
+    def update_row_from_end(self, user_id: int, n: int, **changes): ...
+    def delete_row_from_end(self, user_id: int, n: int): ...
+    def update_row_by_id(self, user_id: int, row_id: int, **changes): ...
+    def delete_row_by_id(self, user_id: int, row_id: int): ...
+    def find_last_row(self, user_id: int, predicate): ...
+    def csv_export_path(self, user_id: int) -> Optional[str]: ...
+
+    # ── балансы ──
+    def get_balances(self, user_id: int) -> dict: ...
+    def set_balance(self, user_id: int, data, currency: str = None, category: str = None): ...
+    def dec_balance(self, user_id: int, amount: float, currency: str | None, category: str | None) -> None: ...
+    def rebalance_on_edit(self, user_id: int, old_row: dict, new_row: dict) -> None: ...
+
+    # ── счета ──
+    def list_accounts(self, user_id: int) -> dict: ...
+    def add_account(self, user_id: int, name: str, currency: str, amount: float = 0.0): ...
+    def set_account_amount(self, user_id: int, name: str, amount: float): ...
+    def dec_account(self, user_id: int, name: str, amount: float) -> None: ...
+    def inc_account(self, user_id: int, name: str, amount: float) -> None: ...
+    def adjust_accounts(self, user_id: int, pairs) -> None: ...
+    def delete_account(self, user_id: int, name: str) -> str: ...
+    def update_account_currency(self, user_id: int, name: str, currency: str): ...
+    def find_accounts_by_currency(self, user_id: int, currency: str) -> list[str]: ...
+    def format_accounts(self, user_id: int) -> str: ...
+    def transfer_between_accounts(self, user_id: int, from_account: str, to_account: str,
+                                  amount: float, second_amount: float = None) -> dict: ...
+
+    # ── правила ──
+    def load_rules(self, user_id: int) -> list: ...
+    def save_rules(self, user_id: int, rules: list) -> None: ...
+
+    # ── служебное ──
+    def user_lock(self, user_id: int) -> asyncio.Lock: ...
+    def flush(self) -> None: ...
+
+
+def record(row: dict, row_id: int) -> TransactionRecord:
+    """Строка в том виде, в каком её вернул бы finance.csv (поля — строки)"""
+    fields = {k: ("" if v is None else str(v)) for k, v in row.items() if k != "id"}
+    fields["id"] = row_id
+    return TransactionRecord(fields)
+
+
+def in_period(row: TransactionRecord, start: date = None, end: date = None) -> bool:
+    if not (start or end):
+        return True
+    d = row.day
+    return d is not None and (start is None or d >= start) and (end is None or d < end)
+
+
+class BaseBackend(abc.ABC):
+    """Общая часть хранилищ, не работающих с файлами app.storage.
+
+    Наследник обязан реализовать абстрактные примитивы — иначе экземпляр
+    не создаётся (TypeError), а не падает на первом вызове.
+    """
+    name = "base"
+
+    def __init__(self):
+        self._locks: dict = {}
+
+    # ── примитивы, которые реализует наследник ──
+    @abc.abstractmethod
+    def ensure_csv(self, user_id: int) -> None: ...
+
+    @abc.abstractmethod
+    def iter_rows(self, user_id: int, start: date = None, end: date = None,
+                  currency: str = None, category: str = None) -> Iterator[TransactionRecord]: ...
+
+    @abc.abstractmethod
+    def rows_since(self, user_id: int, marks: dict = None): ...
+
+    @abc.abstractmethod
+    def apply_batch(self, user_id: int, rows=(), accounts: dict = None, source: str = "",
+                    balances: dict = None) -> None: ...
+
+    @abc.abstractmethod
+    def undo_last_row(self, user_id: int) -> bool: ...
+
+    @abc.abstractmethod
+    def update_row_from_end(self, user_id: int, n: int, **changes): ...
+
+    @abc.abstractmethod
+    def update_row_by_id(self, user_id: int, row_id: int, **changes): ...
+
+    @abc.abstractmethod
+    def delete_row_from_end(self, user_id: int, n: int): ...
+
+    @abc.abstractmethod
+    def delete_row_by_id(self, user_id: int, row_id: int): ...
+
+    @abc.abstractmethod
+    def find_last_row(self, user_id: int, predicate): ...
+
+    @abc.abstractmethod
+    def _state_get(self, user_id: int, kind: str) -> dict:
+        """Счета ("accounts") или балансы ("balances") пользователя"""
+
+    @abc.abstractmethod
+    def _post_events(self, user_id: int, events: list):
+        """Применить события set/add/del к счетам и балансам одной операцией"""
+
+    @abc.abstractmethod
+    def load_rules(self, user_id: int) -> list: ...
+
+    @abc.abstractmethod
+    def save_rules(self, user_id: int, rules: list) -> None: ...
+
+    def _state_replace(self, user_id: int, kind: str, data: dict):
+        self._post_events(user_id, diff_events(kind, self._state_get(user_id, kind), data))
+
+    # ── записи ──
+    def read_rows(self, user_id: int, start: date = None, end: date = None):
+        return list(self.iter_rows(user_id, start=start, end=end))
+
+    def append_row_csv(self, user_id: int, data: dict, source: str = ""):
+        self.apply_batch(user_id, [data], source=source)
+
+    def append_rows_csv(self, user_id: int, rows, source: str = "", update_balances: bool = True):
+        rows = list(rows)
+        if not rows:
+            return 0
+        self._append_posted(user_id, rows, source, update_balances)
+        return len(rows)
+
+    def _append_posted(self, user_id: int, rows: list, source: str, update_balances: bool):
+        """Добавить записи и провести их по счетам и балансам.
+
+        Здесь — чтение, проводка в памяти и apply_batch; хранилище, которое
+        умеет прибавлять изменения на месте, переопределяет это одной операцией.
+        """
+        acc = self.list_accounts(user_id)
+        bal = self.get_balances(user_id) if update_balances else None
+        post_rows(rows, acc, bal)
+        self.apply_batch(user_id, rows, accounts=acc, source=source, balances=bal)
+
+    def update_last_row(self, user_id: int, **changes):
+        if self.find_last_row(user_id, lambda row: True) is None:
+            raise ValueError("Нет записей")
+        return self.update_row_from_end(user_id, 1, **changes)
+
+    def csv_export_path(self, user_id: int):
+        rows = self.iter_rows(user_id)
+        first = next(rows, None)
+        if first is None:
+            return None
+        out = os.path.join(user_dir(user_id), "finance_export.csv")
+        with open(out, "w", newline="", encoding="utf-8") as f:
+            w = csv.DictWriter(f, fieldnames=CSV_FIELDS)
+            w.writeheader()
+            w.writerow(first)
+            w.writerows(rows)
+        return out
+
+    @staticmethod
+    def _new_row(data: dict, source: str = "") -> dict:
+        return make_row(data, source or data.get("source", ""))
+
+    @staticmethod
+    def _changed(row: TransactionRecord, changes: dict) -> dict:
+        changes.pop("id", None)
+        return apply_changes(dict(row), changes)
+
+    # ── балансы ──
+    def get_balances(self, user_id: int):
+        return dict(self._state_get(user_id, "balances"))
+
+    def set_balance(self, user_id: int, data, currency: str = None, category: str = None):
+        if isinstance(data, dict):
+            self._state_replace(user_id, "balances", dict(data))
+            return data
+        key = f"{currency.upper()}" if not category else f"{category}@{currency.upper()}"
+        self._post_events(user_id, [{"kind": "balances", "op": "set", "key": key, "value": float(data)}])
+        return key, float(data)
+
+    def dec_balance(self, user_id: int, amount: float, currency: str | None, category: str | None):
+        if not currency:
+            return
+        delta = -float(amount or 0)
+        pairs = ((currency.upper(), delta), (f"{(category or '')}@{currency.upper()}", delta))
+        self._post_events(user_id, balance_deltas(self._state_get(user_id, "balances"), pairs))
+
+    def rebalance_on_edit(self, user_id: int, old_row: dict, new_row: dict):
+        self._post_events(user_id, balance_deltas(self._state_get(user_id, "balances"),
+                                                   rebalance_pairs(old_row, new_row)))
+
+    # ── счета ──
+    def list_accounts(self, user_id: int) -> dict:
+        return {name: dict(v) for name, v in self._state_get(user_id, "accounts").items()}
+
+    def _account(self, user_id: int, name: str) -> dict:
+        acc = self._state_get(user_id, "accounts")
+        if name not in acc:
+            raise ValueError("Нет такого счёта")
+        return acc
+
+    def _account_events(self, user_id: int, events: list, name: str):
+        self._post_events(user_id, [dict(ev, kind="accounts", key=name) for ev in events])
+        return name, dict(self._state_get(user_id, "accounts")[name])
+
+    def add_account(self, user_id: int, name: str, currency: str, amount: float = 0.0):
+        name = name.strip()
+        currency = (currency or "").upper()
+        if not name or not currency:
+            raise ValueError("name/currency пустые")
+        if name in self._state_get(user_id, "accounts"):
+            raise ValueError("Счёт с таким именем уже существует")
+        value = {"currency": currency, "amount": float(amount)}
+        return self._account_events(user_id, [{"op": "set", "value": value}], name)
+
+    def set_account_amount(self, user_id: int, name: str, amount: float):
+        self._account(user_id, name)
+        return self._account_events(user_id, [{"op": "set", "field": "amount", "value": float(amount)}], name)
+
+    def dec_account(self, user_id: int, name: str, amount: float):
+        self.inc_account(user_id, name, -float(amount or 0))
+
+    def inc_account(self, user_id: int, name: str, amount: float):
+        self._account(user_id, name)
+        self._account_events(user_id, [{"op": "add", "field": "amount", "value": float(amount or 0)}], name)
+
+    def adjust_accounts(self, user_id: int, pairs):
+        acc = self._state_get(user_id, "accounts")
+        self._post_events(user_id, [{"kind": "accounts", "op": "add", "key": name, "field": "amount",
+                                     "value": float(delta)}
+                                    for name, delta in pairs if name in acc and delta])
+
+    def delete_account(self, user_id: int, name: str):
+        self._account(user_id, name)
+        self._post_events(user_id, [{"kind": "accounts", "op": "del", "key": name}])
+        return name
+
+    def update_account_currency(self, user_id: int, name: str, currency: str):
+        self._account(user_id, name)
+        return self._account_events(
+            user_id, [{"op": "set", "field": "currency", "value": (currency or "").upper()}], name)
+
+    def find_accounts_by_currency(self, user_id: int, currency: str) -> list[str]:
+        currency = (currency or "").upper()
+        return [n for n, v in self.list_accounts(user_id).items()
+                if (v.get("currency") or "").upper() == currency]
+
+    def format_accounts(self, user_id: int) -> str:
+        return render_accounts(self.list_accounts(user_id))
+
+    def transfer_between_accounts(self, user_id: int, from_account: str, to_account: str,
+                                  amount: float, second_amount: float = None):
+        rows, result = transfer_rows(self.list_accounts(user_id), from_account, to_account,
+                                      amount, second_amount)
+        self.append_rows_csv(user_id, rows, source="transfer", update_balances=False)
+        return result
+
+    # ── служебное ──
+    def user_lock(self, user_id: int) -> asyncio.Lock:
+        lock = self._locks.get(int(user_id))
+        if lock is None:
+            lock = self._locks[int(user_id)] = asyncio.Lock()
+        return lock
+
+    def flush(self):
+        pass
+
+
+def apply_events(state: dict, events: list):
+    """Применить события счетов/балансов к {"accounts": {...}, "balances": {...}}"""
+    for ev in events:
+        apply_event(state, ev)
@@ -0,0 +1,329 @@
+# app/backends/database.py
+"""
+Хранилище в базе данных app/database (DATABASE_URL, модели SQLAlchemy)
+
+Те же таблицы, что у DatabaseService, миграций и migrate_to_database.py:
+записи — transactions (сумма по модулю + transaction_type, как при переносе
+в bulk.py), счета — accounts (каждое изменение остатка — снимок в balances),
+остатки бюджета — budget_balances, правила — rules. Итоги monthly_summary
+обновляются в той же транзакции, что и записи.
+
+Пользователь хранилища — telegram_id (users.telegram_id). id записи —
+transactions.id: уникален и растёт в порядке добавления, но общий для всех
+пользователей. Каждая операция — одна единица работы (unit_of_work);
+потоковое чтение — по единице работы на пачку, как storage_new.iter_transactions.
+Проводка новых записей по счетам и балансам — приращения в SQL
+(balance = balance + :delta) в той же единице работы, что и вставка:
+параллельные записи одного пользователя не теряют изменений друг друга.
+"""
+import json
+from datetime import date, datetime, time
+
+from sqlalchemy import delete, desc, func, insert, select, update
+from sqlalchemy.exc import IntegrityError
+
+from app.backends.base import BaseBackend, apply_events, record
+from app.database.bulk import _transaction_values
+from app.database.models import Account, BudgetBalance, Transaction, User
+from app.database.service import TRANSACTION_COLUMNS, unit_of_work
+from app.database.summary import add_to_summary, summary_key
+from app.ledger import diff_events, row_deltas
+
+_FETCH_CHUNK = 500
+
+
+def _record(r):
+    """Строка transactions в виде записи finance.csv (сумма со знаком)"""
+    d = r.date
+    total = -r.total if r.transaction_type == "expense" and r.total else r.total
+    return record({
+        "date": d.strftime("%Y-%m-%d %H:%M:%S" if d.time() != time() else "%Y-%m-%d"),
+        "merchant": r.merchant, "total": total, "currency": r.currency, "category": r.category,
+        "payment_method": r.payment_method, "source": r.source, "notes": r.notes,
+    }, r.id)
+
+
+def _day(d: date) -> datetime:
+    return datetime.combine(d, time())
+
+
+class DatabaseBackend(BaseBackend):
+    """Записи, счета, балансы и правила в таблицах app/database"""
+    name = "database"
+
+    @staticmethod
+    def _user_pk(db, user_id: int, create: bool = True):
+        """users.id пользователя (None, если его нет и create=False)"""
+        pk = db.db.execute(select(User.id).where(User.telegram_id == int(user_id))).scalar()
+        if pk is None and create:
+            pk = db.get_or_create_user(int(user_id)).id
+        return pk
+
+    # ── записи ──
+    def ensure_csv(self, user_id: int):
+        with unit_of_work() as db:
+            self._user_pk(db, user_id)
+
+    def _chunks(self, user_id: int, where=(), descending: bool = False):
+        """Записи пачками по _FETCH_CHUNK, по единице работы на пачку"""
+        after = None
+        while True:
+            with unit_of_work() as db:
+                pk = self._user_pk(db, user_id, create=False)
+                if pk is None:
+                    return
+                stmt = select(*TRANSACTION_COLUMNS).where(Transaction.user_id == pk, *where)
+                if after is not None:
+                    stmt = stmt.where(Transaction.id < after if descending else Transaction.id > after)
+                rows = db.db.execute(stmt.order_by(desc(Transaction.id) if descending else Transaction.id)
+                                     .limit(_FETCH_CHUNK)).all()
+            yield from (_record(r) for r in rows)
+            if len(rows) < _FETCH_CHUNK:
+                return
+            after = rows[-1].id
+
+    def iter_rows(self, user_id: int, start: date = None, end: date = None,
+                  currency: str = None, category: str = None):
+        where = []
+        if start:
+            where.append(Transaction.date >= _day(start))
+        if end:
+            where.append(Transaction.date < _day(end))
+        if currency:
+            where.append(Transaction.currency == currency.upper())
+        if category is not None:
+            where.append(func.coalesce(Transaction.category, "") == category)
+        return self._chunks(user_id, where)
+
+    @staticmethod
+    def _marks(db, pk: int, *where) -> tuple:
+        """(последний id, число записей, последнее изменение) среди where"""
+        return tuple(db.db.execute(
+            select(func.max(Transaction.id), func.count(), func.max(Transaction.updated_at))
+            .where(Transaction.user_id == pk, *where)).one())
+
+    def rows_since(self, user_id: int, marks: dict = None):
+        # Правка или удаление старых записей меняет число или время изменения
+        # среди id <= прошлой отметки — тогда отдаём всё заново
+        marks = marks or {}
+        with unit_of_work() as db:
+            pk = self._user_pk(db, user_id, create=False)
+            last_id, count, updated = self._marks(db, pk)
+            full = "id" not in marks or self._marks(db, pk, Transaction.id <= marks["id"])[1:] != (
+                marks["count"], marks["updated"])
+            rows = db.db.execute(
+                select(*TRANSACTION_COLUMNS)
+                .where(Transaction.user_id == pk, Transaction.id > (0 if full else marks["id"]),
+                       Transaction.id <= (last_id or 0))
+                .order_by(Transaction.id)).all()
+        return {"id": last_id or 0, "count": count, "updated": updated}, [_record(r) for r in rows], full
+
+    def apply_batch(self, user_id: int, rows=(), accounts: dict = None, source: str = "",
+                    balances: dict = None):
+        rows = [self._new_row(r, source) for r in rows]
+        with unit_of_work() as db:
+            pk = self._user_pk(db, user_id)
+            self._insert(db, pk, rows)
+            events = []
+            for kind, data in (("accounts", accounts), ("balances", balances)):
+                if data is not None:
+                    events += diff_events(kind, self._load_state(db, pk, kind), data)
+            self._post(db, pk, events)
+
+    @staticmethod
+    def _insert(db, pk: int, rows: list):
+        if not rows:
+            return
+        values = [_transaction_values(pk, r) for r in rows]
+        db.db.execute(insert(Transaction), values)
+        add_to_summary(db.db, [(summary_key(pk, v["date"], v["transaction_type"], v["category"],
+                                            v["currency"]), v["total"]) for v in values])
+
+    def _append_posted(self, user_id: int, rows: list, source: str, update_balances: bool):
+        rows = [self._new_row(r, source) for r in rows]
+        with unit_of_work() as db:
+            pk = self._user_pk(db, user_id)
+            self._insert(db, pk, rows)
+            for kind, key, delta, create in row_deltas(rows, update_balances):
+                if not delta:
+                    continue
+                if kind == "accounts":
+                    self._add_to_account(db, pk, key, delta)
+                else:
+                    self._add_to_balance(db, pk, key, delta, create)
+
+    def _from_end(self, db, pk: int, n: int, strict: bool = True):
+        found = None
+        if n > 0:
+            found = db.db.execute(select(*TRANSACTION_COLUMNS).where(Transaction.user_id == pk)
+                                  .order_by(desc(Transaction.id)).offset(n - 1).limit(1)).first()
+        if found is None:
+            if strict:
+                raise ValueError("Неверный индекс")
+            return None
+        return _record(found)
+
+    def _by_id(self, db, pk: int, row_id: int):
+        found = db.db.execute(select(*TRANSACTION_COLUMNS)
+                              .where(Transaction.user_id == pk, Transaction.id == int(row_id))).first()
+        if found is None:
+            raise ValueError("Запись не найдена")
+        return _record(found)
+
+    def _update(self, db, pk: int, old, changes: dict):
+        new = self._changed(old, changes)
+        values = _transaction_values(pk, new)
+        del values["user_id"], values["is_verified"]
+        db.update_transaction(old.id, **values)
+        return dict(old), new
+
+    def undo_last_row(self, user_id: int):
+        with unit_of_work() as db:
+            pk = self._user_pk(db, user_id, create=False)
+            row = self._from_end(db, pk, 1, strict=False)
+            if row is None:
+                return False
+            db.delete_transaction(row.id)
+            return True
+
+    def update_row_from_end(self, user_id: int, n: int, **changes):
+        with unit_of_work() as db:
+            pk = self._user_pk(db, user_id, create=False)
+            return self._update(db, pk, self._from_end(db, pk, n), changes)
+
+    def update_row_by_id(self, user_id: int, row_id: int, **changes):
+        with unit_of_work() as db:
+            pk = self._user_pk(db, user_id, create=False)
+            return self._update(db, pk, self._by_id(db, pk, row_id), changes)
+
+    def delete_row_from_end(self, user_id: int, n: int):
+        with unit_of_work() as db:
+            row = self._from_end(db, self._user_pk(db, user_id, create=False), n)
+            db.delete_transaction(row.id)
+            return dict(row)
+
+    def delete_row_by_id(self, user_id: int, row_id: int):
+        with unit_of_work() as db:
+            row = self._by_id(db, self._user_pk(db, user_id, create=False), row_id)
+            db.delete_transaction(row.id)
+            return dict(row)
+
+    def find_last_row(self, user_id: int, predicate):
+        for n, row in enumerate(self._chunks(user_id, descending=True), 1):
+            try:
+                if predicate(row):
+                    return n, row
+            except (ValueError, TypeError):
+                continue
+        return None
+
+    # ── счета и балансы ──
+    @staticmethod
+    def _accounts(db, pk: int, names=None) -> dict:
+        """Счета по имени, включая удалённые (при совпадении имён — последний)"""
+        stmt = select(Account).where(Account.user_id == pk).order_by(Account.id)
+        if names is not None:
+            stmt = stmt.where(Account.name.in_(names))
+        return {a.name: a for a in db.db.scalars(stmt)}
+
+    def _load_state(self, db, pk: int, kind: str) -> dict:
+        if pk is None:
+            return {}
+        if kind == "accounts":
+            return {a.name: {"currency": a.currency, "amount": a.balance}
+                    for a in self._accounts(db, pk).values() if a.is_active}
+        return dict(db.db.execute(select(BudgetBalance.key, BudgetBalance.amount)
+                                  .where(BudgetBalance.user_id == pk)).all())
+
+    def _state_get(self, user_id: int, kind: str) -> dict:
+        with unit_of_work() as db:
+            return self._load_state(db, self._user_pk(db, user_id, create=False), kind)
+
+    def _post(self, db, pk: int, events: list):
+        """Применить события к затронутым ключам и записать их в таблицы"""
+        if not events:
+            return
+        state = {kind: self._load_state(db, pk, kind) for kind in {ev["kind"] for ev in events}}
+        apply_events(state, events)
+        for kind, data in state.items():
+            keys = {ev["key"] for ev in events if ev["kind"] == kind}
+            if kind == "accounts":
+                self._write_accounts(db, pk, data, keys)
+                continue
+            db.db.execute(delete(BudgetBalance).where(BudgetBalance.user_id == pk, BudgetBalance.key.in_(keys)))
+            db.db.add_all(BudgetBalance(user_id=pk, key=k, amount=data[k]) for k in keys if k in data)
+            db.db.flush()
+
+    def _write_accounts(self, db, pk: int, data: dict, names: set):
+        existing = self._accounts(db, pk, names)
+        for name in names:
+            acc, value = existing.get(name), data.get(name)
+            if value is None:
+                if acc is not None and acc.is_active:
+                    db.delete_account(acc.id)
+                continue
+            currency, amount = value.get("currency") or "", float(value.get("amount") or 0.0)
+            if acc is None:
+                acc = db.create_account(pk, name, currency, amount)
+            elif acc.is_active and (acc.currency, acc.balance) == (currency, amount):
+                continue
+            else:
+                acc.currency, acc.balance, acc.is_active = currency, amount, True
+                acc.updated_at = datetime.utcnow()
+            # История капитала: снимок на каждое изменение (см. retention.py)
+            db.save_balance(pk, acc.id, amount, currency)
+
+    @staticmethod
+    def _add_to_account(db, pk: int, name: str, delta: float):
+        acc = db.db.execute(select(Account.id, Account.currency, Account.is_active)
+                            .where(Account.user_id == pk, Account.name == name)
+                            .order_by(desc(Account.id)).limit(1)).first()
+        if acc is None or not acc.is_active:
+            return
+        db.db.execute(update(Account).where(Account.id == acc.id)
+                      .values(balance=Account.balance + delta, updated_at=datetime.utcnow()))
+        amount = db.db.execute(select(Account.balance).where(Account.id == acc.id)).scalar()
+        db.save_balance(pk, acc.id, amount, acc.currency)
+
+    @staticmethod
+    def _add_to_balance(db, pk: int, key: str, delta: float, create: bool):
+        """amount = amount + delta; при create отсутствующий ключ вставляется в точке сохранения"""
+        stmt = (update(BudgetBalance).where(BudgetBalance.user_id == pk, BudgetBalance.key == key)
+                .values(amount=BudgetBalance.amount + delta))
+        if db.db.execute(stmt).rowcount or not create:
+            return
+        try:
+            with db.db.begin_nested():
+                db.db.execute(insert(BudgetBalance).values(user_id=pk, key=key, amount=delta))
+        except IntegrityError:
+            # Ключ успела создать параллельная транзакция — прибавляем к нему
+            db.db.execute(stmt)
+
+    def _post_events(self, user_id: int, events: list):
+        if not events:
+            return
+        with unit_of_work() as db:
+            self._post(db, self._user_pk(db, user_id), events)
+
+    # ── правила ──
+    def load_rules(self, user_id: int):
+        with unit_of_work() as db:
+            pk = self._user_pk(db, user_id, create=False)
+            rules = db.get_rules(pk) if pk is not None else []
+            return [{"id": r.id, "category": r.category, "match": json.loads(r.match_conditions)}
+                    for r in sorted(rules, key=lambda r: r.id)]
+
+    def save_rules(self, user_id: int, rules):
+        # Правило с id существующего обновляется на месте — номера правил не меняются
+        with unit_of_work() as db:
+            pk = self._user_pk(db, user_id)
+            existing = {r.id: r for r in db.get_rules(pk)}
+            for rule in rules or []:
+                found = existing.pop(rule.get("id"), None)
+                if found is None:
+                    db.create_rule(pk, rule.get("category", ""), rule.get("match", {}))
+                else:
+                    db.update_rule(found.id, category=rule.get("category", ""),
+                                   match_conditions=json.dumps(rule.get("match", {}), ensure_ascii=False))
+            for rule_id in existing:
+                db.delete_rule(rule_id)
@@ -0,0 +1,60 @@
+# app/backends/file.py
+"""
+Файловое хранилище: CSV/JSON в data/<uid>/ (app.storage и app.rules)
+
+Хранилище по умолчанию. Все операции — функции app.storage как есть, со
+всеми их оптимизациями (индекс смещений, кэш строк, журнал счетов, архив).
+"""
+from app import rules, storage
+
+
+class FileBackend:
+    """StorageBackend поверх app.storage"""
+    name = "file"
+
+    # ── записи ──
+    ensure_csv = staticmethod(storage.ensure_csv)
+    read_rows = staticmethod(storage.read_rows)
+    iter_rows = staticmethod(storage.iter_rows)
+    rows_since = staticmethod(storage.rows_since)
+    append_row_csv = staticmethod(storage.append_row_csv)
+    append_rows_csv = staticmethod(storage.append_rows_csv)
+    apply_batch = staticmethod(storage.apply_batch)
+    undo_last_row = staticmethod(storage.undo_last_row)
+    update_last_row = staticmethod(storage.update_last_row)
+    update_row_from_end = staticmethod(storage.update_row_from_end)
+    delete_row_from_end = staticmethod(storage.delete_row_from_end)
+    update_row_by_id = staticmethod(storage.update_row_by_id)
+    delete_row_by_id = staticmethod(storage.delete_row_by_id)
+    find_last_row = staticmethod(storage.find_last_row)
+    csv_export_path = staticmethod(storage.csv_export_path)
+
+    # ── балансы ──
+    get_balances = staticmethod(storage.get_balances)
+    set_balance = staticmethod(storage.set_balance)
+    dec_balance = staticmethod(storage.dec_balance)
+    rebalance_on_edit = staticmethod(storage.rebalance_on_edit)
+
+    # ── счета ──
+    list_accounts = staticmethod(storage.list_accounts)
+    add_account = staticmethod(storage.add_account)
+    set_account_amount = staticmethod(storage.set_account_amount)
+    dec_account = staticmethod(storage.dec_account)
+    inc_account = staticmethod(storage.inc_account)
+    adjust_accounts = staticmethod(storage.adjust_accounts)
+    delete_account = staticmethod(storage.delete_account)
+    update_account_currency = staticmethod(storage.update_account_currency)
+    find_accounts_by_currency = staticmethod(storage.find_accounts_by_currency)
+    format_accounts = staticmethod(storage.format_accounts)
+    transfer_between_accounts = staticmethod(storage.transfer_between_accounts)
+
+    # ── правила ──
+    load_rules = staticmethod(rules.load_rules)
+    save_rules = staticmethod(rules.save_rules)
+
+    # ── служебное ──
+    user_lock = staticmethod(storage.user_lock)
+
+    @staticmethod
+    def flush():
+        storage.flush_all(snapshot=True)
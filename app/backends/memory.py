@@ -0,0 +1,157 @@
+# app/backends/memory.py
+"""
+Хранилище в памяти процесса: ничего не пишет на диск (кроме /export).
+
+Для тестов и бенчмарков — показывает нижнюю границу стоимости операций
+без файлов и базы. При перезапуске всё теряется.
+"""
+import threading
+from datetime import date
+
+from app.backends.base import BaseBackend, apply_events, in_period, record
+
+
+class _UserData:
+    __slots__ = ("rows", "last_id", "generation", "state", "rules")
+
+    def __init__(self):
+        self.rows = []             # TransactionRecord в порядке добавления
+        self.last_id = 0
+        self.generation = 0        # растёт при правке/удалении записей
+        self.state = {"accounts": {}, "balances": {}}
+        self.rules = []
+
+
+class MemoryBackend(BaseBackend):
+    """Всё в словарях; операции атомарны под одной блокировкой"""
+    name = "memory"
+
+    def __init__(self):
+        super().__init__()
+        self._users: dict = {}
+        self._lock = threading.RLock()
+
+    def _user(self, user_id: int) -> _UserData:
+        u = self._users.get(int(user_id))
+        if u is None:
+            with self._lock:
+                u = self._users.setdefault(int(user_id), _UserData())
+        return u
+
+    # ── записи ──
+    def ensure_csv(self, user_id: int):
+        self._user(user_id)
+
+    def iter_rows(self, user_id: int, start: date = None, end: date = None,
+                  currency: str = None, category: str = None):
+        currency = currency.upper() if currency else None
+        rows = self._user(user_id).rows
+        for row in rows[:len(rows)]:
+            if currency and row.currency.upper() != currency:
+                continue
+            if category is not None and row.category != category:
+                continue
+            if in_period(row, start, end):
+                yield row
+
+    def rows_since(self, user_id: int, marks: dict = None):
+        u = self._user(user_id)
+        with self._lock:
+            rows = list(u.rows)
+            new_marks = {"generation": u.generation, "count": len(rows)}
+        marks = marks or {}
+        if marks.get("generation") == u.generation and marks.get("count", 0) <= len(rows):
+            return new_marks, rows[marks["count"]:], False
+        return new_marks, rows, True
+
+    def apply_batch(self, user_id: int, rows=(), accounts: dict = None, source: str = "",
+                    balances: dict = None):
+        u = self._user(user_id)
+        rows = [self._new_row(r, source) for r in rows]
+        with self._lock:
+            for r in rows:
+                u.last_id += 1
+                u.rows.append(record(r, u.last_id))
+            if accounts is not None:
+                u.state["accounts"] = {k: dict(v) for k, v in accounts.items()}
+            if balances is not None:
+                u.state["balances"] = dict(balances)
+
+    def undo_last_row(self, user_id: int):
+        u = self._user(user_id)
+        with self._lock:
+            if not u.rows:
+                return False
+            u.rows.pop()
+            u.generation += 1
+            return True
+
+    def _from_end(self, u: _UserData, n: int) -> int:
+        if n <= 0 or n > len(u.rows):
+            raise ValueError("Неверный индекс")
+        return len(u.rows) - n
+
+    def _by_id(self, u: _UserData, row_id: int) -> int:
+        for pos in range(len(u.rows) - 1, -1, -1):
+            if u.rows[pos].id == int(row_id):
+                return pos
+        raise ValueError("Запись не найдена")
+
+    def _update_at(self, u: _UserData, pos: int, changes: dict):
+        old = u.rows[pos]
+        new = self._changed(old, changes)
+        u.rows[pos] = record(new, old.id)
+        u.generation += 1
+        return dict(old), new
+
+    def update_row_from_end(self, user_id: int, n: int, **changes):
+        u = self._user(user_id)
+        with self._lock:
+            return self._update_at(u, self._from_end(u, n), changes)
+
+    def update_row_by_id(self, user_id: int, row_id: int, **changes):
+        u = self._user(user_id)
+        with self._lock:
+            return self._update_at(u, self._by_id(u, row_id), changes)
+
+    def delete_row_from_end(self, user_id: int, n: int):
+        u = self._user(user_id)
+        with self._lock:
+            removed = u.rows.pop(self._from_end(u, n))
+            u.generation += 1
+            return dict(removed)
+
+    def delete_row_by_id(self, user_id: int, row_id: int):
+        u = self._user(user_id)
+        with self._lock:
+            removed = u.rows.pop(self._by_id(u, row_id))
+            u.generation += 1
+            return dict(removed)
+
+    def find_last_row(self, user_id: int, predicate):
+        rows = list(self._user(user_id).rows)
+        for n, row in enumerate(reversed(rows), 1):
+            try:
+                if predicate(row):
+                    return n, row
+            except (ValueError, TypeError):
+                continue
+        return None
+
+    # ── счета и балансы ──
+    def _state_get(self, user_id: int, kind: str) -> dict:
+        return self._user(user_id).state[kind]
+
+    def _post_events(self, user_id: int, events: list):
+        if not events:
+            return
+        u = self._user(user_id)
+        with self._lock:
+            apply_events(u.state, events)
+
+    # ── правила ──
+    def load_rules(self, user_id: int):
+        return [dict(r) for r in self._user(user_id).rules]
+
+    def save_rules(self, user_id: int, rules):
+        self._user(user_id).rules = [dict(r) for r in rules or []]
@@ -5,7 +5,8 @@ from telegram import Update, InputFile, ReplyKeyboardRemove
 from telegram.ext import ContextTypes
 
 from app.utils import get_user_id
-from app.storage import ensure_csv
+from app.storage import iter_user_dirs
+from app.backends import ensure_csv, csv_export_path
 from app.keyboards import reply_menu_keyboard
 from app.logger import get_logger
 
@@ -63,9 +64,9 @@ async def export_csv_command(update: Update, context: ContextTypes.DEFAULT_TYPE)
     logger.info(f"User {get_user_id(update)} requested CSV export")
     
     ensure_csv(user_id)
-    path = os.path.join("data", str(user_id), "finance.csv")
+    path = csv_export_path(user_id)
     
-    if not os.path.exists(path):
+    if not path:
         return await update.effective_message.reply_text("Пока нет данных.")
     
     try:
@@ -81,7 +82,7 @@ async def export_csv_command(update: Update, context: ContextTypes.DEFAULT_TYPE)
 
 async def rules_list_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Команда /rules - показать список правил"""
-    from app.rules import load_rules
+    from app.backends import load_rules
     from app.utils import get_user_id
     
     user_id = get_user_id(update)
@@ -101,7 +102,7 @@ async def rules_list_command(update: Update, context: ContextTypes.DEFAULT_TYPE)
 
 async def setcat_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Команда /setcat - добавить правило категоризации"""
-    from app.rules import load_rules, save_rules
+    from app.backends import load_rules, save_rules
     from app.utils import get_user_id, generate_rule_id
     import json
     import re
@@ -160,7 +161,7 @@ async def setcat_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def delrule_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Команда /delrule - удалить правило"""
-    from app.rules import load_rules, save_rules
+    from app.backends import load_rules, save_rules
     from app.utils import get_user_id
     
     msg = update.effective_message
@@ -186,7 +187,7 @@ async def delrule_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def setbalance_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Команда /setbalance - установить баланс"""
-    from app.storage import set_balance
+    from app.backends import set_balance
     from app.utils import get_user_id
     
     msg = update.effective_message
@@ -212,7 +213,7 @@ async def setbalance_command(update: Update, context: ContextTypes.DEFAULT_TYPE)
 async def import_csv_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Команда /import_csv - импорт балансов из CSV файла"""
     from app.services.csv_importer import import_csv_balances
-    from app.storage import add_account
+    from app.backends import add_account
     from app.utils import get_user_id
     
     user_id = get_user_id(update)
@@ -528,7 +529,7 @@ async def check_data_command(update: Update, context: ContextTypes.DEFAULT_TYPE)
         info_text = "📊 **Информация о файлах данных**\n\n"
         
         # Проверяем папки пользователей
-        user_dirs = [d for d in data_dir.iterdir() if d.is_dir() and d.name.isdigit()]
+        user_dirs = [Path(d) for _, d in iter_user_dirs(str(data_dir))]
         info_text += f"👥 **Пользователей:** {len(user_dirs)}\n"
         
         total_files = 0
@@ -1,7 +1,10 @@
 # app/database/__init__.py
 """Модуль для работы с базой данных"""
 
+from .engine import create_database_engine
 from .models import Base, Transaction, Account, Rule, User, Balance
-from .service import DatabaseService, get_database_service
+from .service import DatabaseService, get_database_service, unit_of_work
+from .async_service import AsyncDatabaseService, get_async_database_service, async_unit_of_work
 
-__all__ = ['Base', 'Transaction', 'Account', 'Rule', 'User', 'Balance', 'DatabaseService', 'get_database_service']
+__all__ = ['Base', 'Transaction', 'Account', 'Rule', 'User', 'Balance', 'DatabaseService', 'get_database_service', 'unit_of_work', 'create_database_engine',
+           'AsyncDatabaseService', 'get_async_database_service', 'async_unit_of_work']
@@ -0,0 +1,150 @@
+# app/database/async_service.py
+"""
+Асинхронный сервис базы данных для async-обработчиков
+
+AsyncDatabaseService повторяет API DatabaseService, но каждый метод —
+корутина на AsyncSession: запросы и commit выполняет асинхронный драйвер
+(aiosqlite, asyncpg), и пока одна операция ждёт диск или сеть, цикл
+событий python-telegram-bot обслуживает остальных пользователей.
+
+Логика запросов не дублируется: метод выполняет тот же код DatabaseService
+через AsyncSession.run_sync, а ввод-вывод уходит в асинхронный драйвер.
+Возвращаются те же ORM-объекты и строки; связи (user.accounts и т.п.)
+лениво не подгружаются — нужные данные запрашивайте явно.
+
+    async with async_unit_of_work() as db_service:
+        user = await db_service.get_or_create_user(telegram_id)
+        await db_service.create_transaction(user.id, ...)
+"""
+import os
+import functools
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from typing import Optional, AsyncIterator
+
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+
+from . import models
+from .engine import async_url, create_async_database_engine
+from .service import DatabaseService, _current_service, transaction_cursor
+
+# Явный асинхронный URL; по умолчанию — DATABASE_URL с асинхронным драйвером
+ASYNC_DATABASE_URL = os.getenv("ASYNC_DATABASE_URL") or async_url(models.DATABASE_URL)
+
+# Фабрика сессий создаётся при первом обращении: асинхронный драйвер нужен
+# только тем, кто пользуется этим модулем
+AsyncSessionLocal: Optional[async_sessionmaker] = None
+
+
+def _session_factory() -> async_sessionmaker:
+    global AsyncSessionLocal
+    if AsyncSessionLocal is None:
+        AsyncSessionLocal = async_sessionmaker(create_async_database_engine(ASYNC_DATABASE_URL),
+                                               expire_on_commit=False)
+    return AsyncSessionLocal
+
+
+class AsyncDatabaseService:
+    """Асинхронный сервис для работы с базой данных (зеркало DatabaseService)"""
+
+    def __init__(self, session: AsyncSession, autocommit: bool = True):
+        self.session = session
+        # autocommit=False — работа внутри async_unit_of_work (см. DatabaseService)
+        self.autocommit = autocommit
+
+    async def run_sync(self, func, *args, **kwargs):
+        """Выполнить синхронный код на сессии этого сервиса.
+
+        Внутри func синхронные unit_of_work / get_database_service отдают
+        DatabaseService на этой же сессии — так работают *_async-версии
+        функций storage_new.
+        """
+        def call(sync_session):
+            token = _current_service.set(DatabaseService(sync_session, autocommit=False))
+            try:
+                return func(*args, **kwargs)
+            finally:
+                _current_service.reset(token)
+        result = await self.session.run_sync(call)
+        if self.autocommit:
+            await self.session.commit()
+        return result
+
+    async def iter_transactions(self, user_id: int, chunk: int = 1000, start_date=None,
+                                end_date=None, transaction_type: str = None,
+                                descending: bool = False) -> AsyncIterator:
+        """Все транзакции пользователя потоком (см. DatabaseService.iter_transactions)"""
+        after = None
+        while True:
+            rows = await self.get_transactions(user_id, chunk, transaction_type=transaction_type,
+                                               after=after, start_date=start_date, end_date=end_date,
+                                               descending=descending)
+            for row in rows:
+                yield row
+            if len(rows) < chunk:
+                return
+            after = transaction_cursor(rows[-1])
+
+    async def close(self):
+        """Закрыть сессию"""
+        await self.session.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+
+def _mirror(name: str):
+    method = getattr(DatabaseService, name)
+
+    @functools.wraps(method)
+    async def call(self, *args, **kwargs):
+        return await self.session.run_sync(
+            lambda sync_session: method(DatabaseService(sync_session, self.autocommit), *args, **kwargs))
+    return call
+
+
+# Корутины для всех публичных методов DatabaseService, кроме своих
+for _name, _attr in vars(DatabaseService).items():
+    if callable(_attr) and not _name.startswith("_") and _name not in vars(AsyncDatabaseService):
+        setattr(AsyncDatabaseService, _name, _mirror(_name))
+
+
+# ──────────────────────────────────────────────────────────────────────────────
+# ЕДИНИЦА РАБОТЫ
+# То же, что unit_of_work, для корутин: одна AsyncSession и одна транзакция
+# на блок, текущий сервис — в contextvar (своя копия у каждой asyncio-задачи).
+# ──────────────────────────────────────────────────────────────────────────────
+_current_async_service: ContextVar[Optional[AsyncDatabaseService]] = ContextVar("async_database_service",
+                                                                               default=None)
+
+
+@asynccontextmanager
+async def async_unit_of_work():
+    """Асинхронный сервис с общей сессией; commit при выходе, rollback при ошибке"""
+    service = _current_async_service.get()
+    if service is not None:
+        yield service
+        return
+    session = _session_factory()()
+    service = AsyncDatabaseService(session, autocommit=False)
+    token = _current_async_service.set(service)
+    try:
+        yield service
+        await session.commit()
+    except BaseException:
+        await session.rollback()
+        raise
+    finally:
+        _current_async_service.reset(token)
+        await session.close()
+
+
+def get_async_database_service() -> AsyncDatabaseService:
+    """Асинхронный сервис: текущей единицы работы или собственный (закрыть через async with)"""
+    service = _current_async_service.get()
+    if service is not None:
+        return service
+    return AsyncDatabaseService(_session_factory()())
@@ -0,0 +1,167 @@
+# app/database/bulk.py
+"""
+Пакетный перенос данных из файлового хранилища в базу
+
+Записи читаются потоково через app.storage (партиции, архив, шардинг
+учитываются) и вставляются пачками по chunk_size строк: одна пачка — один
+INSERT ... VALUES на много строк и одна транзакция, а не commit + refresh
+на каждую запись. Вместе с пачкой в той же транзакции обновляются итоги
+monthly_summary и сдвигается migration_progress.rows_done, поэтому
+прерванный перенос продолжается с первой невставленной записи, а уже
+перенесённые пользователи пропускаются.
+Пользователи независимы и переносятся параллельно в пуле процессов.
+
+Переносить при остановленном боте: продолжение опирается на то, что
+порядок записей в файлах с прошлого запуска не менялся.
+"""
+import os
+import json
+import itertools
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime
+from typing import Dict, Any, Iterable, Iterator, List
+
+from sqlalchemy import insert, select, update
+
+from app import rules as file_rules, storage
+from . import models
+from .models import User, Account, Transaction, Rule, BudgetBalance, MigrationProgress
+from .summary import add_to_summary, summary_key
+
+CHUNK_SIZE = int(os.getenv("MIGRATION_CHUNK_SIZE", "5000"))
+
+_DATE_FORMATS = ("%Y-%m-%d", "%d.%m.%Y", "%d/%m/%Y", "%Y-%m-%d %H:%M:%S", "%d.%m.%Y %H:%M:%S")
+
+
+def parse_csv_date(date_str: str) -> datetime:
+    """Парсинг даты из CSV; если формат не распознан — текущая дата"""
+    for fmt in _DATE_FORMATS:
+        try:
+            return datetime.strptime(date_str or "", fmt)
+        except ValueError:
+            continue
+    return datetime.now()
+
+
+def _transaction_values(user_pk: int, row) -> dict:
+    total = float(row.get("total") or 0)
+    return {
+        "user_id": user_pk,
+        "date": parse_csv_date(row.get("date")),
+        "total": abs(total),
+        "currency": row.get("currency") or "EUR",
+        "category": row.get("category") or None,
+        "merchant": row.get("merchant") or None,
+        "payment_method": row.get("payment_method") or None,
+        "source": row.get("source") or None,
+        "notes": row.get("notes") or None,
+        "transaction_type": "income" if total > 0 else "expense",
+        "is_verified": False,
+    }
+
+
+def _chunks(rows: Iterable, size: int) -> Iterator[List]:
+    it = iter(rows)
+    while True:
+        chunk = list(itertools.islice(it, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def _start_user(conn, telegram_id: int) -> tuple:
+    """(id пользователя в базе, уже перенесено строк, перенос закончен).
+
+    При первом запуске заводит пользователя, счета, правила, остатки бюджета
+    и запись о ходе переноса — всё в одной транзакции.
+    """
+    progress = conn.execute(select(MigrationProgress.user_id, MigrationProgress.rows_done,
+                                   MigrationProgress.finished)
+                            .where(MigrationProgress.telegram_id == telegram_id)).first()
+    if progress is not None:
+        return tuple(progress)
+
+    user_pk = conn.execute(select(User.id).where(User.telegram_id == telegram_id)).scalar()
+    if user_pk is None:
+        user_pk = conn.execute(insert(User).values(telegram_id=telegram_id)).inserted_primary_key[0]
+
+    accounts = [{"user_id": user_pk, "name": name, "currency": info.get("currency") or "EUR",
+                 "balance": float(info.get("amount") or 0.0), "is_active": True}
+                for name, info in storage.list_accounts(telegram_id).items()]
+    if accounts:
+        conn.execute(insert(Account), accounts)
+
+    rules = [{"user_id": user_pk, "category": rule.get("category", ""), "is_active": True,
+              "match_conditions": json.dumps(rule.get("match", {}), ensure_ascii=False)}
+             for rule in file_rules.load_rules(telegram_id)]
+    if rules:
+        conn.execute(insert(Rule), rules)
+
+    balances = [{"user_id": user_pk, "key": key, "amount": float(value or 0.0)}
+                for key, value in storage.get_balances(telegram_id).items()]
+    if balances:
+        conn.execute(insert(BudgetBalance), balances)
+
+    conn.execute(insert(MigrationProgress).values(telegram_id=telegram_id, user_id=user_pk,
+                                                  rows_done=0, finished=False))
+    return user_pk, 0, False
+
+
+def migrate_user(telegram_id: int, chunk_size: int = None) -> Dict[str, Any]:
+    """Перенести (или дописать после обрыва) данные одного пользователя"""
+    chunk_size = chunk_size or CHUNK_SIZE
+    engine = models.engine
+    with engine.begin() as conn:
+        user_pk, rows_done, finished = _start_user(conn, telegram_id)
+    stats = {"user_id": telegram_id, "skipped": finished, "resumed_from": rows_done,
+             "accounts_created": 0 if rows_done or finished else len(storage.list_accounts(telegram_id)),
+             "rules_created": 0 if rows_done or finished else len(file_rules.load_rules(telegram_id)),
+             "transactions_created": 0}
+    if finished:
+        return stats
+
+    rows = itertools.islice(storage.iter_rows(telegram_id), rows_done, None)
+    for chunk in _chunks(rows, chunk_size):
+        with engine.begin() as conn:
+            values = [_transaction_values(user_pk, r) for r in chunk]
+            conn.execute(insert(Transaction), values)
+            add_to_summary(conn, [(summary_key(user_pk, v["date"], v["transaction_type"], v["category"],
+                                               v["currency"]), v["total"]) for v in values])
+            conn.execute(update(MigrationProgress)
+                         .where(MigrationProgress.telegram_id == telegram_id)
+                         .values(rows_done=MigrationProgress.rows_done + len(chunk)))
+        stats["transactions_created"] += len(chunk)
+
+    with engine.begin() as conn:
+        conn.execute(update(MigrationProgress)
+                     .where(MigrationProgress.telegram_id == telegram_id)
+                     .values(finished=True))
+    return stats
+
+
+def _init_worker():
+    # Соединения пула, унаследованные от родителя через fork, не трогаем
+    models.engine.dispose(close=False)
+
+
+def migrate_users(user_ids: Iterable[int], workers: int = None,
+                  chunk_size: int = None) -> Iterator[Dict[str, Any]]:
+    """Перенести пользователей; результаты (или {"user_id", "error"}) — по мере готовности.
+
+    workers=1 — последовательно в текущем процессе.
+    """
+    user_ids = list(user_ids)
+    if (workers or os.cpu_count() or 1) <= 1 or len(user_ids) <= 1:
+        for uid in user_ids:
+            try:
+                yield migrate_user(uid, chunk_size)
+            except Exception as e:
+                yield {"user_id": uid, "error": str(e)}
+        return
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker) as pool:
+        futures = {pool.submit(migrate_user, uid, chunk_size): uid for uid in user_ids}
+        for future in as_completed(futures):
+            try:
+                yield future.result()
+            except Exception as e:
+                yield {"user_id": futures[future], "error": str(e)}
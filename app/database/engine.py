@@ -0,0 +1,105 @@
+# app/database/engine.py
+"""
+Фабрика движка SQLAlchemy с настройками под диалект
+
+SQLite по умолчанию работает в режиме rollback-журнала с synchronous=FULL:
+каждый commit — несколько fsync, а пишущая транзакция блокирует читателей.
+На каждом новом соединении включаем:
+
+  journal_mode=WAL      читатели не ждут писателя, commit — одна запись в WAL
+  synchronous=NORMAL    fsync только на чекпоинте (в WAL это не грозит
+                        порчей базы, при сбое питания теряется лишь хвост)
+  mmap_size             чтение страниц через отображение файла в память
+  cache_size            кэш страниц соединения (в КиБ)
+  busy_timeout          ждать освободившуюся блокировку, а не падать с
+                        "database is locked"
+
+Для остальных баз (PostgreSQL, MySQL) — пул соединений фиксированного
+размера с проверкой соединения перед выдачей и периодическим пересозданием.
+Всё настраивается переменными окружения (см. env.example).
+
+create_async_database_engine — то же для AsyncEngine (async_service.py):
+синхронный URL переводится на асинхронный драйвер (aiosqlite, asyncpg,
+aiomysql).
+"""
+import os
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import Engine, make_url
+from sqlalchemy.ext.asyncio import AsyncEngine, create_async_engine
+
+SQLITE_MMAP_SIZE = int(os.getenv("SQLITE_MMAP_SIZE", str(256 * 1024 * 1024)))
+SQLITE_CACHE_SIZE_KB = int(os.getenv("SQLITE_CACHE_SIZE_KB", "65536"))
+SQLITE_BUSY_TIMEOUT_MS = int(os.getenv("SQLITE_BUSY_TIMEOUT_MS", "5000"))
+
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "5"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "10"))
+DB_POOL_TIMEOUT = int(os.getenv("DB_POOL_TIMEOUT", "30"))
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))
+
+
+def sqlite_pragmas() -> dict:
+    """PRAGMA, выполняемые на каждом новом соединении SQLite"""
+    return {
+        "journal_mode": "WAL",
+        "synchronous": "NORMAL",
+        "mmap_size": SQLITE_MMAP_SIZE,
+        # отрицательное значение — размер в КиБ, а не в страницах
+        "cache_size": -SQLITE_CACHE_SIZE_KB,
+        "busy_timeout": SQLITE_BUSY_TIMEOUT_MS,
+    }
+
+
+def _pool_options(url: str) -> dict:
+    """Параметры пула для не-SQLite баз"""
+    if make_url(url).get_backend_name() == "sqlite":
+        return {}
+    return {
+        "pool_size": DB_POOL_SIZE,
+        "max_overflow": DB_MAX_OVERFLOW,
+        "pool_timeout": DB_POOL_TIMEOUT,
+        "pool_recycle": DB_POOL_RECYCLE,
+        "pool_pre_ping": True,
+    }
+
+
+def _set_sqlite_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    try:
+        for name, value in sqlite_pragmas().items():
+            cursor.execute(f"PRAGMA {name}={value}")
+    finally:
+        cursor.close()
+
+
+def create_database_engine(url: str, **kwargs) -> Engine:
+    """create_engine с настройками под диалект; kwargs переопределяют умолчания"""
+    engine = create_engine(url, **{"echo": False, **_pool_options(url), **kwargs})
+    if engine.dialect.name == "sqlite":
+        event.listen(engine, "connect", _set_sqlite_pragmas)
+    return engine
+
+
+# Асинхронные драйверы для синхронных URL
+ASYNC_DRIVERS = {
+    "sqlite": "sqlite+aiosqlite",
+    "postgresql": "postgresql+asyncpg",
+    "mysql": "mysql+aiomysql",
+    "mariadb": "mariadb+aiomysql",
+}
+
+
+def async_url(url: str) -> str:
+    """URL базы с асинхронным драйвером (sqlite:///x.db → sqlite+aiosqlite:///x.db)"""
+    parsed = make_url(url)
+    if parsed.drivername in ASYNC_DRIVERS.values() or parsed.get_backend_name() not in ASYNC_DRIVERS:
+        return url
+    return parsed.set(drivername=ASYNC_DRIVERS[parsed.get_backend_name()]).render_as_string(hide_password=False)
+
+
+def create_async_database_engine(url: str, **kwargs) -> AsyncEngine:
+    """create_async_engine с теми же настройками, что и create_database_engine"""
+    engine = create_async_engine(async_url(url), **{"echo": False, **_pool_options(url), **kwargs})
+    if engine.dialect.name == "sqlite":
+        event.listen(engine.sync_engine, "connect", _set_sqlite_pragmas)
+    return engine
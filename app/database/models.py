@@ -1,15 +1,20 @@
 # app/database/models.py
-from sqlalchemy import create_engine, Column, Integer, String, Float, DateTime, Text, Boolean, ForeignKey
+from sqlalchemy import Column, Integer, String, Float, DateTime, Text, Boolean, ForeignKey, Index
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker, relationship
 from datetime import datetime
 import os
 
+from .engine import create_database_engine
+
 # База данных SQLite
 DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///finance_bot.db")
 
-engine = create_engine(DATABASE_URL, echo=False)
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+# WAL и PRAGMA для SQLite, пул соединений для остальных баз — см. engine.py
+engine = create_database_engine(DATABASE_URL)
+# expire_on_commit=False: объекты, прочитанные в единице работы, остаются
+# доступны после её commit и закрытия сессии (без повторного SELECT)
+SessionLocal = sessionmaker(autocommit=False, autoflush=False, expire_on_commit=False, bind=engine)
 Base = declarative_base()
 
 
@@ -76,6 +81,13 @@ class Transaction(Base):
     # Связи
     user = relationship("User", back_populates="transactions")
     account = relationship("Account", back_populates="transactions")
+    
+    # Индексы под выборки сервиса (миграция 0002_transaction_indexes)
+    __table_args__ = (
+        Index("ix_transactions_user_date", "user_id", "date"),
+        Index("ix_transactions_user_type_date", "user_id", "transaction_type", "date"),
+        Index("ix_transactions_user_category", "user_id", "category"),
+    )
 
 
 class Rule(Base):
@@ -108,6 +120,50 @@ class Balance(Base):
     # Связи
     user = relationship("User")
     account = relationship("Account")
+    
+    # Последний снимок по счёту и прореживание истории (миграция 0005_balance_history)
+    __table_args__ = (
+        Index("ix_balances_user_account_date", "user_id", "account_id", "date"),
+    )
+
+
+class BudgetBalance(Base):
+    """Остатки бюджета по валюте ("EUR") и категории ("Food@EUR") — balances.json файлового хранилища"""
+    __tablename__ = "budget_balances"
+    
+    user_id = Column(Integer, ForeignKey("users.id"), primary_key=True)
+    key = Column(String(150), primary_key=True)
+    amount = Column(Float, nullable=False, default=0.0)
+
+
+class MonthlySummary(Base):
+    """Помесячные итоги транзакций (поддерживаются инкрементально, см. summary.py)"""
+    __tablename__ = "monthly_summary"
+    
+    user_id = Column(Integer, ForeignKey("users.id"), primary_key=True)
+    month = Column(String(7), primary_key=True)  # YYYY-MM
+    transaction_type = Column(String(20), primary_key=True)
+    category = Column(String(100), primary_key=True)  # "" — без категории
+    currency = Column(String(10), primary_key=True)
+    total = Column(Float, nullable=False, default=0.0)
+    count = Column(Integer, nullable=False, default=0)
+    min_total = Column(Float, nullable=False)
+    max_total = Column(Float, nullable=False)
+
+
+class MigrationProgress(Base):
+    """Ход переноса пользователя из файлов в базу (migrate_to_database.py).
+
+    rows_done обновляется в той же транзакции, что и очередная пачка
+    транзакций, — прерванный перенос продолжается с этого места.
+    """
+    __tablename__ = "migration_progress"
+    
+    telegram_id = Column(Integer, primary_key=True)
+    user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
+    rows_done = Column(Integer, nullable=False, default=0)
+    finished = Column(Boolean, nullable=False, default=False)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
 
 
 # Функции для работы с базой данных
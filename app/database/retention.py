@@ -0,0 +1,88 @@
+# app/database/retention.py
+"""
+Прореживание истории балансов (таблица balances)
+
+Снимок баланса пишется на каждое изменение, и таблица растёт без предела,
+хотя для графика капитала старые данные нужны всё грубее. Чем старше
+снимок, тем крупнее корзина, в которой от каждого счёта остаётся только
+последний снимок:
+
+  моложе BALANCE_KEEP_RAW_DAYS       все снимки
+  моложе BALANCE_KEEP_DAILY_DAYS     последний за день
+  моложе BALANCE_KEEP_WEEKLY_DAYS    последний за неделю
+  старше                             последний за месяц
+
+Последний снимок счёта всегда последний и в своей корзине, поэтому текущий
+баланс не теряется. Каждый уровень — один DELETE по row_number() в окне
+(счёт, корзина); повторный запуск ничего не удаляет.
+"""
+import os
+from datetime import datetime, timedelta
+
+from sqlalchemy import delete, desc, func, select
+
+from .models import Balance
+
+BALANCE_KEEP_RAW_DAYS = int(os.getenv("BALANCE_KEEP_RAW_DAYS", "7"))
+BALANCE_KEEP_DAILY_DAYS = int(os.getenv("BALANCE_KEEP_DAILY_DAYS", "90"))
+BALANCE_KEEP_WEEKLY_DAYS = int(os.getenv("BALANCE_KEEP_WEEKLY_DAYS", "730"))
+
+# Формат корзины: (SQLite strftime, MySQL date_format, PostgreSQL to_char).
+# Неделя везде ISO: с понедельника, без недели 00 и без разрыва на границе
+# года. У strftime в SQLite такого формата нет (%W делит неделю 31 декабря /
+# 1 января), поэтому там корзина недели — дата её понедельника.
+PERIOD_FORMATS = {
+    "day": ("%Y-%m-%d", "%Y-%m-%d", "YYYY-MM-DD"),
+    "week": (None, "%x-%v", "IYYY-IW"),
+    "month": ("%Y-%m", "%Y-%m", "YYYY-MM"),
+}
+
+
+def period_expr(dialect: str, column, period: str):
+    """Выражение-корзина ('YYYY-MM-DD', неделя или 'YYYY-MM') для даты на диалекте базы"""
+    sqlite_fmt, mysql_fmt, pg_fmt = PERIOD_FORMATS[period]
+    if dialect == "sqlite":
+        if sqlite_fmt is None:
+            return func.date(column, "weekday 0", "-6 days")
+        return func.strftime(sqlite_fmt, column)
+    if dialect in ("mysql", "mariadb"):
+        return func.date_format(column, mysql_fmt)
+    return func.to_char(column, pg_fmt)
+
+
+def newest_per_account(*where):
+    """Подзапрос (id, rn): rn = 1 у последнего снимка каждого счёта среди where"""
+    return (
+        select(Balance.id, func.row_number().over(
+            partition_by=Balance.account_id, order_by=(desc(Balance.date), desc(Balance.id))).label("rn"))
+        .where(*where)
+        .subquery()
+    )
+
+
+def downsample_balances(db, now: datetime = None, user_id: int = None, raw_days: int = None,
+                        daily_days: int = None, weekly_days: int = None) -> int:
+    """Проредить снимки балансов (всех пользователей или одного); вернуть число удалённых"""
+    now = now or datetime.utcnow()
+    dialect = db.get_bind().dialect.name if hasattr(db, "get_bind") else db.dialect.name
+    tiers = (
+        ("day", BALANCE_KEEP_RAW_DAYS if raw_days is None else raw_days),
+        ("week", BALANCE_KEEP_DAILY_DAYS if daily_days is None else daily_days),
+        ("month", BALANCE_KEEP_WEEKLY_DAYS if weekly_days is None else weekly_days),
+    )
+    removed = 0
+    # От мелких корзин к крупным: месячный уровень выбирает из уже недельных снимков
+    for period, days in tiers:
+        where = [Balance.date < now - timedelta(days=days)]
+        if user_id is not None:
+            where.append(Balance.user_id == user_id)
+        ranked = (
+            select(Balance.id, func.row_number().over(
+                partition_by=(Balance.account_id, period_expr(dialect, Balance.date, period)),
+                order_by=(desc(Balance.date), desc(Balance.id))).label("rn"))
+            .where(*where)
+            .subquery()
+        )
+        result = db.execute(delete(Balance).where(Balance.id.in_(select(ranked.c.id).where(ranked.c.rn > 1))))
+        removed += result.rowcount
+    return removed
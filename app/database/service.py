@@ -1,18 +1,63 @@
 # app/database/service.py
 from sqlalchemy.orm import Session
-from sqlalchemy import and_, or_, desc, asc
+from sqlalchemy import and_, or_, desc, asc, func, select
+from contextlib import contextmanager
+from contextvars import ContextVar
 from datetime import datetime, date
-from typing import List, Optional, Dict, Any
+from typing import List, Optional, Dict, Any, Tuple, Iterator
 import json
 
-from .models import User, Account, Transaction, Rule, Balance, get_db
+from . import models
+from .models import User, Account, Transaction, Rule, Balance, MonthlySummary
+from .retention import downsample_balances, newest_per_account
+from .summary import add_to_summary, remove_from_summary, rebuild_summary, month_expr, transaction_key
+
+# Колонки, которые отдают списки транзакций (get_transactions / iter_transactions):
+# строки select() без ORM-объектов, поля доступны как атрибуты (row.date, row.total)
+TRANSACTION_COLUMNS = (
+    Transaction.id, Transaction.date, Transaction.merchant, Transaction.total,
+    Transaction.currency, Transaction.category, Transaction.payment_method,
+    Transaction.source, Transaction.notes, Transaction.transaction_type,
+)
+
+
+def transaction_cursor(row) -> Tuple[datetime, int]:
+    """Курсор keyset-пагинации для строки транзакции: (date, id)"""
+    return row.date, row.id
 
 
 class DatabaseService:
-    """Сервис для работы с базой данных"""
+    """Сервис для работы с базой данных
+
+    autocommit=True — каждая изменяющая операция сама делает commit (сервис
+    вне единицы работы). autocommit=False — операции только сбрасывают
+    изменения в сессию (flush, чтобы появились id), а commit один на всю
+    единицу работы (см. unit_of_work).
+    """
     
-    def __init__(self, db: Session):
+    def __init__(self, db: Session, autocommit: bool = True):
         self.db = db
+        self.autocommit = autocommit
+    
+    def _save(self, obj=None):
+        """Зафиксировать изменения: commit вне единицы работы, flush внутри"""
+        if not self.autocommit:
+            self.db.flush()
+            return
+        self.db.commit()
+        if obj is not None:
+            self.db.refresh(obj)
+    
+    def close(self):
+        """Закрыть сессию (сессией единицы работы управляет unit_of_work)"""
+        if self.autocommit:
+            self.db.close()
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc):
+        self.close()
     
     # ==================== ПОЛЬЗОВАТЕЛИ ====================
     
@@ -29,15 +74,14 @@ class DatabaseService:
                 last_name=last_name
             )
             self.db.add(user)
-            self.db.commit()
-            self.db.refresh(user)
+            self._save(user)
         else:
             # Обновляем информацию о пользователе
             user.username = username
             user.first_name = first_name
             user.last_name = last_name
             user.updated_at = datetime.utcnow()
-            self.db.commit()
+            self._save()
         
         return user
     
@@ -57,8 +101,7 @@ class DatabaseService:
             balance=balance
         )
         self.db.add(account)
-        self.db.commit()
-        self.db.refresh(account)
+        self._save(account)
         return account
     
     def get_accounts(self, user_id: int) -> List[Account]:
@@ -77,7 +120,7 @@ class DatabaseService:
         if account:
             account.balance = new_balance
             account.updated_at = datetime.utcnow()
-            self.db.commit()
+            self._save()
     
     def delete_account(self, account_id: int):
         """Удалить счет (мягкое удаление)"""
@@ -85,7 +128,7 @@ class DatabaseService:
         if account:
             account.is_active = False
             account.updated_at = datetime.utcnow()
-            self.db.commit()
+            self._save()
     
     # ==================== ТРАНЗАКЦИИ ====================
     
@@ -109,19 +152,52 @@ class DatabaseService:
             transaction_type=transaction_type
         )
         self.db.add(transaction)
-        self.db.commit()
-        self.db.refresh(transaction)
+        add_to_summary(self.db, [(transaction_key(transaction), total)])
+        self._save(transaction)
         return transaction
     
-    def get_transactions(self, user_id: int, limit: int = 100, 
-                        offset: int = 0, transaction_type: str = None) -> List[Transaction]:
-        """Получить транзакции пользователя"""
-        query = self.db.query(Transaction).filter(Transaction.user_id == user_id)
-        
-        if transaction_type:
-            query = query.filter(Transaction.transaction_type == transaction_type)
-        
-        return query.order_by(desc(Transaction.date)).offset(offset).limit(limit).all()
+    def get_transactions(self, user_id: int, limit: int = 100, offset: int = 0,
+                        transaction_type: str = None, after: Tuple = None,
+                        start_date: date = None, end_date: date = None,
+                        descending: bool = True) -> List:
+        """Получить страницу транзакций пользователя (по умолчанию новые сначала).
+
+        Следующая страница — after=transaction_cursor(последняя строка):
+        keyset по (date, id) читает ровно limit строк по индексу на любой
+        глубине, в отличие от offset, который пропускает строки перебором.
+        """
+        where = self._transaction_filters(user_id, start_date, end_date, transaction_type)
+        stmt = self._transactions_page(where, after, limit, descending)
+        if offset:
+            stmt = stmt.offset(offset)
+        return self.db.execute(stmt).all()
+    
+    def iter_transactions(self, user_id: int, chunk: int = 1000, start_date: date = None,
+                          end_date: date = None, transaction_type: str = None,
+                          descending: bool = False) -> Iterator:
+        """Все транзакции пользователя потоком (по умолчанию в хронологическом порядке).
+
+        Читает пачками по chunk строк keyset-запросами — в памяти не больше
+        одной пачки, сколько бы транзакций ни было.
+        """
+        after = None
+        while True:
+            rows = self.get_transactions(user_id, chunk, transaction_type=transaction_type, after=after,
+                                         start_date=start_date, end_date=end_date, descending=descending)
+            yield from rows
+            if len(rows) < chunk:
+                return
+            after = transaction_cursor(rows[-1])
+    
+    def _transactions_page(self, where: list, after: Tuple, limit: int, descending: bool):
+        order = desc if descending else asc
+        stmt = select(*TRANSACTION_COLUMNS).where(*where)
+        if after is not None:
+            after_date, after_id = after
+            beyond = (Transaction.date < after_date) if descending else (Transaction.date > after_date)
+            next_id = (Transaction.id < after_id) if descending else (Transaction.id > after_id)
+            stmt = stmt.where(or_(beyond, and_(Transaction.date == after_date, next_id)))
+        return stmt.order_by(order(Transaction.date), order(Transaction.id)).limit(limit)
     
     def get_transactions_by_date_range(self, user_id: int, start_date: date, 
                                       end_date: date) -> List[Transaction]:
@@ -142,20 +218,29 @@ class DatabaseService:
         """Обновить транзакцию"""
         transaction = self.get_transaction(transaction_id)
         if transaction:
+            old = (transaction_key(transaction), transaction.total)
             for key, value in kwargs.items():
                 if hasattr(transaction, key):
                     setattr(transaction, key, value)
             transaction.updated_at = datetime.utcnow()
-            self.db.commit()
-            self.db.refresh(transaction)
+            new = (transaction_key(transaction), transaction.total)
+            if new != old:
+                # Итоги пересчитываются по уже изменённой транзакции
+                self.db.flush()
+                remove_from_summary(self.db, *old)
+                add_to_summary(self.db, [new])
+            self._save(transaction)
         return transaction
     
     def delete_transaction(self, transaction_id: int):
         """Удалить транзакцию"""
         transaction = self.get_transaction(transaction_id)
         if transaction:
+            old = (transaction_key(transaction), transaction.total)
             self.db.delete(transaction)
-            self.db.commit()
+            self.db.flush()
+            remove_from_summary(self.db, *old)
+            self._save()
     
     # ==================== ПРАВИЛА ====================
     
@@ -167,8 +252,7 @@ class DatabaseService:
             match_conditions=json.dumps(match_conditions, ensure_ascii=False)
         )
         self.db.add(rule)
-        self.db.commit()
-        self.db.refresh(rule)
+        self._save(rule)
         return rule
     
     def get_rules(self, user_id: int) -> List[Rule]:
@@ -189,8 +273,7 @@ class DatabaseService:
                 if hasattr(rule, key):
                     setattr(rule, key, value)
             rule.updated_at = datetime.utcnow()
-            self.db.commit()
-            self.db.refresh(rule)
+            self._save(rule)
         return rule
     
     def delete_rule(self, rule_id: int):
@@ -199,7 +282,7 @@ class DatabaseService:
         if rule:
             rule.is_active = False
             rule.updated_at = datetime.utcnow()
-            self.db.commit()
+            self._save()
     
     # ==================== БАЛАНСЫ ====================
     
@@ -212,29 +295,51 @@ class DatabaseService:
             currency=currency
         )
         self.db.add(balance_record)
-        self.db.commit()
+        self._save()
     
     def get_latest_balances(self, user_id: int) -> List[Balance]:
-        """Получить последние балансы пользователя"""
-        return self.db.query(Balance).filter(
-            Balance.user_id == user_id
-        ).order_by(desc(Balance.date)).all()
+        """Последний снимок баланса по каждому счёту пользователя (row_number() в окне счёта)"""
+        newest = newest_per_account(Balance.user_id == user_id)
+        return self.db.execute(
+            select(Balance).join(newest, Balance.id == newest.c.id)
+            .where(newest.c.rn == 1).order_by(Balance.account_id)
+        ).scalars().all()
+    
+    def get_balance_history(self, user_id: int, account_id: int = None, start_date: date = None,
+                            end_date: date = None) -> List[Tuple[datetime, int, str, float]]:
+        """История снимков для графика: (дата, счёт, валюта, баланс) по возрастанию даты"""
+        where = [Balance.user_id == user_id]
+        if account_id is not None:
+            where.append(Balance.account_id == account_id)
+        if start_date:
+            where.append(Balance.date >= start_date)
+        if end_date:
+            where.append(Balance.date <= end_date)
+        return self._rows(
+            select(Balance.date, Balance.account_id, Balance.currency, Balance.balance)
+            .where(*where).order_by(Balance.date, Balance.id)
+        )
+    
+    def downsample_balances(self, now: datetime = None, user_id: int = None) -> int:
+        """Проредить старые снимки балансов (см. retention.py); вернуть число удалённых"""
+        removed = downsample_balances(self.db, now, user_id)
+        self._save()
+        return removed
     
     # ==================== СТАТИСТИКА ====================
+    # Агрегаты считает база (GROUP BY), наружу идут простые кортежи — ORM-объекты
+    # транзакций не создаются.
     
     def get_user_stats(self, user_id: int) -> Dict[str, Any]:
-        """Получить статистику пользователя"""
-        accounts_count = self.db.query(Account).filter(
-            and_(Account.user_id == user_id, Account.is_active == True)
-        ).count()
+        """Получить статистику пользователя (один запрос)"""
+        def _count(model, *where):
+            return select(func.count()).select_from(model).where(model.user_id == user_id, *where).scalar_subquery()
         
-        transactions_count = self.db.query(Transaction).filter(
-            Transaction.user_id == user_id
-        ).count()
-        
-        rules_count = self.db.query(Rule).filter(
-            and_(Rule.user_id == user_id, Rule.is_active == True)
-        ).count()
+        accounts_count, transactions_count, rules_count = self.db.execute(select(
+            _count(Account, Account.is_active == True),
+            _count(Transaction),
+            _count(Rule, Rule.is_active == True),
+        )).one()
         
         return {
             "accounts_count": accounts_count,
@@ -242,30 +347,158 @@ class DatabaseService:
             "rules_count": rules_count
         }
     
-    def get_category_stats(self, user_id: int, start_date: date = None, 
-                          end_date: date = None) -> Dict[str, float]:
-        """Получить статистику по категориям"""
-        query = self.db.query(Transaction).filter(Transaction.user_id == user_id)
-        
+    def _transaction_filters(self, user_id: int, start_date: date = None, end_date: date = None,
+                             transaction_type: str = None) -> list:
+        where = [Transaction.user_id == user_id]
         if start_date:
-            query = query.filter(Transaction.date >= start_date)
+            where.append(Transaction.date >= start_date)
         if end_date:
-            query = query.filter(Transaction.date <= end_date)
-        
-        transactions = query.all()
-        
-        category_stats = {}
-        for transaction in transactions:
-            if transaction.category:
-                if transaction.category not in category_stats:
-                    category_stats[transaction.category] = 0.0
-                category_stats[transaction.category] += abs(transaction.total)
-        
-        return category_stats
+            where.append(Transaction.date <= end_date)
+        if transaction_type:
+            where.append(Transaction.transaction_type == transaction_type)
+        return where
+    
+    def _month(self):
+        """Выражение 'YYYY-MM' для даты транзакции на диалекте текущей базы"""
+        return month_expr(self.db.get_bind().dialect.name)
+    
+    def _rows(self, stmt) -> List[Tuple]:
+        return [tuple(row) for row in self.db.execute(stmt)]
+    
+    def get_category_stats(self, user_id: int, start_date: date = None, 
+                          end_date: date = None) -> Dict[str, float]:
+        """Получить статистику по категориям: {категория: сумма abs(total)}"""
+        stmt = (
+            select(Transaction.category, func.sum(func.abs(Transaction.total)))
+            .where(*self._transaction_filters(user_id, start_date, end_date),
+                   Transaction.category.is_not(None), Transaction.category != "")
+            .group_by(Transaction.category)
+        )
+        return {category: float(total) for category, total in self.db.execute(stmt)}
+    
+    def get_monthly_stats(self, user_id: int, start_date: date = None, end_date: date = None,
+                          transaction_type: str = None) -> List[Tuple[str, str, str, float, int]]:
+        """Итоги по месяцам: (месяц 'YYYY-MM', тип, валюта, сумма, число транзакций)
+
+        Без границ периода — из monthly_summary, без прохода по транзакциям.
+        """
+        if start_date is None and end_date is None:
+            where = [MonthlySummary.user_id == user_id]
+            if transaction_type:
+                where.append(MonthlySummary.transaction_type == transaction_type)
+            return self._rows(
+                select(MonthlySummary.month, MonthlySummary.transaction_type, MonthlySummary.currency,
+                       func.sum(MonthlySummary.total), func.sum(MonthlySummary.count))
+                .where(*where)
+                .group_by(MonthlySummary.month, MonthlySummary.transaction_type, MonthlySummary.currency)
+                .order_by(MonthlySummary.month, MonthlySummary.transaction_type, MonthlySummary.currency)
+            )
+        month = self._month().label("month")
+        stmt = (
+            select(month, Transaction.transaction_type, Transaction.currency,
+                   func.sum(Transaction.total), func.count())
+            .where(*self._transaction_filters(user_id, start_date, end_date, transaction_type))
+            .group_by(month, Transaction.transaction_type, Transaction.currency)
+            .order_by(month, Transaction.transaction_type, Transaction.currency)
+        )
+        return self._rows(stmt)
+    
+    def get_merchant_stats(self, user_id: int, start_date: date = None, end_date: date = None,
+                           transaction_type: str = None,
+                           limit: int = None) -> List[Tuple[str, str, float, int]]:
+        """Итоги по магазинам: (магазин, валюта, сумма, число транзакций), по убыванию суммы"""
+        total = func.sum(Transaction.total).label("total")
+        stmt = (
+            select(Transaction.merchant, Transaction.currency, total, func.count())
+            .where(*self._transaction_filters(user_id, start_date, end_date, transaction_type),
+                   Transaction.merchant.is_not(None), Transaction.merchant != "")
+            .group_by(Transaction.merchant, Transaction.currency)
+            .order_by(desc(total))
+        )
+        if limit:
+            stmt = stmt.limit(limit)
+        return self._rows(stmt)
+    
+    def get_currency_stats(self, user_id: int, start_date: date = None,
+                           end_date: date = None) -> List[Tuple[str, str, float, int]]:
+        """Итоги по валютам: (валюта, тип, сумма, число транзакций)"""
+        stmt = (
+            select(Transaction.currency, Transaction.transaction_type,
+                   func.sum(Transaction.total), func.count())
+            .where(*self._transaction_filters(user_id, start_date, end_date))
+            .group_by(Transaction.currency, Transaction.transaction_type)
+            .order_by(Transaction.currency, Transaction.transaction_type)
+        )
+        return self._rows(stmt)
+
+    
+    def get_monthly_summary(self, user_id: int, month: str = None, start_month: str = None,
+                            end_month: str = None, transaction_type: str = None) -> List[Tuple]:
+        """Помесячные итоги из monthly_summary (месяцы — 'YYYY-MM', границы включительно):
+        (месяц, тип, категория, валюта, сумма, число, минимум, максимум)"""
+        where = [MonthlySummary.user_id == user_id]
+        if month:
+            where.append(MonthlySummary.month == month)
+        if start_month:
+            where.append(MonthlySummary.month >= start_month)
+        if end_month:
+            where.append(MonthlySummary.month <= end_month)
+        if transaction_type:
+            where.append(MonthlySummary.transaction_type == transaction_type)
+        return self._rows(
+            select(MonthlySummary.month, MonthlySummary.transaction_type, MonthlySummary.category,
+                   MonthlySummary.currency, MonthlySummary.total, MonthlySummary.count,
+                   MonthlySummary.min_total, MonthlySummary.max_total)
+            .where(*where)
+            .order_by(MonthlySummary.month, MonthlySummary.transaction_type,
+                      MonthlySummary.category, MonthlySummary.currency)
+        )
+    
+    def rebuild_monthly_summary(self, user_id: int = None):
+        """Пересчитать monthly_summary по транзакциям (пользователя или всех)"""
+        rebuild_summary(self.db, user_id)
+        self._save()
+
+# ──────────────────────────────────────────────────────────────────────────────
+# ЕДИНИЦА РАБОТЫ
+# Одна сессия и одна транзакция на блок (обычно — на один Telegram update).
+# Текущий сервис хранится в contextvar: каждый update обрабатывается в своей
+# asyncio-задаче со своей копией контекста, так что параллельные update не
+# делят сессию. Вложенные unit_of_work и get_database_service внутри блока
+# возвращают тот же сервис.
+# ──────────────────────────────────────────────────────────────────────────────
+_current_service: ContextVar[Optional[DatabaseService]] = ContextVar("database_service", default=None)
+
+
+@contextmanager
+def unit_of_work():
+    """Сервис с общей сессией; commit при выходе из блока, rollback при ошибке"""
+    service = _current_service.get()
+    if service is not None:
+        yield service
+        return
+    db = models.SessionLocal()
+    service = DatabaseService(db, autocommit=False)
+    token = _current_service.set(service)
+    try:
+        yield service
+        db.commit()
+    except BaseException:
+        db.rollback()
+        raise
+    finally:
+        _current_service.reset(token)
+        db.close()
 
 
-# Функция для получения сервиса базы данных
 def get_database_service():
-    """Получить сервис базы данных"""
-    db = next(get_db())
-    return DatabaseService(db)
+    """Получить сервис базы данных.
+
+    Внутри unit_of_work — сервис текущей единицы работы. Вне её — сервис с
+    собственной сессией и commit на каждой операции; его нужно закрыть
+    (service.close() или with get_database_service() as db_service).
+    """
+    service = _current_service.get()
+    if service is not None:
+        return service
+    return DatabaseService(models.SessionLocal())
@@ -0,0 +1,170 @@
+# app/database/summary.py
+"""
+Помесячные итоги транзакций (таблица monthly_summary)
+
+Строка на (пользователь, месяц, тип, категория, валюта): сумма, число,
+минимум и максимум. Итоги поддерживаются инкрементально в той же
+транзакции БД, что и изменение самих транзакций (DatabaseService.create_/
+update_/delete_transaction, пакетный перенос в bulk.py), поэтому отчёт за
+месяц — чтение нескольких строк, а не проход по transactions.
+
+Добавление — один upsert на пачку (ON CONFLICT DO UPDATE в SQLite и
+PostgreSQL, ON DUPLICATE KEY UPDATE в MySQL): total = total + :x без
+чтения, и две транзакции, одновременно открывающие новую группу, не
+сталкиваются на первичном ключе. На прочих диалектах — UPDATE, а при
+отсутствии строки INSERT в точке сохранения с повтором UPDATE, если её
+успела вставить другая транзакция.
+Удаление — тоже без чтения: count = count - 1, total = total - :x, затем
+DELETE группы с count <= 0. Минимум/максимум при удалении не вычитаются —
+если удалили граничное значение, они пересчитываются по транзакциям этой
+группы (подзапрос по индексу user_id + date за месяц). Пустая категория
+хранится как "".
+
+Функции принимают и Session, и Connection.
+"""
+from collections import defaultdict
+from datetime import datetime
+from types import SimpleNamespace
+from typing import Iterable, Tuple
+
+from sqlalchemy import case, delete, func, insert, or_, select, update
+from sqlalchemy.dialects import mysql, postgresql, sqlite
+from sqlalchemy.exc import IntegrityError
+
+from .models import Transaction, MonthlySummary
+
+# (user_id, месяц 'YYYY-MM', тип, категория, валюта)
+SummaryKey = Tuple[int, str, str, str, str]
+
+_KEY_COLUMNS = ("user_id", "month", "transaction_type", "category", "currency")
+
+
+def dialect_name(db) -> str:
+    """Диалект базы для Session или Connection"""
+    return db.get_bind().dialect.name if hasattr(db, "get_bind") else db.dialect.name
+
+
+def month_expr(dialect: str, column=Transaction.date):
+    """Выражение 'YYYY-MM' для даты на диалекте базы"""
+    if dialect == "sqlite":
+        return func.strftime("%Y-%m", column)
+    if dialect in ("mysql", "mariadb"):
+        return func.date_format(column, "%Y-%m")
+    return func.to_char(column, "YYYY-MM")
+
+
+def summary_key(user_id: int, date: datetime, transaction_type: str, category: str,
+                currency: str) -> SummaryKey:
+    return user_id, date.strftime("%Y-%m"), transaction_type, category or "", currency
+
+
+def transaction_key(transaction) -> SummaryKey:
+    return summary_key(transaction.user_id, transaction.date, transaction.transaction_type,
+                       transaction.category, transaction.currency)
+
+
+def _where(key: SummaryKey) -> tuple:
+    user_id, month, transaction_type, category, currency = key
+    return (MonthlySummary.user_id == user_id, MonthlySummary.month == month,
+            MonthlySummary.transaction_type == transaction_type,
+            MonthlySummary.category == category, MonthlySummary.currency == currency)
+
+
+def _merged(current, added) -> dict:
+    """Значения итогов после прибавления added (колонки новой строки) к current"""
+    return {
+        "total": current.total + added.total,
+        "count": current.count + added.count,
+        "min_total": case((added.min_total < current.min_total, added.min_total), else_=current.min_total),
+        "max_total": case((added.max_total > current.max_total, added.max_total), else_=current.max_total),
+    }
+
+
+def summary_upsert(dialect: str, rows: list):
+    """INSERT строк итогов, прибавляющий их к существующим; None — диалект без upsert"""
+    if dialect in ("sqlite", "postgresql"):
+        stmt = (sqlite if dialect == "sqlite" else postgresql).insert(MonthlySummary).values(rows)
+        return stmt.on_conflict_do_update(index_elements=_KEY_COLUMNS,
+                                          set_=_merged(MonthlySummary, stmt.excluded))
+    if dialect in ("mysql", "mariadb"):
+        stmt = mysql.insert(MonthlySummary).values(rows)
+        return stmt.on_duplicate_key_update(**_merged(MonthlySummary, stmt.inserted))
+    return None
+
+
+def add_to_summary(db, items: Iterable[Tuple[SummaryKey, float]]):
+    """Учесть транзакции (ключ, сумма) в итогах — одним upsert на все ключи"""
+    groups = defaultdict(lambda: [0.0, 0, None, None])
+    for key, total in items:
+        g = groups[key]
+        g[0] += total
+        g[1] += 1
+        g[2] = total if g[2] is None else min(g[2], total)
+        g[3] = total if g[3] is None else max(g[3], total)
+    if not groups:
+        return
+    rows = [dict(zip(_KEY_COLUMNS, key), total=total, count=count, min_total=lo, max_total=hi)
+            for key, (total, count, lo, hi) in groups.items()]
+    stmt = summary_upsert(dialect_name(db), rows)
+    if stmt is not None:
+        db.execute(stmt)
+        return
+    for row in rows:
+        _add_row(db, row)
+
+
+def _add_row(db, row: dict):
+    """UPDATE, а при отсутствии строки — INSERT в точке сохранения"""
+    stmt = (update(MonthlySummary).where(*_where(tuple(row[c] for c in _KEY_COLUMNS)))
+            .values(**_merged(MonthlySummary, SimpleNamespace(**row))))
+    if db.execute(stmt).rowcount:
+        return
+    try:
+        with db.begin_nested():
+            db.execute(insert(MonthlySummary).values(row))
+    except IntegrityError:
+        # Строку успела вставить параллельная транзакция — прибавляем к ней
+        db.execute(stmt)
+
+
+def remove_from_summary(db, key: SummaryKey, total: float):
+    """Исключить транзакцию из итогов. Саму транзакцию нужно уже удалить/изменить (flush)."""
+    where = _where(key)
+    db.execute(update(MonthlySummary).where(*where)
+               .values(total=MonthlySummary.total - total, count=MonthlySummary.count - 1))
+    db.execute(delete(MonthlySummary).where(*where, MonthlySummary.count <= 0))
+    remaining = select(func.min(Transaction.total), func.max(Transaction.total)).where(*_transactions_of(key))
+    db.execute(update(MonthlySummary)
+               .where(*where, or_(MonthlySummary.min_total >= total, MonthlySummary.max_total <= total))
+               .values(min_total=remaining.with_only_columns(func.min(Transaction.total)).scalar_subquery(),
+                       max_total=remaining.with_only_columns(func.max(Transaction.total)).scalar_subquery()))
+
+
+def _transactions_of(key: SummaryKey) -> tuple:
+    user_id, month, transaction_type, category, currency = key
+    year, mon = map(int, month.split("-"))
+    start = datetime(year, mon, 1)
+    end = datetime(year + mon // 12, mon % 12 + 1, 1)
+    return (Transaction.user_id == user_id, Transaction.date >= start, Transaction.date < end,
+            Transaction.transaction_type == transaction_type,
+            func.coalesce(Transaction.category, "") == category, Transaction.currency == currency)
+
+
+def rebuild_summary(db, user_id: int = None):
+    """Пересчитать итоги по транзакциям (для существующих баз и проверки)"""
+    month = month_expr(dialect_name(db))
+    category = func.coalesce(Transaction.category, "")
+    source = (
+        select(Transaction.user_id, month, Transaction.transaction_type, category, Transaction.currency,
+               func.sum(Transaction.total), func.count(), func.min(Transaction.total),
+               func.max(Transaction.total))
+        .group_by(Transaction.user_id, month, Transaction.transaction_type, category, Transaction.currency)
+    )
+    clear = delete(MonthlySummary)
+    if user_id is not None:
+        source = source.where(Transaction.user_id == user_id)
+        clear = clear.where(MonthlySummary.user_id == user_id)
+    db.execute(clear)
+    db.execute(insert(MonthlySummary).from_select(
+        ["user_id", "month", "transaction_type", "category", "currency",
+         "total", "count", "min_total", "max_total"], source))
@@ -10,7 +10,7 @@ from app.keyboards import (
     balance_menu_kb, reply_menu_keyboard, accounts_kb, account_edit_menu_kb,
     currency_selection_kb, delete_confirmation_kb
 )
-from app.storage import (
+from app.backends import (
     list_accounts, add_account, set_account_amount, format_accounts,
     delete_account, update_account_currency
 )
@@ -11,13 +11,31 @@ from app.exceptions import ReceiptParsingError, ValidationError
 from app.services.enhanced_receipt_parser import EnhancedReceiptParser
 from app.services.smart_categorization import SmartCategorizationService
 from app.services.receipt_validator import ReceiptValidator
-from app.storage import list_accounts
+from app.backends import apply_batch, get_balances, list_accounts
 from app.keyboards import accounts_kb, categories_kb
 from app.constants import CHOOSE_ACC_FOR_RECEIPT, CHOOSE_CATEGORY_FOR_RECEIPT
 
 logger = get_logger(__name__)
 
 
+def _save_posted(user_id: int, row: dict, source: str, account: str, delta: float, balances: dict):
+    """Сохранить запись, изменение счёта и балансы одним apply_batch.
+
+    Запись и остатки фиксируются вместе: после сбоя не бывает записи без
+    проводки или проводки без записи.
+    """
+    accounts = list_accounts(user_id)
+    accounts[account]["amount"] = float(accounts[account]["amount"]) + delta
+    apply_batch(user_id, [row], accounts=accounts, source=source, balances=balances)
+
+
+def _income_balances(user_id: int, amount: float, currency: str) -> dict:
+    """Балансы после дохода (как inc_balance_for_income)"""
+    balances = get_balances(user_id)
+    balances[currency] = float(balances.get(currency, 0.0)) + amount
+    return balances
+
+
 async def enhanced_on_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Улучшенный обработчик фото чеков"""
     msg = update.effective_message
@@ -217,18 +235,12 @@ async def enhanced_receipt_choose_account_finish(update: Update, context: Contex
     try:
         # Обрабатываем доход
         if pending_income:
-            from app.storage import append_row_csv, inc_account
-            from app.handlers.income import inc_balance_for_income
-            
             income_data = pending_income.copy()
             income_data["payment_method"] = choice
             
-            # Сохраняем доход
-            append_row_csv(user_id, income_data, source="manual_income")
-            
-            # Увеличиваем баланс и счёт (доход)
-            inc_balance_for_income(user_id, income_data["total"], income_data["currency"], income_data.get("category"))
-            inc_account(user_id, choice, income_data["total"])
+            # Доход, баланс и счёт сохраняются одним apply_batch
+            _save_posted(user_id, income_data, "manual_income", choice, income_data["total"],
+                         _income_balances(user_id, income_data["total"], income_data["currency"]))
             
             success_text = (
                 f"✅ <b>Доход сохранён!</b>\n\n"
@@ -252,8 +264,6 @@ async def enhanced_receipt_choose_account_finish(update: Update, context: Contex
         
         # Обрабатываем чек (расход)
         elif pending_data:
-            from app.storage import append_row_csv, dec_balance, dec_account
-            
             receipt_data = pending_data["data"]
             
             # Проверяем тип данных - объект или словарь
@@ -293,11 +303,8 @@ async def enhanced_receipt_choose_account_finish(update: Update, context: Contex
                 # Это словарь (из voice)
                 transaction_data = receipt_data.copy()
             
-            # Сохраняем в CSV
             source = f"enhanced_photo:{pending_data.get('photo_id', '')}" if hasattr(receipt_data, 'payment_method') else f"voice:{pending_data.get('photo_id', '')}"
-            append_row_csv(user_id, transaction_data, source=source)
             
-            # Обновляем балансы
             if hasattr(receipt_data, 'total'):
                 # Объект
                 total = receipt_data.total
@@ -312,14 +319,19 @@ async def enhanced_receipt_choose_account_finish(update: Update, context: Contex
             # Определяем, доход это или расход
             if total > 0:
                 # Доход - увеличиваем баланс и счёт
-                from app.handlers.income import inc_balance_for_income
-                inc_balance_for_income(user_id, total, currency, category)
-                from app.storage import inc_account
-                inc_account(user_id, choice, total)
+                delta = total
+                balances = _income_balances(user_id, total, currency)
             else:
-                # Расход - уменьшаем баланс и счёт
-                dec_balance(user_id, total, currency, category)
-                dec_account(user_id, choice, total)
+                # Расход - те же изменения, что у dec_balance и dec_account
+                delta = -float(total or 0)
+                balances = get_balances(user_id)
+                if currency:
+                    for key in (currency.upper(), f"{(category or '')}@{currency.upper()}"):
+                        if key in balances and delta:
+                            balances[key] = float(balances[key]) + delta
+            
+            # Запись, счёт и балансы сохраняются одним apply_batch
+            _save_posted(user_id, transaction_data, source, choice, delta, balances)
             
             # Показываем результат
             if total > 0:
@@ -23,14 +23,17 @@ from app.categories import (
     income_categories_kb, get_income_categories_list, format_category_for_display,
     get_income_category_by_name, validate_and_normalize_income_category
 )
-from app.storage import (
-    ensure_csv, read_rows, append_row_csv, undo_last_row,
+from app.backends import (
+    ensure_csv, read_rows, iter_rows, append_row_csv, undo_last_row,
     set_balance, get_balances, fmt_money,
     update_last_row, update_row_from_end, rebalance_on_edit,
-    list_accounts, add_account, set_account_amount, inc_account,
+    find_last_row, update_row_by_id, delete_row_by_id,
+    list_accounts, add_account, adjust_accounts, inc_account,
     find_accounts_by_currency, format_accounts
 )
-from app.rules import apply_category_rules, load_rules, save_rules
+from app.rules import apply_category_rules
+from app.backends import load_rules, save_rules
+from app.models import row_amount
 from app.utils import get_user_id as _uid
 
 # ──────────────────────────────────────────────────────────────────────────────
@@ -41,21 +44,23 @@ def rebalance_accounts_on_income_edit(user_id: int, old_row: dict, new_row: dict
         try: return float(x)
         except: return 0.0
     
-    accs = list_accounts(user_id)
     old_acc = (old_row.get("payment_method") or "").strip()
     new_acc = (new_row.get("payment_method") or "").strip()
     old_total = _num(old_row.get("total", 0))
     new_total = _num(new_row.get("total", 0))
     
-    # Отменить предыдущее изменение (убрать старую сумму дохода)
-    if old_acc and old_acc in accs:
-        cur = float(accs[old_acc]["amount"])
-        set_account_amount(user_id, old_acc, cur - old_total)
-    
-    # Применить новое изменение (добавить новую сумму дохода)
-    if new_acc and new_acc in accs:
-        cur = float(list_accounts(user_id)[new_acc]["amount"])
-        set_account_amount(user_id, new_acc, cur + new_total)
+    # Убрать старую сумму дохода и добавить новую — компенсирующими событиями
+    adjust_accounts(user_id, [(old_acc, -old_total), (new_acc, new_total)])
+
+def _is_income_row(row: dict) -> bool:
+    return row_amount(row) > 0
+
+def _update_last_income(user_id: int, **changes):
+    """Изменить последний доход (а не просто последнюю запись) по его id"""
+    found = find_last_row(user_id, _is_income_row)
+    if not found:
+        raise ValueError("Записей о доходах нет")
+    return update_row_by_id(user_id, found[1].id, **changes)
 
 def inc_balance_for_income(user_id: int, amount: float, currency: str, category: str = None):
     """Увеличить баланс для дохода (положительная операция)"""
@@ -84,16 +89,12 @@ async def income_back(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def income_last(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Показать последний доход"""
-    rows = read_rows(_uid(update))
-    if not rows:
-        return await update.effective_message.reply_text("Пока записей нет.")
-    
-    # Ищем последний доход (положительная сумма)
-    income_rows = [r for r in rows if float(r.get('total', 0) or 0) > 0]
-    if not income_rows:
+    # Ищем последний доход (положительная сумма) с конца файла
+    found = find_last_row(_uid(update), _is_income_row)
+    if not found:
         return await update.effective_message.reply_text("Записей о доходах пока нет.")
     
-    r = income_rows[-1]
+    _, r = found
     await update.effective_message.reply_text(
         "💰 Последний доход:\n"
         f"• Дата: {r.get('date','')}\n"
@@ -105,54 +106,25 @@ async def income_last(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def income_undo(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Отменить последний доход"""
-    rows = read_rows(_uid(update))
-    if not rows:
-        return await update.effective_message.reply_text("Удалять нечего.")
-    
-    # Ищем последний доход (положительная сумма)
-    income_rows = [r for r in rows if float(r.get('total', 0) or 0) > 0]
-    if not income_rows:
+    found = find_last_row(_uid(update), _is_income_row)
+    if not found:
         return await update.effective_message.reply_text("Записей о доходах для удаления нет.")
     
-    # Находим индекс последнего дохода в общем списке
-    last_income = income_rows[-1]
-    last_income_index = None
-    for i in range(len(rows) - 1, -1, -1):
-        if rows[i] == last_income:
-            last_income_index = i
-            break
+    # Удаляем запись по id (перезаписывается только хвост файла) и корректируем балансы
+    _, row = found
+    removed_row = delete_row_by_id(_uid(update), row.id)
     
-    if last_income_index is not None:
-        # Удаляем запись и корректируем балансы
-        removed_row = rows.pop(last_income_index)
-        
-        # Пересохраняем CSV
-        import csv
-        csv_path = f"data/{_uid(update)}/finance.csv"
-        os.makedirs(os.path.dirname(csv_path), exist_ok=True)
-        
-        with open(csv_path, "w", newline="", encoding="utf-8") as f:
-            if rows:
-                writer = csv.DictWriter(f, fieldnames=rows[0].keys())
-                writer.writeheader()
-                writer.writerows(rows)
-        
-        # Корректируем баланс
-        amount = float(removed_row.get('total', 0) or 0)
-        currency = removed_row.get('currency', 'EUR')
-        inc_balance_for_income(_uid(update), -amount, currency)  # Вычитаем доход
-        
-        # Корректируем счёт
-        account = removed_row.get('payment_method')
-        if account:
-            accounts = list_accounts(_uid(update))
-            if account in accounts:
-                current_amount = float(accounts[account]["amount"])
-                set_account_amount(_uid(update), account, current_amount - amount)
-        
-        await update.effective_message.reply_text("↩️ Последний доход удалён.")
-    else:
-        await update.effective_message.reply_text("Ошибка при удалении дохода.")
+    # Корректируем баланс
+    amount = row_amount(removed_row)
+    currency = removed_row.get('currency', 'EUR')
+    inc_balance_for_income(_uid(update), -amount, currency)  # Вычитаем доход
+    
+    # Корректируем счёт
+    account = removed_row.get('payment_method')
+    if account:
+        adjust_accounts(_uid(update), [(account, -amount)])
+    
+    await update.effective_message.reply_text("↩️ Последний доход удалён.")
 
 async def income_router(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Роутер для меню доходов"""
@@ -181,31 +153,27 @@ async def income_router(update: Update, context: ContextTypes.DEFAULT_TYPE):
 # Статистика доходов
 async def income_stats(update: Update, context: ContextTypes.DEFAULT_TYPE, start_date: date, end_date: date):
     """Показать статистику доходов за период"""
-    rows = read_rows(_uid(update))
-    selected = []
-    
-    for r in rows:
+    # Один потоковый проход: валюта отчёта — валюта первого дохода периода
+    base_cur, total_sum = None, 0.0
+    by_cat, by_source = defaultdict(float), defaultdict(float)
+    for r in iter_rows(_uid(update), start=start_date, end=end_date):
         try:
-            d = datetime.strptime(r.get("date",""), "%Y-%m-%d").date()
-            amount = float(r.get("total", 0) or 0)
-            # Учитываем только доходы (положительные суммы)
-            if amount > 0 and start_date <= d < end_date:
-                selected.append(r)
+            amount = row_amount(r)
         except Exception:
             continue
-
-    if not selected:
-        return await update.effective_message.reply_text("За выбранный период доходов не найдено.")
-
-    base_cur = selected[0].get("currency") or "EUR"
-    total_sum = sum(float(r.get("total",0) or 0) for r in selected if (r.get("currency") or "") == base_cur)
-
-    by_cat, by_source = defaultdict(float), defaultdict(float)
-    for r in selected:
+        # Учитываем только доходы (положительные суммы)
+        if amount <= 0:
+            continue
+        if base_cur is None:
+            base_cur = r.get("currency") or "EUR"
         if (r.get("currency") or "") != base_cur:
             continue
-        by_cat[r.get("category") or "—"] += float(r.get("total",0) or 0)
-        by_source[r.get("merchant") or "—"] += float(r.get("total",0) or 0)
+        total_sum += amount
+        by_cat[r.get("category") or "—"] += amount
+        by_source[r.get("merchant") or "—"] += amount
+
+    if base_cur is None:
+        return await update.effective_message.reply_text("За выбранный период доходов не найдено.")
 
     top_cat = sorted(by_cat.items(), key=lambda x: x[1], reverse=True)[:10]
     top_source = sorted(by_source.items(), key=lambda x: x[1], reverse=True)[:5]
@@ -310,14 +278,12 @@ async def edit_income_set_source(update: Update, context: ContextTypes.DEFAULT_T
     
     try:
         # Находим последний доход
-        rows = read_rows(_uid(update))
-        income_rows = [r for r in rows if float(r.get('total', 0) or 0) > 0]
-        if not income_rows:
+        if not find_last_row(_uid(update), _is_income_row):
             await update.effective_message.reply_text("Записей о доходах нет.")
             return INCOME_EDIT_MENU
         
         # Обновляем источник
-        _, new_row = update_last_row(_uid(update), merchant=txt)
+        _, new_row = _update_last_income(_uid(update), merchant=txt)
         await update.effective_message.reply_text(f"✅ Источник обновлён: {new_row.get('merchant','')}", reply_markup=edit_income_menu_kb())
         return INCOME_EDIT_MENU
     except Exception as e:
@@ -353,7 +319,7 @@ async def edit_income_set_amount_currency(update: Update, context: ContextTypes.
     
     try:
         amount = float(context.user_data.get("edit_income_amount_tmp"))
-        old_row, new_row = update_last_row(_uid(update), total=amount, currency=cur)
+        old_row, new_row = _update_last_income(_uid(update), total=amount, currency=cur)
         
         # Пересчитываем балансы для дохода
         rebalance_on_edit(_uid(update), old_row, new_row)
@@ -391,7 +357,7 @@ async def edit_income_set_category(update: Update, context: ContextTypes.DEFAULT
         selected_category = txt
     
     try:
-        _, new_row = update_last_row(_uid(update), category=selected_category)
+        _, new_row = _update_last_income(_uid(update), category=selected_category)
         await update.effective_message.reply_text(f"✅ Категория: {new_row.get('category','')}", reply_markup=edit_income_menu_kb())
         return INCOME_EDIT_MENU
     except Exception as e:
@@ -411,7 +377,7 @@ async def edit_income_set_payment(update: Update, context: ContextTypes.DEFAULT_
         return INCOME_EDIT_PAYMENT
     
     try:
-        old_row, new_row = update_last_row(_uid(update), payment_method=choice)
+        old_row, new_row = _update_last_income(_uid(update), payment_method=choice)
         rebalance_accounts_on_income_edit(_uid(update), old_row, new_row)
         await update.effective_message.reply_text(f"✅ Счёт обновлён: {choice}", reply_markup=edit_income_menu_kb())
         return INCOME_EDIT_MENU
@@ -19,14 +19,16 @@ from app.keyboards import (
     expense_add_merchant_kb, expense_add_category_kb, expense_add_account_kb
 )
 from app.services.receipt_parser import parse_receipt
-from app.storage import (
-    ensure_csv, read_rows, append_row_csv, undo_last_row,
+from app.backends import (
+    ensure_csv, read_rows, iter_rows, append_row_csv, undo_last_row,
     set_balance, get_balances, dec_balance, fmt_money,
-    update_last_row, update_row_from_end, rebalance_on_edit,
-    list_accounts, add_account, set_account_amount, dec_account,
+    update_last_row, update_row_from_end, rebalance_on_edit, find_last_row,
+    list_accounts, add_account, adjust_accounts, dec_account,
     find_accounts_by_currency, format_accounts
 )
-from app.rules import apply_category_rules, load_rules, save_rules
+from app.rules import apply_category_rules
+from app.backends import load_rules, save_rules
+from app.models import row_amount
 
 from app.utils import get_user_id as _uid
 
@@ -36,19 +38,13 @@ def rebalance_accounts_on_edit(user_id: int, old_row: dict, new_row: dict):
     def _num(x):
         try: return float(x)
         except: return 0.0
-    accs = list_accounts(user_id)
     old_acc = (old_row.get("payment_method") or "").strip()
     new_acc = (new_row.get("payment_method") or "").strip()
     old_total = _num(old_row.get("total", 0))
     new_total = _num(new_row.get("total", 0))
-    # Отменить предыдущее изменение (вернуть старую сумму)
-    if old_acc and old_acc in accs:
-        cur = float(accs[old_acc]["amount"])
-        set_account_amount(user_id, old_acc, cur + old_total)
-    # Применить новое изменение (отрицательная = расход, положительная = доход)
-    if new_acc and new_acc in accs:
-        cur = float(list_accounts(user_id)[new_acc]["amount"])
-        set_account_amount(user_id, new_acc, cur - new_total)
+    # Отменить предыдущее изменение (вернуть старую сумму) и применить новое
+    # (отрицательная = расход, положительная = доход) — компенсирующими событиями
+    adjust_accounts(user_id, [(old_acc, old_total), (new_acc, -new_total)])
 
 # ──────────────────────────────────────────────────────────────────────────────
 # Базовые действия и меню «Расходы»
@@ -62,16 +58,12 @@ async def purchases_back(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def last(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Показать последний расход"""
-    rows = read_rows(_uid(update))
-    if not rows:
-        return await update.effective_message.reply_text("Пока записей нет.")
-    
-    # Ищем последний расход (отрицательная сумма)
-    expense_rows = [r for r in rows if float(r.get('total', 0) or 0) < 0]
-    if not expense_rows:
+    # Ищем последний расход (отрицательная сумма) с конца файла
+    found = find_last_row(_uid(update), lambda r: row_amount(r) < 0)
+    if not found:
         return await update.effective_message.reply_text("Записей о расходах пока нет.")
     
-    r = expense_rows[-1]
+    _, r = found
     await update.effective_message.reply_text(
         "🧾 Последний расход:\n"
         f"• Дата: {r.get('date','')}\n"
@@ -123,28 +115,21 @@ async def stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
     except Exception as e:
         return await msg.reply_text(f"❌ {e}")
 
-    rows = read_rows(_uid(update))
-    selected = []
-    for r in rows:
-        try:
-            d = datetime.strptime(r.get("date",""), "%Y-%m-%d").date()
-        except Exception:
-            continue
-        if start <= d < end:
-            selected.append(r)
-
-    if not selected:
-        return await msg.reply_text("За выбранный период ничего не найдено.")
-
-    base_cur = selected[0].get("currency") or "EUR"
-    total_sum = sum(float(r.get("total",0) or 0) for r in selected if (r.get("currency") or "") == base_cur)
-
+    # Один потоковый проход: валюта отчёта — валюта первой записи периода
+    base_cur, total_sum = None, 0.0
     by_cat, by_merch = defaultdict(float), defaultdict(float)
-    for r in selected:
+    for r in iter_rows(_uid(update), start=start, end=end):
+        if base_cur is None:
+            base_cur = r.get("currency") or "EUR"
         if (r.get("currency") or "") != base_cur:
             continue
-        by_cat[r.get("category") or "—"] += float(r.get("total",0) or 0)
-        by_merch[r.get("merchant") or "—"] += float(r.get("total",0) or 0)
+        amount = row_amount(r)
+        total_sum += amount
+        by_cat[r.get("category") or "—"] += amount
+        by_merch[r.get("merchant") or "—"] += amount
+
+    if base_cur is None:
+        return await msg.reply_text("За выбранный период ничего не найдено.")
 
     top_cat = sorted(by_cat.items(), key=lambda x: x[1], reverse=True)[:10]
     top_merch = sorted(by_merch.items(), key=lambda x: x[1], reverse=True)[:5]
@@ -9,7 +9,7 @@ from app.constants import (
 from app.keyboards import (
     balance_menu_kb, accounts_kb, transfer_amount_kb, transfer_confirm_kb
 )
-from app.storage import (
+from app.backends import (
     list_accounts, transfer_between_accounts, format_accounts
 )
 from app.utils import get_user_id as _uid
@@ -6,9 +6,8 @@ from app.constants import CHOOSE_ACC_FOR_RECEIPT, CHOOSE_CATEGORY_FOR_RECEIPT
 from app.keyboards import accounts_kb, categories_kb
 from app.speech import ffmpeg_convert_to_mp3, transcribe_openai, parse_spoken_purchase
 from app.rules import apply_category_rules
-from app.storage import (
-    append_row_csv, dec_balance, dec_account, inc_account,
-    list_accounts, fmt_money
+from app.backends import (
+    append_rows_csv, list_accounts, fmt_money
 )
 
 from app.utils import get_user_id as _uid
@@ -65,23 +64,16 @@ async def on_voice(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 # Сохраняем транскрипцию в поле notes
                 data_with_notes = data.copy()
                 data_with_notes['notes'] = f"Голосовая запись: {text}"
-                append_row_csv(_uid(update), data_with_notes, source=f"voice:{voice.file_id}")
+                # Запись, баланс и счёт — одной операцией
+                append_rows_csv(_uid(update), [data_with_notes], source=f"voice:{voice.file_id}")
                 
                 total = float(data.get("total", 0) or 0)
                 currency = data.get("currency", "")
                 
                 # Определяем, доход это или расход
                 if total > 0:
-                    # Доход - увеличиваем баланс и счёт
-                    from app.handlers.income import inc_balance_for_income
-                    inc_balance_for_income(_uid(update), total, currency, data.get("category"))
-                    inc_account(_uid(update), acc_name, total)
                     amount_display = f"💰 Доход: {total:.2f} {currency}"
                 else:
-                    # Расход - уменьшаем баланс и счёт
-                    dec_balance(_uid(update), amount=abs(total), currency=currency,
-                                category=(data.get("category") or None))
-                    dec_account(_uid(update), acc_name, abs(total))
                     amount_display = f"💸 Расход: {abs(total):.2f} {currency}"
                 
                 await msg.reply_text(
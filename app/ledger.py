@@ -0,0 +1,237 @@
+# app/ledger.py
+"""
+Общие правила записей и проводки — чистые функции без файлов и базы
+
+Используются файловым хранилищем (app.storage) и хранилищами app/backends,
+поэтому одни и те же данные дают одинаковый результат на любом из них:
+поля записи (CSV_FIELDS, make_row, apply_changes), события счетов и
+балансов set/add/del (apply_event, diff_events, balance_deltas), проводка
+записей (row_deltas, post_rows, rebalance_pairs), перевод между счетами
+(transfer_rows) и текст списка счетов (render_accounts).
+"""
+from datetime import datetime
+from collections import OrderedDict
+
+CSV_FIELDS = ["date", "merchant", "total", "currency", "category", "payment_method", "source", "notes", "id"]
+
+
+def make_row(data: dict, source: str = "") -> OrderedDict:
+    row = OrderedDict()
+    row["date"] = (data.get("date") or datetime.now().strftime("%Y-%m-%d"))
+    row["merchant"] = data.get("merchant") or ""
+    row["total"] = float(data.get("total") or 0)
+    row["currency"] = (data.get("currency") or "").upper()
+    row["category"] = data.get("category") or ""
+    row["payment_method"] = data.get("payment_method") or ""
+    row["source"] = source or ""
+    row["notes"] = data.get("notes") or ""
+    return row
+
+
+def apply_changes(row: dict, changes: dict) -> dict:
+    new = dict(row)
+    for k, v in changes.items():
+        if k == "total":
+            v = float(str(v).replace(",", "."))
+        if k == "currency":
+            v = (v or "").upper()
+        new[k] = v
+    return new
+
+
+def apply_event(data: dict, ev: dict):
+    target = data.setdefault(ev["kind"], {})
+    key = ev["key"]
+    if "field" in ev:
+        if not isinstance(target.get(key), dict):
+            return
+        target, key = target[key], ev["field"]
+    op = ev["op"]
+    if op == "del":
+        target.pop(key, None)
+    elif op == "set":
+        value = ev["value"]
+        target[key] = dict(value) if isinstance(value, dict) else value
+    elif op == "add":
+        target[key] = float(target.get(key) or 0) + float(ev["value"])
+
+
+def diff_events(kind: str, old: dict, new: dict) -> list:
+    """События set/del, превращающие old в new"""
+    events = [{"kind": kind, "op": "del", "key": key} for key in old if key not in new]
+    for key, value in new.items():
+        prev = old.get(key)
+        if key in old and prev == value:
+            continue
+        if isinstance(prev, dict) and isinstance(value, dict) and prev.keys() == value.keys():
+            events.extend({"kind": kind, "op": "set", "key": key, "field": field, "value": v}
+                          for field, v in value.items() if prev[field] != v)
+        else:
+            events.append({"kind": kind, "op": "set", "key": key, "value": value})
+    return events
+
+
+def balance_deltas(bal: dict, pairs) -> list:
+    """События "add" для пар (ключ, изменение); отсутствующие ключи пропускаются"""
+    return [{"kind": "balances", "op": "add", "key": k, "value": delta}
+            for k, delta in pairs if k in bal and delta]
+
+
+def rebalance_pairs(old_row: dict, new_row: dict) -> list:
+    """(ключ баланса, изменение) при правке записи old_row → new_row"""
+    def _num(x):
+        try:
+            return float(x)
+        except:
+            return 0.0
+    old_cur = (old_row.get("currency") or "").upper()
+    new_cur = (new_row.get("currency") or "").upper()
+    old_cat = old_row.get("category") or None
+    new_cat = new_row.get("category") or None
+    old_total = _num(old_row.get("total", 0))
+    new_total = _num(new_row.get("total", 0))
+
+    pairs = []
+    # вернуть старую сумму (компенсирующее событие)
+    if old_cur:
+        pairs += [(k, old_total) for k in (old_cur, f"{(old_cat or '')}@{old_cur}")]
+    # применить новую сумму (отрицательная = расход, положительная = доход)
+    if new_cur:
+        pairs += [(k, -new_total) for k in (new_cur, f"{(new_cat or '')}@{new_cur}")]
+    return pairs
+
+
+def row_deltas(rows, balances: bool = True) -> list:
+    """Проводка записей: (вид, ключ, изменение, создавать ли ключ) в порядке записей.
+
+    Сумма записи прибавляется к счёту из payment_method; доход создаёт или
+    увеличивает баланс валюты, расход меняет только существующие балансы
+    валюты и категория@валюта.
+    """
+    out = []
+    for r in rows:
+        total = float(r.get("total") or 0)
+        name = (r.get("payment_method") or "").strip()
+        if name:
+            out.append(("accounts", name, total, False))
+        currency = (r.get("currency") or "").upper()
+        if not balances or not currency:
+            continue
+        if total > 0:
+            out.append(("balances", currency, total, True))
+        else:
+            out += [("balances", k, total, False) for k in (currency, f"{(r.get('category') or '')}@{currency}")]
+    return out
+
+
+def post_rows(rows, acc: dict, bal: dict = None):
+    """Провести записи по счетам acc и балансам bal (словари меняются на месте)"""
+    for kind, key, delta, create in row_deltas(rows, bal is not None):
+        if kind == "accounts":
+            if key in acc:
+                acc[key]["amount"] = float(acc[key]["amount"]) + delta
+        elif create or key in bal:
+            bal[key] = float(bal.get(key, 0.0)) + delta
+
+
+def render_accounts(acc: dict) -> str:
+    if not acc:
+        return "📊 Счетов пока нет.\n\n💡 Добавьте первый счёт, чтобы начать отслеживать баланс!"
+    
+    lines = ["💼 <b>Ваши счета:</b>\n"]
+    total_amounts = {}
+    
+    for name, v in acc.items():
+        amount = float(v.get('amount', 0))
+        currency = v.get('currency', '')
+        
+        # Группируем по валютам для подсчета общего баланса
+        if currency not in total_amounts:
+            total_amounts[currency] = 0
+        total_amounts[currency] += amount
+        
+        # Красивое форматирование счета
+        if amount >= 0:
+            emoji = "💰"
+        else:
+            emoji = "💸"
+            
+        lines.append(f"{emoji} <b>{name}</b>\n   {amount:,.2f} {currency}\n")
+    
+    # Добавляем общий баланс по валютам
+    if total_amounts:
+        lines.append("━━━━━━━━━━━━━━━━━━━━")
+        lines.append("📈 <b>Общий баланс:</b>")
+        for currency, total in total_amounts.items():
+            if total >= 0:
+                emoji = "💚"
+            else:
+                emoji = "❤️"
+            lines.append(f"{emoji} {total:,.2f} {currency}")
+    
+    return "\n".join(lines)
+
+
+def transfer_rows(acc: dict, from_account: str, to_account: str, amount: float, second_amount: float = None):
+    """Проверить перевод и подготовить его записи; возвращает (записи, итог перевода)"""
+    if from_account not in acc:
+        raise ValueError(f"Счет-источник «{from_account}» не найден")
+    if to_account not in acc:
+        raise ValueError(f"Счет-получатель «{to_account}» не найден")
+    if from_account == to_account:
+        raise ValueError("Нельзя переводить на тот же счет")
+    
+    from_acc = acc[from_account]
+    to_acc = acc[to_account]
+    
+    # Проверяем достаточность средств
+    if float(from_acc["amount"]) < amount:
+        raise ValueError(f"Недостаточно средств на счете «{from_account}». Доступно: {from_acc['amount']:.2f} {from_acc['currency']}")
+    
+    # Определяем валюты
+    from_currency = from_acc["currency"]
+    to_currency = to_acc["currency"]
+    
+    # Если валюты одинаковые, используем одну сумму
+    if from_currency == to_currency:
+        transfer_amount = amount
+    else:
+        # Если валюты разные, используем вторую сумму
+        if second_amount is None:
+            raise ValueError("Для разных валют необходимо указать сумму для счета-получателя")
+        transfer_amount = second_amount
+    
+    # Записываем переводы в CSV для отображения в экспорте
+    current_date = datetime.now().strftime("%Y-%m-%d")
+    
+    # Запись списания с исходного счета
+    from_transaction = {
+        "date": current_date,
+        "merchant": f"Перевод на {to_account}",
+        "total": -amount,  # Отрицательная сумма для расхода
+        "currency": from_currency,
+        "category": "Банковские операции",
+        "payment_method": from_account,
+        "source": "transfer"
+    }
+    
+    # Запись зачисления на целевой счет
+    to_transaction = {
+        "date": current_date,
+        "merchant": f"Перевод с {from_account}",
+        "total": transfer_amount,  # Положительная сумма для дохода
+        "currency": to_currency,
+        "category": "Банковские операции",
+        "payment_method": to_account,
+        "source": "transfer"
+    }
+    
+    return [from_transaction, to_transaction], {
+        "from_account": from_account,
+        "to_account": to_account,
+        "from_amount": amount,
+        "to_amount": transfer_amount,
+        "from_currency": from_currency,
+        "to_currency": to_currency,
+        "date": current_date
+    }
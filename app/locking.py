@@ -0,0 +1,150 @@
+# app/locking.py
+"""
+Блокировки читатель/писатель для папки пользователя (data/<uid>/)
+
+Между процессами (бот, web_server, data_sync, скрипты) — fcntl.flock на
+файле <папка>/.lock: читатели берут LOCK_SH и идут параллельно, писатель
+берёт LOCK_EX. Внутри процесса одна блокировка на папку делится между
+потоками: она реентерабельна (писатель может читать и снова писать), а
+чтение можно повысить до записи — на время ожидания своё чтение
+отпускается. Без fcntl (Windows) остаётся только блокировка между потоками.
+"""
+import os
+import threading
+from contextlib import contextmanager, ExitStack
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover - Windows
+    fcntl = None
+
+LOCK_FILE = ".lock"
+
+
+class _DirLock:
+    """Реентерабельная RW-блокировка одной папки"""
+
+    def __init__(self, directory: str):
+        self.path = os.path.join(directory, LOCK_FILE)
+        self.cond = threading.Condition(threading.Lock())
+        self.readers = {}          # id потока → глубина вложенности чтения
+        self.writer = None         # id потока-писателя
+        self.writer_depth = 0
+        self.writer_reads = 0      # чтение писателя до повышения
+        self.fd = None
+        self.mode = None           # режим flock, которым сейчас владеет процесс
+
+    def _flock(self, mode):
+        if fcntl is None or mode == self.mode:
+            return
+        if self.fd is None:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        fcntl.flock(self.fd, mode)
+        self.mode = mode
+
+    def acquire(self, exclusive: bool):
+        me = threading.get_ident()
+        with self.cond:
+            if self.writer == me:
+                self.writer_depth += 1
+                return
+            if not exclusive:
+                if me in self.readers:
+                    self.readers[me] += 1
+                    return
+                while self.writer is not None:
+                    self.cond.wait()
+                if not self.readers:
+                    self._flock(fcntl.LOCK_SH if fcntl else None)
+                self.readers[me] = 1
+                return
+            reads = self.readers.pop(me, 0)
+            if reads and not self.readers:
+                self._unlock()
+                self.cond.notify_all()
+            while self.writer is not None or self.readers:
+                self.cond.wait()
+            self.writer, self.writer_depth, self.writer_reads = me, 1, reads
+            try:
+                self._flock(fcntl.LOCK_EX if fcntl else None)
+            except BaseException:
+                self.writer = None
+                self.cond.notify_all()
+                raise
+
+    def release(self):
+        me = threading.get_ident()
+        with self.cond:
+            if self.writer == me:
+                self.writer_depth -= 1
+                if self.writer_depth:
+                    return
+                self.writer = None
+                if self.writer_reads:
+                    # Возврат к чтению, с которого начиналось повышение
+                    self.readers[me] = self.writer_reads
+                    self._flock(fcntl.LOCK_SH if fcntl else None)
+                else:
+                    self._unlock()
+                self.cond.notify_all()
+                return
+            self.readers[me] -= 1
+            if not self.readers[me]:
+                del self.readers[me]
+                if not self.readers:
+                    self._unlock()
+                    self.cond.notify_all()
+
+    def _unlock(self):
+        if fcntl is not None and self.mode is not None:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+        self.mode = None
+
+
+_locks: dict = {}
+_locks_guard = threading.Lock()
+
+
+def _dir_lock(directory: str) -> _DirLock:
+    key = os.path.abspath(directory)
+    lock = _locks.get(key)
+    if lock is None:
+        with _locks_guard:
+            lock = _locks.setdefault(key, _DirLock(key))
+    return lock
+
+
+@contextmanager
+def shared(directory: str):
+    """Блокировка на чтение папки: параллельно с другими читателями"""
+    lock = _dir_lock(directory)
+    lock.acquire(False)
+    try:
+        yield
+    finally:
+        lock.release()
+
+
+@contextmanager
+def exclusive(directory: str):
+    """Блокировка на запись папки: никто другой не читает и не пишет"""
+    lock = _dir_lock(directory)
+    lock.acquire(True)
+    try:
+        yield
+    finally:
+        lock.release()
+
+
+@contextmanager
+def lock_dirs(dirs, write: bool = False):
+    """Заблокировать сразу несколько папок (для операций над всем data/).
+
+    Папки берутся в отсортированном порядке — два таких вызова не
+    заблокируют друг друга навечно.
+    """
+    with ExitStack() as stack:
+        for d in sorted(set(dirs)):
+            stack.enter_context(exclusive(d) if write else shared(d))
+        yield
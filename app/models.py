@@ -1,5 +1,7 @@
 # app/models.py
 from dataclasses import dataclass
+from sys import intern
+from collections.abc import Mapping
 from typing import List, Optional, Dict, Any
 from datetime import date
 
@@ -64,6 +66,94 @@ class Transaction:
     source: str = ""
 
 
+TRANSACTION_FIELDS = ("date", "merchant", "total", "currency", "category", "payment_method", "source", "notes", "id")
+
+
+def _parse_date(value: str) -> Optional[date]:
+    if len(value) != 10 or value[4] != "-" or value[7] != "-":
+        return None
+    try:
+        return date.fromisoformat(value)
+    except ValueError:
+        return None
+
+
+def _parse_id(value) -> Optional[int]:
+    try:
+        return int(value)
+    except (ValueError, TypeError):
+        return None
+
+
+def _parse_amount(value: str) -> Optional[float]:
+    try:
+        return float(value)
+    except (ValueError, TypeError):
+        return None
+
+
+class TransactionRecord(Mapping):
+    """Запись finance.csv в том виде, в каком её отдаёт хранилище.
+
+    Поля — исходные строки из CSV (как у csv.DictReader), кроме id — это
+    int (или None для строк без id). Плюс разобранные один раз при чтении
+    day (date или None) и amount (float или None).
+    Ведёт себя как неизменяемый словарь: row["total"], row.get(...), dict(row).
+    """
+    __slots__ = TRANSACTION_FIELDS + ("day", "amount")
+
+    def __init__(self, row: Mapping):
+        get = row.get
+        self.date = get("date") or ""
+        self.merchant = get("merchant") or ""
+        self.total = get("total") or ""
+        # Короткие повторяющиеся значения храним в одном экземпляре
+        self.currency = intern(get("currency") or "")
+        self.category = intern(get("category") or "")
+        self.payment_method = intern(get("payment_method") or "")
+        self.source = intern(get("source") or "")
+        self.notes = get("notes") or ""
+        self.id = _parse_id(get("id"))
+        self.day = _parse_date(self.date)
+        self.amount = _parse_amount(self.total)
+
+    def __getitem__(self, key):
+        if key not in TRANSACTION_FIELDS:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def get(self, key, default=None):
+        if key not in TRANSACTION_FIELDS:
+            return default
+        return getattr(self, key)
+
+    def __contains__(self, key):
+        return key in TRANSACTION_FIELDS
+
+    def __iter__(self):
+        return iter(TRANSACTION_FIELDS)
+
+    def __len__(self):
+        return len(TRANSACTION_FIELDS)
+
+    def __repr__(self):
+        return f"TransactionRecord({dict(self)!r})"
+
+
+def row_amount(row: Mapping) -> float:
+    """Сумма записи: готовая у TransactionRecord, иначе разбирается из строки"""
+    if isinstance(row, TransactionRecord) and row.amount is not None:
+        return row.amount
+    return float(row.get("total", 0) or 0)
+
+
+def row_date(row: Mapping) -> Optional[date]:
+    """Дата записи или None, если она не в формате YYYY-MM-DD"""
+    if isinstance(row, TransactionRecord):
+        return row.day
+    return _parse_date(row.get("date") or "")
+
+
 @dataclass
 class VoiceData:
     """Данные голосового сообщения"""
@@ -3,14 +3,16 @@ import os
 import json
 from typing import List, Dict, Any, Optional
 
+from app import locking
+from app.storage import user_dir, _write_json
+
 # ──────────────────────────────────────────────────────────────────────────────
 # Путь к rules.json для конкретного пользователя
 # ──────────────────────────────────────────────────────────────────────────────
 def _rules_path(user_id: int) -> str:
-    # файлы лежат в data/<user_id>/rules.json
-    base = os.path.join("data", str(user_id))
-    os.makedirs(base, exist_ok=True)
-    return os.path.join(base, "rules.json")
+    # файлы лежат в папке пользователя: data/<user_id>/rules.json
+    # (или data/ab/cd/<user_id>/rules.json при DATA_SHARDING=hashed)
+    return os.path.join(user_dir(user_id), "rules.json")
 
 # ──────────────────────────────────────────────────────────────────────────────
 # Загрузка / сохранение правил
@@ -22,7 +24,7 @@ def load_rules(user_id: int) -> List[Dict[str, Any]]:
     p = _rules_path(user_id)
     if os.path.exists(p):
         try:
-            with open(p, "r", encoding="utf-8") as f:
+            with locking.shared(os.path.dirname(p)), open(p, "r", encoding="utf-8") as f:
                 data = json.load(f)
                 return data if isinstance(data, list) else []
         except Exception:
@@ -38,10 +40,13 @@ def load_rules(user_id: int) -> List[Dict[str, Any]]:
     return []
 
 def save_rules(user_id: int, rules: List[Dict[str, Any]]) -> None:
-    """Сохранить правила пользователя в data/<uid>/rules.json."""
+    """Сохранить правила пользователя в data/<uid>/rules.json.
+
+    Атомарно (временный файл + rename): при сбое посреди записи остаётся
+    прежний файл, а не пустой или обрезанный."""
     p = _rules_path(user_id)
-    with open(p, "w", encoding="utf-8") as f:
-        json.dump(rules or [], f, ensure_ascii=False, indent=2)
+    with locking.exclusive(os.path.dirname(p)):
+        _write_json(p, rules or [])
 
 # ──────────────────────────────────────────────────────────────────────────────
 # Сопоставление транзакции правилам
@@ -1,14 +1,104 @@
 # app/services/analytics.py
 from typing import List, Dict, Any, Optional
 from datetime import date, timedelta
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
+from array import array
+import os
+import threading
 import statistics
 
-from app.storage import read_rows
+from app import storage
+from app.backends import rows_since
 from app.models import StatsData, StatsPeriod
 from app.utils import get_user_id, format_money
 
 
+# Сколько пользователей держать в кэше колонок
+COLUMNS_CACHE_USERS = int(os.getenv("COLUMNS_CACHE_USERS", "64"))
+
+
+class TransactionColumns:
+    """Колоночное представление транзакций пользователя (из TransactionRecord).
+
+    Дата хранится как порядковый номер дня, отдельно — номер месяца и день
+    месяца, сумма — как double. Категория, продавец и валюта — коды в
+    словарях значений.
+    Строки с неразбираемой датой или суммой учитываются только в raw_count.
+    """
+
+    CATEGORICAL = ("category", "merchant", "currency")
+
+    def __init__(self):
+        self.raw_count = 0
+        self.dates = array("l")
+        self.months = array("l")
+        self.days = array("b")
+        self.totals = array("d")
+        self.codes = {name: array("l") for name in self.CATEGORICAL}
+        self.labels = {name: [] for name in self.CATEGORICAL}
+        self._lookup = {name: {} for name in self.CATEGORICAL}
+
+    def __len__(self) -> int:
+        return len(self.totals)
+
+    def extend(self, rows):
+        for row in rows:
+            self.raw_count += 1
+            d, amount = row.day, row.amount
+            if d is None or amount is None:
+                continue
+            self.dates.append(d.toordinal())
+            self.months.append(d.year * 12 + d.month - 1)
+            self.days.append(d.day)
+            self.totals.append(amount)
+            for name in self.CATEGORICAL:
+                value = getattr(row, name)
+                code = self._lookup[name].get(value)
+                if code is None:
+                    code = self._lookup[name][value] = len(self.labels[name])
+                    self.labels[name].append(value)
+                self.codes[name].append(code)
+
+    def select(self, start: date, end: date) -> List[int]:
+        """Индексы строк с start <= date <= end"""
+        lo, hi = start.toordinal(), end.toordinal()
+        return [i for i, d in enumerate(self.dates) if lo <= d <= hi]
+
+    def group_by(self, keys, idx=None):
+        """Суммы и количества по кодам keys; idx — подмножество строк"""
+        sums, counts = defaultdict(float), defaultdict(int)
+        totals = self.totals
+        if idx is None:
+            for k, t in zip(keys, totals):
+                sums[k] += t
+                counts[k] += 1
+        else:
+            for i in idx:
+                k = keys[i]
+                sums[k] += totals[i]
+                counts[k] += 1
+        return sums, counts
+
+
+_columns_cache: "OrderedDict[str, tuple]" = OrderedDict()
+_columns_lock = threading.Lock()
+
+
+def get_columns(user_id: int) -> TransactionColumns:
+    """Колонки пользователя из кэша; после append дочитываются только новые строки"""
+    key = os.path.join(storage.DATA_DIR, str(user_id))
+    with _columns_lock:
+        marks, cols = _columns_cache.pop(key, (None, None))
+        marks, rows, full = rows_since(user_id, marks)
+        if full or cols is None:
+            cols = TransactionColumns()
+        cols.extend(rows)
+        _columns_cache[key] = (marks, cols)
+        while len(_columns_cache) > COLUMNS_CACHE_USERS:
+            _columns_cache.popitem(last=False)
+        return cols
+
+
 class AnalyticsService:
     """Сервис для аналитики финансовых данных"""
     
@@ -17,35 +107,34 @@ class AnalyticsService:
     
     def get_monthly_trends(self, months: int = 6) -> Dict[str, Any]:
         """Получить тренды за последние месяцы"""
-        rows = read_rows(self.user_id)
-        if not rows:
+        cols = get_columns(self.user_id)
+        if not cols.raw_count:
             return {"error": "Нет данных"}
         
-        # Группируем по месяцам
-        monthly_data = defaultdict(lambda: {"total": 0, "count": 0, "categories": defaultdict(float)})
-        
-        for row in rows:
-            try:
-                row_date = date.fromisoformat(row.get("date", ""))
-                month_key = f"{row_date.year}-{row_date.month:02d}"
-                
-                amount = float(row.get("total", 0))
-                category = row.get("category", "Без категории")
-                
-                monthly_data[month_key]["total"] += amount
-                monthly_data[month_key]["count"] += 1
-                monthly_data[month_key]["categories"][category] += amount
-                
-            except (ValueError, TypeError):
-                continue
-        
-        # Сортируем по месяцам
-        sorted_months = sorted(monthly_data.keys())
-        recent_months = sorted_months[-months:] if len(sorted_months) > months else sorted_months
-        
+        # Группируем по месяцам, затем по паре (месяц, категория)
+        month_sums, month_counts = cols.group_by(cols.months)
+        recent = sorted(month_sums)[-months:]
+        wanted = set(recent)
+        idx = [i for i, m in enumerate(cols.months) if m in wanted]
+        labels = cols.labels["category"]
+        n_categories = len(labels)
+        pair_sums, _ = cols.group_by(
+            array("l", (m * n_categories + c for m, c in zip(cols.months, cols.codes["category"]))), idx
+        )
+        
+        monthly_data = {}
+        for m in recent:
+            monthly_data[f"{m // 12}-{m % 12 + 1:02d}"] = {
+                "total": month_sums[m], "count": month_counts[m], "categories": {}
+            }
+        for pair, amount in pair_sums.items():
+            m, c = divmod(pair, n_categories)
+            monthly_data[f"{m // 12}-{m % 12 + 1:02d}"]["categories"][labels[c]] = amount
+        
+        recent_months = list(monthly_data)
         return {
             "months": recent_months,
-            "data": {month: monthly_data[month] for month in recent_months},
+            "data": monthly_data,
             "trend": self._calculate_trend([monthly_data[month]["total"] for month in recent_months])
         }
     
@@ -54,33 +143,23 @@ class AnalyticsService:
         end_date = date.today()
         start_date = end_date - timedelta(days=period_days)
         
-        rows = read_rows(self.user_id)
-        filtered_rows = self._filter_by_period(rows, start_date, end_date)
-        
-        if not filtered_rows:
+        cols = get_columns(self.user_id)
+        idx = cols.select(start_date, end_date)
+        if not idx:
             return {"error": "Нет данных за период"}
         
-        category_stats = defaultdict(lambda: {"total": 0, "count": 0, "avg": 0})
-        
-        for row in filtered_rows:
-            category = row.get("category", "Без категории")
-            amount = float(row.get("total", 0))
-            
-            category_stats[category]["total"] += amount
-            category_stats[category]["count"] += 1
-        
-        # Вычисляем средние значения
-        for category, stats in category_stats.items():
-            stats["avg"] = stats["total"] / stats["count"] if stats["count"] > 0 else 0
-        
-        # Сортируем по общей сумме
-        sorted_categories = sorted(category_stats.items(), key=lambda x: x[1]["total"], reverse=True)
+        sums, counts = cols.group_by(cols.codes["category"], idx)
+        labels = cols.labels["category"]
+        category_stats = {
+            labels[c]: {"total": sums[c], "count": counts[c], "avg": sums[c] / counts[c]}
+            for c in sorted(sums, key=sums.get, reverse=True)
+        }
         
         return {
             "period": f"{start_date} - {end_date}",
-            "categories": dict(sorted_categories),
-            "total_spent": sum(stats["total"] for stats in category_stats.values()),
-            "total_transactions": sum(stats["count"] for stats in category_stats.values())
+            "categories": category_stats,
+            "total_spent": sum(sums.values()),
+            "total_transactions": len(idx)
         }
     
     def get_merchant_analysis(self, period_days: int = 30) -> Dict[str, Any]:
@@ -88,58 +167,42 @@ class AnalyticsService:
         end_date = date.today()
         start_date = end_date - timedelta(days=period_days)
         
-        rows = read_rows(self.user_id)
-        filtered_rows = self._filter_by_period(rows, start_date, end_date)
-        
-        if not filtered_rows:
+        cols = get_columns(self.user_id)
+        idx = cols.select(start_date, end_date)
+        if not idx:
             return {"error": "Нет данных за период"}
         
-        merchant_stats = defaultdict(lambda: {"total": 0, "count": 0, "last_visit": None})
-        
-        for row in filtered_rows:
-            merchant = row.get("merchant", "Неизвестно")
-            amount = float(row.get("total", 0))
-            row_date = date.fromisoformat(row.get("date", ""))
-            
-            merchant_stats[merchant]["total"] += amount
-            merchant_stats[merchant]["count"] += 1
-            
-            if (merchant_stats[merchant]["last_visit"] is None or 
-                row_date > merchant_stats[merchant]["last_visit"]):
-                merchant_stats[merchant]["last_visit"] = row_date
+        codes = cols.codes["merchant"]
+        sums, counts = cols.group_by(codes, idx)
+        last_visit = {}
+        for i in idx:
+            c = codes[i]
+            if cols.dates[i] > last_visit.get(c, 0):
+                last_visit[c] = cols.dates[i]
         
         # Сортируем по общей сумме
-        sorted_merchants = sorted(merchant_stats.items(), key=lambda x: x[1]["total"], reverse=True)
+        labels = cols.labels["merchant"]
+        top = sorted(sums, key=sums.get, reverse=True)[:10]  # Топ 10
         
         return {
             "period": f"{start_date} - {end_date}",
-            "merchants": dict(sorted_merchants[:10]),  # Топ 10
-            "total_merchants": len(merchant_stats)
+            "merchants": {
+                labels[c]: {"total": sums[c], "count": counts[c], "last_visit": date.fromordinal(last_visit[c])}
+                for c in top
+            },
+            "total_merchants": len(sums)
         }
     
     def get_spending_patterns(self) -> Dict[str, Any]:
         """Анализ паттернов трат"""
-        rows = read_rows(self.user_id)
-        if not rows:
+        cols = get_columns(self.user_id)
+        if not cols.raw_count:
             return {"error": "Нет данных"}
         
-        # Анализ по дням недели
-        weekday_spending = defaultdict(float)
+        # Анализ по дням недели (0 = понедельник, 6 = воскресенье)
+        weekday_spending, _ = cols.group_by(array("b", ((d - 1) % 7 for d in cols.dates)))
         # Анализ по времени месяца
-        monthly_spending = defaultdict(float)
-        
-        for row in rows:
-            try:
-                row_date = date.fromisoformat(row.get("date", ""))
-                amount = float(row.get("total", 0))
-                
-                # День недели (0 = понедельник, 6 = воскресенье)
-                weekday_spending[row_date.weekday()] += amount
-                # День месяца
-                monthly_spending[row_date.day] += amount
-                
-            except (ValueError, TypeError):
-                continue
+        monthly_spending, _ = cols.group_by(cols.days)
         
         weekday_names = ["Понедельник", "Вторник", "Среда", "Четверг", "Пятница", "Суббота", "Воскресенье"]
         
@@ -151,18 +214,6 @@ class AnalyticsService:
             "most_expensive_day": weekday_names[max(weekday_spending.keys(), key=lambda k: weekday_spending[k])] if weekday_spending else None
         }
     
-    def _filter_by_period(self, rows: List[Dict], start_date: date, end_date: date) -> List[Dict]:
-        """Фильтрация записей по периоду"""
-        filtered = []
-        for row in rows:
-            try:
-                row_date = date.fromisoformat(row.get("date", ""))
-                if start_date <= row_date <= end_date:
-                    filtered.append(row)
-            except (ValueError, TypeError):
-                continue
-        return filtered
-    
     def _calculate_trend(self, values: List[float]) -> str:
         """Вычисление тренда (рост/падение/стабильно)"""
         if len(values) < 2:
@@ -0,0 +1,42 @@
+# app/services/balance_retention.py
+"""
+Плановое прореживание истории балансов в базе данных через JobQueue бота
+"""
+import os
+
+from app.database.async_service import async_unit_of_work
+from app.logger import get_logger
+
+logger = get_logger(__name__)
+
+# Период запуска (часы) и задержка первого запуска после старта (секунды)
+BALANCE_RETENTION_INTERVAL_HOURS = float(os.getenv("BALANCE_RETENTION_INTERVAL_HOURS", "24"))
+BALANCE_RETENTION_FIRST_DELAY = float(os.getenv("BALANCE_RETENTION_FIRST_DELAY", "900"))
+
+
+async def balance_retention_job(context=None):
+    """Проредить снимки балансов всех пользователей (daily → weekly → monthly)"""
+    try:
+        async with async_unit_of_work() as db_service:
+            removed = await db_service.downsample_balances()
+    except Exception as e:
+        logger.error(f"Ошибка прореживания истории балансов: {e}")
+        return 0
+    if removed:
+        logger.info(f"История балансов: удалено {removed} старых снимков")
+    return removed
+
+
+def schedule_balance_retention(application):
+    """Поставить прореживание в JobQueue, если бот работает с базой (задан DATABASE_URL)"""
+    if not os.getenv("DATABASE_URL"):
+        return None
+    if application.job_queue is None:
+        logger.warning("JobQueue недоступна — прореживание истории балансов отключено")
+        return None
+    return application.job_queue.run_repeating(
+        balance_retention_job,
+        interval=BALANCE_RETENTION_INTERVAL_HOURS * 3600,
+        first=BALANCE_RETENTION_FIRST_DELAY,
+        name="balance_retention",
+    )
@@ -0,0 +1,45 @@
+# app/services/compaction.py
+"""
+Плановое сжатие CSV пользователей (vacuum) через JobQueue бота
+"""
+import os
+
+from app import storage
+from app.logger import get_logger
+
+logger = get_logger(__name__)
+
+# Период запуска (часы) и задержка первого запуска после старта (секунды)
+COMPACTION_INTERVAL_HOURS = float(os.getenv("COMPACTION_INTERVAL_HOURS", "24"))
+COMPACTION_FIRST_DELAY = float(os.getenv("COMPACTION_FIRST_DELAY", "600"))
+
+
+async def compaction_job(context=None):
+    """Сжать файлы всех пользователей по очереди (закрытые годы — в архив)"""
+    total = 0
+    for user_id in storage.list_user_ids():
+        try:
+            archived = storage.archive_closed_years(user_id)
+            if archived:
+                logger.info(f"Архив: пользователь {user_id}, перенесено {archived} записей")
+            saved = await storage.compact_user_async(user_id)
+        except Exception as e:
+            logger.error(f"Ошибка сжатия данных пользователя {user_id}: {e}")
+            continue
+        if saved:
+            logger.info(f"Сжатие: пользователь {user_id}, освобождено {saved} байт")
+        total += saved
+    return total
+
+
+def schedule_compaction(application):
+    """Поставить сжатие в JobQueue приложения (нужен python-telegram-bot[job-queue])"""
+    if application.job_queue is None:
+        logger.warning("JobQueue недоступна — плановое сжатие CSV отключено")
+        return None
+    return application.job_queue.run_repeating(
+        compaction_job,
+        interval=COMPACTION_INTERVAL_HOURS * 3600,
+        first=COMPACTION_FIRST_DELAY,
+        name="csv_compaction",
+    )
@@ -322,7 +322,7 @@ def auto_create_accounts_from_csv(user_id: int, csv_data: Dict, overwrite_existi
     Returns:
         Dict с результатами создания счетов
     """
-    from app.storage import add_account, list_accounts
+    from app.backends import list_accounts, apply_batch
     
     try:
         existing_accounts = list_accounts(user_id)
@@ -333,18 +333,19 @@ def auto_create_accounts_from_csv(user_id: int, csv_data: Dict, overwrite_existi
         skipped_count = 0
         errors = []
         
+        # Все изменения копятся в одном словаре и сохраняются одной записью
+        accounts = dict(existing_accounts)
         for account in accounts_for_import:
-            account_name = account['name']
+            account_name = (account['name'] or '').strip()
             account_amount = account['amount']
-            account_currency = account['currency']
+            account_currency = (account['currency'] or '').upper()
             
             try:
                 # Проверяем, существует ли счет
                 if account_name in existing_accounts:
                     if overwrite_existing:
                         # Обновляем существующий счет
-                        from app.storage import set_account_amount
-                        set_account_amount(user_id, account_name, account_amount)
+                        accounts[account_name]["amount"] = float(account_amount)
                         updated_count += 1
                         logger.info(f"Updated account {account_name} for user {user_id}")
                     else:
@@ -352,7 +353,11 @@ def auto_create_accounts_from_csv(user_id: int, csv_data: Dict, overwrite_existi
                         logger.info(f"Skipped existing account {account_name} for user {user_id}")
                 else:
                     # Создаем новый счет
-                    add_account(user_id, account_name, account_currency, account_amount)
+                    if not account_name or not account_currency:
+                        raise ValueError("name/currency пустые")
+                    if account_name in accounts:
+                        raise ValueError("Счёт с таким именем уже существует")
+                    accounts[account_name] = {"currency": account_currency, "amount": float(account_amount)}
                     created_count += 1
                     logger.info(f"Created account {account_name} for user {user_id}")
                     
@@ -361,6 +366,9 @@ def auto_create_accounts_from_csv(user_id: int, csv_data: Dict, overwrite_existi
                 errors.append(error_msg)
                 logger.error(error_msg)
         
+        if created_count or updated_count:
+            apply_batch(user_id, accounts=accounts)
+        
         return {
             'success': True,
             'created': created_count,
@@ -390,7 +398,7 @@ def export_balances_to_csv(user_id: int, output_path: str = None) -> Dict:
     Returns:
         Dict с результатами экспорта
     """
-    from app.storage import list_accounts
+    from app.backends import list_accounts
     from datetime import datetime
     import csv
     
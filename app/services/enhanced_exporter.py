@@ -9,7 +9,8 @@ from typing import Dict, List, Optional, Tuple
 from collections import defaultdict
 
 from app.logger import get_logger
-from app.storage import read_rows, list_accounts, get_balances
+from app.backends import read_rows, list_accounts, get_balances
+from app.models import row_amount, row_date
 
 logger = get_logger(__name__)
 
@@ -19,10 +20,14 @@ class EnhancedExporter:
     
     def __init__(self, user_id: int):
         self.user_id = user_id
-        self.transactions = read_rows(user_id)
         self.accounts = list_accounts(user_id)
         self.balances = get_balances(user_id)
     
+    @property
+    def transactions(self) -> List[Dict]:
+        """Все транзакции пользователя (читаются по требованию)"""
+        return read_rows(self.user_id)
+    
     def export_monthly_data(self, year: int, month: int, output_dir: str = None) -> Dict:
         """
         Экспортирует данные за конкретный месяц
@@ -159,13 +164,11 @@ class EnhancedExporter:
         """Фильтрует транзакции по периоду"""
         filtered = []
         
-        for transaction in self.transactions:
-            try:
-                transaction_date = datetime.strptime(transaction.get('date', ''), '%Y-%m-%d').date()
-                if start_date <= transaction_date < end_date:
-                    filtered.append(transaction)
-            except (ValueError, TypeError):
-                continue
+        # Хранилище читает только партиции, пересекающиеся с периодом
+        for transaction in read_rows(self.user_id, start=start_date, end=end_date):
+            transaction_date = row_date(transaction)
+            if transaction_date and start_date <= transaction_date < end_date:
+                filtered.append(transaction)
         
         return filtered
     
@@ -219,7 +222,7 @@ class EnhancedExporter:
         transfer_candidates = defaultdict(list)
         
         for i, transaction in enumerate(transactions):
-            amount = float(transaction.get('total', 0) or 0)
+            amount = row_amount(transaction)
             if amount != 0:
                 # Используем ключ: дата + валюта + абсолютная сумма
                 key = (transaction.get('date', ''), transaction.get('currency', ''), abs(amount))
@@ -229,14 +232,14 @@ class EnhancedExporter:
         for key, candidate_transactions in transfer_candidates.items():
             if len(candidate_transactions) >= 2:
                 # Разделяем на отрицательные и положительные
-                negative_transactions = [(idx, t) for idx, t in candidate_transactions if float(t.get('total', 0) or 0) < 0]
-                positive_transactions = [(idx, t) for idx, t in candidate_transactions if float(t.get('total', 0) or 0) > 0]
+                negative_transactions = [(idx, t) for idx, t in candidate_transactions if row_amount(t) < 0]
+                positive_transactions = [(idx, t) for idx, t in candidate_transactions if row_amount(t) > 0]
                 
                 # Ищем пары: одна отрицательная, одна положительная
                 for neg_idx, neg_tx in negative_transactions:
                     for pos_idx, pos_tx in positive_transactions:
-                        neg_amount = abs(float(neg_tx.get('total', 0) or 0))
-                        pos_amount = float(pos_tx.get('total', 0) or 0)
+                        neg_amount = abs(row_amount(neg_tx))
+                        pos_amount = row_amount(pos_tx)
                         
                         # Проверяем, что суммы совпадают (с небольшой погрешностью)
                         if abs(neg_amount - pos_amount) < 0.01:
@@ -264,7 +267,7 @@ class EnhancedExporter:
                 if i in transfer_ids:
                     continue  # Пропускаем переводы
                 
-                amount = float(transaction.get('total', 0) or 0)
+                amount = row_amount(transaction)
                 source = transaction.get('source', '').lower()
                 category = transaction.get('category', '').lower()
                 merchant = transaction.get('merchant', '').lower()
@@ -328,7 +331,7 @@ class EnhancedExporter:
                 if i in transfer_ids:
                     continue  # Пропускаем переводы
                 
-                amount = float(transaction.get('total', 0) or 0)
+                amount = row_amount(transaction)
                 source = transaction.get('source', '').lower()
                 category = transaction.get('category', '').lower()
                 merchant = transaction.get('merchant', '').lower()
@@ -370,7 +373,7 @@ class EnhancedExporter:
                         writer.writerow({
                             'date': expense.get('date', ''),
                             'merchant': expense.get('merchant', ''),
-                            'amount': abs(float(expense.get('total', 0) or 0)),  # Положительное значение
+                            'amount': abs(row_amount(expense)),  # Положительное значение
                             'currency': expense.get('currency', ''),
                             'category': expense.get('category', ''),
                             'payment_method': expense.get('payment_method', ''),
@@ -431,7 +434,7 @@ class EnhancedExporter:
             # Группируем переводы по ключу (дата + валюта + сумма)
             for i, transaction in enumerate(transactions):
                 if i in transfer_ids:
-                    amount = float(transaction.get('total', 0) or 0)
+                    amount = row_amount(transaction)
                     key = (transaction.get('date', ''), transaction.get('currency', ''), abs(amount))
                     transfer_candidates[key].append((i, transaction))
             
@@ -439,14 +442,14 @@ class EnhancedExporter:
             for key, candidate_transactions in transfer_candidates.items():
                 if len(candidate_transactions) >= 2:
                     # Разделяем на отрицательные и положительные
-                    negative_transactions = [(idx, t) for idx, t in candidate_transactions if float(t.get('total', 0) or 0) < 0]
-                    positive_transactions = [(idx, t) for idx, t in candidate_transactions if float(t.get('total', 0) or 0) > 0]
+                    negative_transactions = [(idx, t) for idx, t in candidate_transactions if row_amount(t) < 0]
+                    positive_transactions = [(idx, t) for idx, t in candidate_transactions if row_amount(t) > 0]
                     
                     # Создаем записи о переводах
                     for neg_idx, neg_tx in negative_transactions:
                         for pos_idx, pos_tx in positive_transactions:
-                            neg_amount = abs(float(neg_tx.get('total', 0) or 0))
-                            pos_amount = float(pos_tx.get('total', 0) or 0)
+                            neg_amount = abs(row_amount(neg_tx))
+                            pos_amount = row_amount(pos_tx)
                             
                             # Проверяем, что суммы совпадают (с небольшой погрешностью)
                             if abs(neg_amount - pos_amount) < 0.01:
@@ -502,7 +505,7 @@ class EnhancedExporter:
                 
                 if transactions:
                     for transaction in transactions:
-                        amount = float(transaction.get('total', 0) or 0)
+                        amount = row_amount(transaction)
                         transaction_type = 'income' if amount > 0 else 'expense' if amount < 0 else 'zero'
                         
                         writer.writerow({
@@ -8,11 +8,15 @@ from datetime import datetime, date
 from typing import List, Dict, Any, Optional
 import gspread
 from google.oauth2.service_account import Credentials
-from app.database.service import get_database_service
+from app.database.service import unit_of_work
+from app.storage_new import iter_transactions
 from app.logger import get_logger
 
 logger = get_logger(__name__)
 
+# Строк транзакций на одну пачку чтения из базы и один вызов append_rows
+SHEET_BATCH = 1000
+
 class GoogleSheetsSync:
     """Сервис синхронизации с Google Sheets"""
     
@@ -75,20 +79,21 @@ class GoogleSheetsSync:
             return False
         
         try:
-            db_service = get_database_service()
-            spreadsheet = self.client.open_by_key(spreadsheet_id)
-            
-            # Получаем данные пользователя
-            user = db_service.get_user(user_id)
+            # Данные читаются короткими единицами работы, а запросы к Sheets API
+            # идут вне их: транзакция базы не держится, пока ждём сеть
+            with unit_of_work() as db_service:
+                user = db_service.get_user(user_id)
             if not user:
                 logger.error(f"Пользователь {user_id} не найден")
                 return False
             
-            # Создаем листы
-            self._create_transactions_sheet(spreadsheet, user_id, db_service)
-            self._create_accounts_sheet(spreadsheet, user_id, db_service)
-            self._create_rules_sheet(spreadsheet, user_id, db_service)
-            self._create_summary_sheet(spreadsheet, user_id, db_service)
+            spreadsheet = self.client.open_by_key(spreadsheet_id)
+            
+            # Создаем листы (данные — по id пользователя в базе)
+            self._create_transactions_sheet(spreadsheet, user.id)
+            self._create_accounts_sheet(spreadsheet, user.id)
+            self._create_rules_sheet(spreadsheet, user.id)
+            self._create_summary_sheet(spreadsheet, user.id)
             
             logger.info(f"Данные пользователя {user_id} синхронизированы")
             return True
@@ -97,7 +102,7 @@ class GoogleSheetsSync:
             logger.error(f"Ошибка синхронизации данных пользователя {user_id}: {e}")
             return False
     
-    def _create_transactions_sheet(self, spreadsheet, user_id: int, db_service):
+    def _create_transactions_sheet(self, spreadsheet, user_id: int):
         """Создать лист с транзакциями"""
         try:
             # Удаляем старый лист если есть
@@ -117,23 +122,27 @@ class GoogleSheetsSync:
             ]
             worksheet.append_row(headers)
             
-            # Получаем транзакции
-            transactions = db_service.get_transactions(user_id, limit=500)
-            
-            for t in transactions:
-                row = [
-                    t.id,
-                    t.date.strftime('%Y-%m-%d %H:%M:%S'),
-                    t.transaction_type,
-                    t.total,
-                    t.currency,
-                    t.category or '',
-                    t.merchant or '',
-                    t.payment_method or '',
-                    t.source or '',
-                    t.notes or ''
-                ]
-                worksheet.append_row(row)
+            # Все транзакции потоком (пачка — своя единица работы); в таблицу —
+            # пачками, один запрос к API на пачку
+            batch = []
+            for t in iter_transactions(user_id, chunk=SHEET_BATCH):
+                batch.append([
+                    t['id'],
+                    t['date'].strftime('%Y-%m-%d %H:%M:%S'),
+                    t['transaction_type'],
+                    t['total'],
+                    t['currency'],
+                    t['category'] or '',
+                    t['merchant'] or '',
+                    t['payment_method'] or '',
+                    t['source'] or '',
+                    t['notes'] or ''
+                ])
+                if len(batch) >= SHEET_BATCH:
+                    worksheet.append_rows(batch)
+                    batch = []
+            if batch:
+                worksheet.append_rows(batch)
             
             # Форматируем заголовки
             worksheet.format('A1:J1', {
@@ -144,7 +153,7 @@ class GoogleSheetsSync:
         except Exception as e:
             logger.error(f"Ошибка создания листа транзакций: {e}")
     
-    def _create_accounts_sheet(self, spreadsheet, user_id: int, db_service):
+    def _create_accounts_sheet(self, spreadsheet, user_id: int):
         """Создать лист со счетами"""
         try:
             # Удаляем старый лист если есть
@@ -162,7 +171,8 @@ class GoogleSheetsSync:
             worksheet.append_row(headers)
             
             # Получаем счета
-            accounts = db_service.get_accounts(user_id)
+            with unit_of_work() as db_service:
+                accounts = db_service.get_accounts(user_id)
             
             for a in accounts:
                 row = [
@@ -183,7 +193,7 @@ class GoogleSheetsSync:
         except Exception as e:
             logger.error(f"Ошибка создания листа счетов: {e}")
     
-    def _create_rules_sheet(self, spreadsheet, user_id: int, db_service):
+    def _create_rules_sheet(self, spreadsheet, user_id: int):
         """Создать лист с правилами"""
         try:
             # Удаляем старый лист если есть
@@ -201,7 +211,8 @@ class GoogleSheetsSync:
             worksheet.append_row(headers)
             
             # Получаем правила
-            rules = db_service.get_rules(user_id)
+            with unit_of_work() as db_service:
+                rules = db_service.get_rules(user_id)
             
             for r in rules:
                 conditions = json.loads(r.match_conditions)
@@ -222,7 +233,7 @@ class GoogleSheetsSync:
         except Exception as e:
             logger.error(f"Ошибка создания листа правил: {e}")
     
-    def _create_summary_sheet(self, spreadsheet, user_id: int, db_service):
+    def _create_summary_sheet(self, spreadsheet, user_id: int):
         """Создать сводный лист"""
         try:
             # Удаляем старый лист если есть
@@ -232,15 +243,20 @@ class GoogleSheetsSync:
             except:
                 pass
             
+            # Статистика — одним чтением из базы
+            with unit_of_work() as db_service:
+                stats = db_service.get_user_stats(user_id)
+                category_stats = db_service.get_category_stats(user_id)
+                monthly = db_service.get_monthly_summary(user_id)
+            
             # Создаем новый лист
-            worksheet = spreadsheet.add_worksheet(title="Сводка", rows=50, cols=3)
+            worksheet = spreadsheet.add_worksheet(title="Сводка", rows=50, cols=8)
             
             # Заголовок
             worksheet.append_row(["СВОДКА ДАННЫХ"])
             worksheet.append_row([])
             
             # Статистика
-            stats = db_service.get_user_stats(user_id)
             worksheet.append_row(["Показатель", "Значение"])
             worksheet.append_row(["Всего счетов", stats['accounts_count']])
             worksheet.append_row(["Всего транзакций", stats['transactions_count']])
@@ -248,13 +264,20 @@ class GoogleSheetsSync:
             worksheet.append_row([])
             
             # Статистика по категориям
-            category_stats = db_service.get_category_stats(user_id)
             if category_stats:
                 worksheet.append_row(["СТАТИСТИКА ПО КАТЕГОРИЯМ"])
                 worksheet.append_row(["Категория", "Сумма"])
                 
                 for category, amount in category_stats.items():
                     worksheet.append_row([category, amount])
+                worksheet.append_row([])
+            
+            # Итоги по месяцам — готовые строки monthly_summary
+            if monthly:
+                worksheet.append_row(["ИТОГИ ПО МЕСЯЦАМ"])
+                worksheet.append_rows(
+                    [["Месяц", "Тип", "Категория", "Валюта", "Сумма", "Количество", "Мин.", "Макс."]]
+                    + [list(row) for row in monthly])
             
             # Форматируем заголовок
             worksheet.format('A1', {
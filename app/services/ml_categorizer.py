@@ -8,7 +8,7 @@ import os
 
 from app.logger import get_logger
 from app.models import ReceiptData
-from app.storage import read_rows
+from app.backends import read_rows
 
 logger = get_logger(__name__)
 
@@ -8,7 +8,8 @@ import statistics
 
 from app.logger import get_logger
 from app.models import ReceiptData, ReceiptItem
-from app.rules import load_rules, apply_category_rules
+from app.rules import apply_category_rules
+from app.backends import load_rules
 from app.categories import get_category_keywords_dict, get_category_by_name
 
 logger = get_logger(__name__)
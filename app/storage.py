@@ -1,29 +1,142 @@
 # storage.py — multi-user файловое хранилище
 import os
+import io
+import re
 import csv
+import gzip
+import lzma
+import copy
 import json
-from datetime import datetime
-from collections import OrderedDict
+import time
+import hashlib
+import struct
+import atexit
+import asyncio
+import functools
+import threading
+import itertools
+from datetime import datetime, date
+from collections import OrderedDict, Counter, deque
 
 DATA_DIR = os.getenv("DATA_DIR", "data")
+# Раскладка транзакций для новых пользователей: "single" — один finance.csv,
+# "monthly" — помесячные партиции data/<uid>/tx/YYYY-MM.csv с manifest.json
+STORAGE_LAYOUT = os.getenv("STORAGE_LAYOUT", "single")
+# Раскладка папок пользователей: "flat" — data/<uid>/, "hashed" — data/ab/cd/<uid>/,
+# где ab и cd — первые два байта md5(uid) в hex (не больше 256 записей на уровень)
+DATA_SHARDING = os.getenv("DATA_SHARDING", "flat")
 
 # ──────────────────────────────────────────────────────────────────────────────
 # ВСПОМОГАТЕЛЬНОЕ
 # ──────────────────────────────────────────────────────────────────────────────
+_SHARD_RE = re.compile(r"^[0-9a-f]{2}$")
+# (DATA_DIR, DATA_SHARDING, uid) → папка пользователя
+_user_dirs: dict = {}
+
+def _flat_dir(user_id: int) -> str:
+    return os.path.join(DATA_DIR, str(user_id))
+
+def _sharded_dir(user_id: int) -> str:
+    h = hashlib.md5(str(user_id).encode()).hexdigest()
+    return os.path.join(DATA_DIR, h[:2], h[2:4], str(user_id))
+
 def _user_dir(user_id: int) -> str:
-    d = os.path.join(DATA_DIR, str(user_id))
+    key = (DATA_DIR, DATA_SHARDING, int(user_id))
+    d = _user_dirs.get(key)
+    if d is None:
+        d = _flat_dir(user_id)
+        if DATA_SHARDING == "hashed":
+            sharded = _sharded_dir(user_id)
+            # Ещё не перенесённый пользователь остаётся на старом месте
+            if os.path.isdir(sharded) or not os.path.isdir(d):
+                d = sharded
+        _user_dirs[key] = d
     os.makedirs(d, exist_ok=True)
     return d
 
+def user_dir(user_id: int) -> str:
+    """Папка данных пользователя (с учётом DATA_SHARDING)"""
+    return _user_dir(user_id)
+
+def iter_user_dirs(data_dir: str = None):
+    """(uid, папка) всех пользователей — в плоской и шардированной раскладке.
+
+    Имена из двух hex-символов считаются уровнем шардов (id Telegram длиннее).
+    """
+    data_dir = data_dir or DATA_DIR
+    if not os.path.isdir(data_dir):
+        return
+    for a in sorted(os.listdir(data_dir)):
+        top = os.path.join(data_dir, a)
+        if not os.path.isdir(top):
+            continue
+        if a.isdigit() and not _SHARD_RE.match(a):
+            yield int(a), top
+        elif _SHARD_RE.match(a):
+            for b in sorted(os.listdir(top)):
+                mid = os.path.join(top, b)
+                if not _SHARD_RE.match(b) or not os.path.isdir(mid):
+                    continue
+                for uid in sorted(os.listdir(mid)):
+                    if uid.isdigit() and os.path.isdir(os.path.join(mid, uid)):
+                        yield int(uid), os.path.join(mid, uid)
+
+def relocate_user_dir(user_id: int, sharding: str = None):
+    """Перенести папку пользователя в раскладку sharding (по умолчанию DATA_SHARDING).
+
+    Запускать при остановленном боте. Возвращает новый путь или None, если
+    переносить нечего (уже на месте или папки нет).
+    """
+    hashed = (sharding or DATA_SHARDING) == "hashed"
+    source, target = _flat_dir(user_id), _sharded_dir(user_id)
+    if not hashed:
+        source, target = target, source
+    if not os.path.isdir(source) or os.path.exists(target):
+        return None
+    flush_all()
+    with locking.exclusive(source):
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        os.rename(source, target)
+    # Забываем всё, что держало старые пути
+    for key in [k for k in _user_dirs if k[0] == DATA_DIR and k[2] == int(user_id)]:
+        del _user_dirs[key]
+    with _states_lock:
+        st = _states.pop(os.path.join(DATA_DIR, str(user_id)), None)
+    if st is not None and st.flush_handle is not None:
+        st.flush_handle.cancel()
+    clear_rows_cache()
+    return target
+
 def _csv_path(user_id: int) -> str:
     return os.path.join(_user_dir(user_id), "finance.csv")
 
+def _tx_dir(user_id: int) -> str:
+    return os.path.join(_user_dir(user_id), "tx")
+
+def _manifest_path(user_id: int) -> str:
+    return os.path.join(_tx_dir(user_id), "manifest.json")
+
+def _partition_path(user_id: int, key: str) -> str:
+    return os.path.join(_tx_dir(user_id), f"{key}.csv")
+
+def _idx_path(csv_path: str) -> str:
+    return os.path.splitext(csv_path)[0] + ".idx"
+
 def _balances_path(user_id: int) -> str:
     return os.path.join(_user_dir(user_id), "balances.json")
 
 def _accounts_path(user_id: int) -> str:
     return os.path.join(_user_dir(user_id), "accounts.json")
 
+def _journal_path(user_id: int) -> str:
+    return os.path.join(_user_dir(user_id), "journal.json")
+
+def _ledger_path(user_id: int) -> str:
+    return os.path.join(_user_dir(user_id), "ledger.jsonl")
+
+def _ledger_archive_dir(user_id: int) -> str:
+    return os.path.join(_user_dir(user_id), "ledger")
+
 def _read_json(path: str, default):
     if not os.path.exists(path):
         return default
@@ -33,113 +146,1716 @@ def _read_json(path: str, default):
     except:
         return default
 
-def _write_json(path: str, data):
-    with open(path, "w", encoding="utf-8") as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
+def _write_json(path: str, data, fsync: bool = True):
+    """Атомарная запись: временный файл + rename, читатель не увидит половину JSON"""
+    tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False, indent=2)
+            if fsync:
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(tmp, path)
+    except BaseException:
+        # недописанный временный файл не оставляем
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+# Блокировки папки пользователя между процессами (app/locking.py): публичные
+# функции чтения берут её на чтение, функции записи — на запись. Счета и
+# балансы (раздел СОСТОЯНИЕ) блокируются на запись внутри — даже чтение
+# состояния может подтянуть чужие правки и дописать журнал.
+def _reading(user_id: int):
+    return locking.shared(_user_dir(user_id))
+
+def _writing(user_id: int):
+    return locking.exclusive(_user_dir(user_id))
+
+def _locked(exclusive: bool):
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(user_id, *args, **kwargs):
+            with (_writing if exclusive else _reading)(user_id):
+                return func(user_id, *args, **kwargs)
+        return wrapper
+    return decorator
+
+_reads = _locked(False)
+_writes = _locked(True)
 
 from app.utils import format_money as fmt_money
+from app.models import TransactionRecord
+from app import locking
+from app.ledger import (
+    CSV_FIELDS, make_row, apply_changes, apply_event, diff_events, balance_deltas,
+    rebalance_pairs, row_deltas, post_rows, render_accounts, transfer_rows,
+)
 
 # ──────────────────────────────────────────────────────────────────────────────
 # CSV
 # ──────────────────────────────────────────────────────────────────────────────
-CSV_FIELDS = ["date", "merchant", "total", "currency", "category", "payment_method", "source", "notes"]
+def is_partitioned(user_id: int) -> bool:
+    """Хранятся ли транзакции пользователя помесячными партициями"""
+    if os.path.exists(_manifest_path(user_id)):
+        return True
+    if os.path.exists(_csv_path(user_id)):
+        return False
+    return STORAGE_LAYOUT == "monthly"
 
+@_writes
 def ensure_csv(user_id: int):
-    path = _csv_path(user_id)
+    if is_partitioned(user_id):
+        if not os.path.exists(_manifest_path(user_id)):
+            _save_manifest(user_id, _new_manifest())
+        return
+    _ensure_file(_csv_path(user_id))
+
+def _ensure_file(path: str):
     if not os.path.exists(path):
         with open(path, "w", newline="", encoding="utf-8") as f:
             w = csv.DictWriter(f, fieldnames=CSV_FIELDS)
             w.writeheader()
+        _write_index(path, [], os.path.getsize(path), 0)
 
-def read_rows(user_id: int):
-    path = _csv_path(user_id)
-    if not os.path.exists(path):
-        return []
+def _data_files(user_id: int, start: date = None, end: date = None) -> list[str]:
+    """CSV-файлы пользователя в хронологическом порядке.
+
+    Для помесячной раскладки при заданном периоде возвращаются только
+    партиции, пересекающиеся с [start, end).
+    """
+    if not is_partitioned(user_id):
+        path = _csv_path(user_id)
+        return [path] if os.path.exists(path) else []
+    keys = sorted(_load_manifest(user_id)["partitions"])
+    if start or end:
+        keys = [k for k in keys if _partition_overlaps(k, start, end)]
+    return [_partition_path(user_id, k) for k in keys]
+
+def _row_in_period(row: TransactionRecord, start: date = None, end: date = None) -> bool:
+    d = row.day
+    if d is None:
+        return False
+    return (start is None or d >= start) and (end is None or d < end)
+
+def _sources(user_id: int, start: date = None, end: date = None) -> list:
+    """Источники записей: архивные месяцы (сегмент, месяц), затем горячие CSV"""
+    return _archive_parts(user_id, start, end) + _data_files(user_id, start, end)
+
+def _iter_source(src):
+    if isinstance(src, tuple):
+        return iter(_read_segment_month(*src))
+    return _iter_file(src)
+
+def _read_source(src) -> list:
+    if isinstance(src, tuple):
+        return _read_segment_month(*src)
+    return _read_file(src)
+
+@_reads
+def read_rows(user_id: int, start: date = None, end: date = None):
+    """Записи пользователя (TransactionRecord); если задан период — только те, где start <= date < end.
+
+    Архивные годы читаются, только если период в них заходит.
+    """
+    if start or end:
+        return list(iter_rows(user_id, start=start, end=end))
     rows = []
+    for src in _sources(user_id):
+        rows.extend(_read_source(src))
+    return rows
+
+def iter_rows(user_id: int, start: date = None, end: date = None,
+              currency: str = None, category: str = None):
+    """Потоковый обход записей с фильтрами: start <= date < end, валюта, категория.
+
+    Строки разбираются лениво и не накапливаются в памяти. При помесячной
+    раскладке читаются только партиции, пересекающиеся с периодом, и обход
+    заканчивается на последней из них. В одном finance.csv записи не
+    упорядочены по дате (бывают внесённые задним числом), поэтому файл
+    просматривается до конца. Уже закэшированные файлы берутся из кэша.
+    Пока обход не закончен, папка пользователя заблокирована на чтение.
+    """
+    currency = currency.upper() if currency else None
+    with _reading(user_id):
+        for src in _sources(user_id, start, end):
+            for row in _iter_source(src):
+                if currency and row.currency.upper() != currency:
+                    continue
+                if category is not None and row.category != category:
+                    continue
+                if (start or end) and not _row_in_period(row, start, end):
+                    continue
+                yield row
+
+def _iter_file(path: str):
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return
+    cached = _rows_cache_get(path, st)
+    if cached is not None:
+        # Срез по текущей длине: append может дописать строки в кэш во время обхода
+        yield from itertools.islice(cached, len(cached))
+        return
+    with open(path, "r", newline="", encoding="utf-8") as f:
+        for r in csv.DictReader(f):
+            yield TransactionRecord(r)
+
+def _read_file(path: str) -> list:
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return []
+    cached = _rows_cache_get(path, st)
+    if cached is not None:
+        return list(cached)
     with open(path, "r", newline="", encoding="utf-8") as f:
         r = csv.DictReader(f)
-        for row in r:
-            rows.append(row)
-    return rows
+        rows = [TransactionRecord(row) for row in r]
+        fieldnames = r.fieldnames
+    _rows_cache_put(path, st, fieldnames, rows)
+    return list(rows)
 
+@_reads
+def rows_since(user_id: int, marks: dict = None):
+    """Записи, добавленные после снимка marks — для инкрементальных кэшей.
+
+    Возвращает (новый снимок, строки, full). Если с момента снимка файлы
+    только дописывались, строки — лишь новые записи и full=False. Если
+    снимка нет или записи правились/удалялись — все записи и full=True.
+    """
+    marks = marks or {}
+    files = _data_files(user_id)
+    segments = _archived_segments(user_id)
+    full = not marks or bool(set(marks) - set(files) - set(segments))
+    new_marks, appended = {}, []
+    for path in segments:
+        # Сегменты не дописываются: любое изменение — полное перечитывание
+        st = os.stat(path)
+        new_marks[path] = (st.st_size, st.st_mtime_ns, 0, 0)
+        full = full or marks.get(path) != new_marks[path]
+    for path in files:
+        st = os.stat(path)
+        count = _tail_offsets(path, 0)[0]
+        mark = (st.st_size, st.st_mtime_ns, count, _rows_generation[path])
+        new_marks[path] = mark
+        prev = marks.get(path)
+        if full or prev == mark:
+            continue
+        if prev is None:
+            appended.extend(_read_file(path))
+            continue
+        added = count - prev[2]
+        if prev[3] == mark[3] and added > 0 and _tail_offsets(path, added)[1][0] == prev[0]:
+            appended.extend(TransactionRecord(r) for r in _read_tail(path, added)[3])
+        else:
+            full = True
+    if full:
+        return new_marks, read_rows(user_id), True
+    return new_marks, appended, False
+
+@_writes
 def append_row_csv(user_id: int, data: dict, source: str = ""):
     ensure_csv(user_id)
-    row = OrderedDict()
-    row["date"] = (data.get("date") or datetime.now().strftime("%Y-%m-%d"))
-    row["merchant"] = data.get("merchant") or ""
-    row["total"] = float(data.get("total") or 0)
-    row["currency"] = (data.get("currency") or "").upper()
-    row["category"] = data.get("category") or ""
-    row["payment_method"] = data.get("payment_method") or ""
-    row["source"] = source or ""
-    row["notes"] = data.get("notes") or ""
-    with open(_csv_path(user_id), "a", newline="", encoding="utf-8") as f:
-        w = csv.DictWriter(f, fieldnames=CSV_FIELDS)
-        w.writerow(row)
+    row = make_row(data, source)
+    if is_partitioned(user_id):
+        _append_partitioned(user_id, [row])
+    else:
+        _append_to_file(_csv_path(user_id), [row])
 
-def undo_last_row(user_id: int):
-    rows = read_rows(user_id)
+@_writes
+def append_rows_csv(user_id: int, rows, source: str = "", update_balances: bool = True):
+    """Добавить несколько записей и провести их по счетам и балансам за один шаг.
+
+    Все строки пишутся одним DictWriter в один открытый файл (для помесячной
+    раскладки — по одному append на партицию), счета и балансы сохраняются
+    один раз, всё вместе фиксируется через apply_batch.
+    Проводка та же, что у одиночных операций: сумма записи прибавляется к
+    счёту из payment_method (если такой счёт есть); доход (total > 0)
+    увеличивает баланс валюты, расход уменьшает существующие балансы валюты
+    и категория@валюта. update_balances=False — только счета (переводы).
+    Возвращает число добавленных записей.
+    """
+    rows = list(rows)
     if not rows:
+        return 0
+    acc = list_accounts(user_id)
+    bal = _load_balances(user_id) if update_balances else None
+    post_rows(rows, acc, bal)
+    apply_batch(user_id, rows, accounts=acc, source=source, balances=bal)
+    return len(rows)
+
+def _encode_rows(fieldnames, rows, pos: int):
+    """Сериализовать строки CSV; возвращает (байты, смещения строк, конечная позиция)"""
+    line = io.StringIO(newline="")
+    w = csv.DictWriter(line, fieldnames=fieldnames)
+    chunks, offsets = [], []
+    for r in rows:
+        line.seek(0)
+        line.truncate()
+        w.writerow(r)
+        chunk = line.getvalue().encode("utf-8")
+        offsets.append(pos)
+        chunks.append(chunk)
+        pos += len(chunk)
+    return b"".join(chunks), offsets, pos
+
+def _append_to_file(path: str, rows):
+    """Дописать строки; строкам без id выдаются следующие id из заголовка индекса"""
+    _ensure_index(path)
+    last_id = _read_index_header(path)[1]
+    ids = []
+    for r in rows:
+        row_id = _parse_id(r.get("id"))
+        if row_id is None:
+            last_id += 1
+            row_id = last_id
+        r["id"] = row_id
+        last_id = max(last_id, row_id)
+        ids.append(row_id)
+    before = os.stat(path)
+    with open(path, "ab") as f:
+        start = f.seek(0, os.SEEK_END)
+        data, offsets, _ = _encode_rows(CSV_FIELDS, rows, start)
+        f.write(data)
+    after = os.stat(path)
+    _index_append(path, start, zip(offsets, ids), after.st_size, last_id)
+    _rows_cache_extend(path, before, after, rows)
+
+@_writes
+def undo_last_row(user_id: int):
+    """Удалить последнюю запись — усечение файла по индексу смещений"""
+    if is_partitioned(user_id):
+        try:
+            _delete_partitioned(user_id, 1)
+        except ValueError:
+            return False
+        return True
+    path = _csv_path(user_id)
+    if not os.path.exists(path):
         return False
-    rows = rows[:-1]
-    ensure_csv(user_id)
-    with open(_csv_path(user_id), "w", newline="", encoding="utf-8") as f:
-        w = csv.DictWriter(f, fieldnames=CSV_FIELDS)
-        w.writeheader()
-        for r in rows:
-            w.writerow(r)
+    count, offsets = _tail_offsets(path, 1)
+    if not offsets:
+        return False
+    with open(path, "r+b") as f:
+        f.truncate(offsets[0])
+    _index_truncate(path, count - 1, offsets[0])
+    _rows_cache_invalidate(path)
     return True
 
 def _rewrite_rows(user_id: int, rows):
-    ensure_csv(user_id)
-    with open(_csv_path(user_id), "w", newline="", encoding="utf-8") as f:
+    if is_partitioned(user_id):
+        for key in _load_manifest(user_id)["partitions"]:
+            _remove_file(_partition_path(user_id, key))
+        _save_manifest(user_id, _new_manifest())
+        _append_partitioned(user_id, rows)
+        return
+    path = _csv_path(user_id)
+    with open(path, "w", newline="", encoding="utf-8") as f:
         w = csv.DictWriter(f, fieldnames=CSV_FIELDS)
         w.writeheader()
         for r in rows:
             w.writerow(r)
+    _rebuild_index(path)
+    _rows_cache_invalidate(path)
 
+def _rows_count(user_id: int) -> int:
+    if is_partitioned(user_id):
+        return sum(_load_manifest(user_id)["partitions"].values())
+    path = _csv_path(user_id)
+    if not os.path.exists(path):
+        return 0
+    return _tail_offsets(path, 0)[0]
+
+@_writes
 def update_last_row(user_id: int, **changes):
-    rows = read_rows(user_id)
-    if not rows:
+    if not _rows_count(user_id):
         raise ValueError("Нет записей")
-    old = dict(rows[-1])
-    new = dict(old)
-    for k, v in changes.items():
-        if k == "total":
-            v = float(str(v).replace(",", "."))
-        if k == "currency":
-            v = (v or "").upper()
-        new[k] = v
-    rows[-1] = new
-    _rewrite_rows(user_id, rows)
-    return old, new
+    return update_row_from_end(user_id, 1, **changes)
 
+@_writes
 def update_row_from_end(user_id: int, n: int, **changes):
-    rows = read_rows(user_id)
-    if n <= 0 or n > len(rows):
+    """Изменить n-ю с конца запись; перезаписывается только хвост файла"""
+    if n <= 0:
+        raise ValueError("Неверный индекс")
+    if is_partitioned(user_id):
+        return _update_partitioned(user_id, n, changes)
+    return _update_from_end(_csv_path(user_id), n, changes)
+
+@_writes
+def delete_row_from_end(user_id: int, n: int):
+    """Удалить n-ю с конца запись; возвращает удалённую строку"""
+    if n <= 0:
+        raise ValueError("Неверный индекс")
+    if is_partitioned(user_id):
+        return _delete_partitioned(user_id, n)
+    return _delete_from_end(_csv_path(user_id), n)
+
+def _update_from_end(path: str, n: int, changes: dict):
+    if not os.path.exists(path):
+        raise ValueError("Неверный индекс")
+    keep, start, fieldnames, rows = _read_tail(path, n)
+    if len(rows) < n:
+        raise ValueError("Неверный индекс")
+    old = dict(rows[0])
+    new = apply_changes(old, changes)
+    rows[0] = new
+    _write_tail(path, keep, start, fieldnames, rows)
+    return old, new
+
+def _delete_from_end(path: str, n: int):
+    if not os.path.exists(path):
+        raise ValueError("Неверный индекс")
+    keep, start, fieldnames, rows = _read_tail(path, n)
+    if len(rows) < n:
+        raise ValueError("Неверный индекс")
+    removed = rows.pop(0)
+    _write_tail(path, keep, start, fieldnames, rows)
+    return removed
+
+@_writes
+def update_row_by_id(user_id: int, row_id: int, **changes):
+    """Изменить запись по id; возвращает (старая, новая).
+
+    Если новая строка не длиннее старой, она пишется на место старой
+    (разница добивается пробелами в поле id) — стоимость не зависит от
+    размера файла. Иначе перезаписывается хвост файла начиная с этой записи.
+    """
+    changes.pop("id", None)
+    path, key, pos, start, end = _locate_id(user_id, row_id)
+    fieldnames = _read_header(path)
+    with open(path, "rb") as f:
+        f.seek(start)
+        raw = f.read(end - start)
+    old = next(csv.DictReader(io.StringIO(raw.decode("utf-8"), newline=""), fieldnames=fieldnames))
+    old["id"] = row_id
+    new = apply_changes(old, changes)
+    if key is not None and _partition_key(new.get("date")) != key:
+        _move_partitioned(user_id, path, key, pos, new)
+        return old, new
+    data = _encode_rows(fieldnames, [new], 0)[0]
+    if len(data) > len(raw):
+        keep, tail_start, _, rows = _read_tail(path, _tail_offsets(path, 0)[0] - pos)
+        rows[0] = new
+        _write_tail(path, keep, tail_start, fieldnames, rows)
+        return old, new
+    padded = dict(new, id=f"{row_id}{' ' * (len(raw) - len(data))}")
+    data = _encode_rows(fieldnames, [padded], 0)[0]
+    before = os.stat(path)
+    with open(path, "r+b") as f:
+        f.seek(start)
+        f.write(data)
+    _rows_cache_replace(path, before, os.stat(path), pos, new)
+    return old, new
+
+@_writes
+def delete_row_by_id(user_id: int, row_id: int):
+    """Удалить запись по id; перезаписывается хвост файла после неё. Возвращает удалённую строку"""
+    path, key, pos, _, _ = _locate_id(user_id, row_id)
+    keep, start, fieldnames, rows = _read_tail(path, _tail_offsets(path, 0)[0] - pos)
+    removed = rows.pop(0)
+    removed["id"] = row_id
+    _write_tail(path, keep, start, fieldnames, rows)
+    if key is not None:
+        m = _load_manifest(user_id)
+        _forget_partition_row(user_id, m, key, len(rows) + 1)
+        _save_manifest(user_id, m)
+    return removed
+
+def _locate_id(user_id: int, row_id: int):
+    """(файл, месяц партиции или None, номер строки, начало, конец) для id"""
+    if is_partitioned(user_id):
+        # Свежие месяцы проверяются первыми — правят обычно недавние записи
+        for key in sorted(_load_manifest(user_id)["partitions"], reverse=True):
+            path = _partition_path(user_id, key)
+            found = _find_id(path, row_id) if os.path.exists(path) else None
+            if found:
+                return (path, key) + found
+    else:
+        path = _csv_path(user_id)
+        found = _find_id(path, row_id) if os.path.exists(path) else None
+        if found:
+            return (path, None) + found
+    raise ValueError("Запись не найдена")
+
+@_reads
+def find_last_row(user_id: int, predicate):
+    """Найти последнюю запись, для которой predicate(row) истинно.
+
+    Записи читаются с конца, поэтому стоимость зависит от расстояния до
+    найденной записи, а не от длины истории.
+    Возвращает (n, row), где n — позиция с конца (1 = последняя), либо None.
+    """
+    for n, row in _iter_from_end(user_id):
+        try:
+            if predicate(row):
+                return n, row
+        except (ValueError, TypeError):
+            continue
+    return None
+
+def _iter_from_end(user_id: int, window: int = 32):
+    """(n, row) от последней записи к первой; хвост читается окнами растущего размера"""
+    if is_partitioned(user_id):
+        yield from _iter_partitioned_from_end(user_id, window)
+        return
+    path = _csv_path(user_id)
+    if not os.path.exists(path):
+        return
+    seen = 0
+    while True:
+        before, _, _, rows = _read_tail(path, window)
+        for i in range(len(rows) - 1 - seen, -1, -1):
+            yield len(rows) - i, TransactionRecord(rows[i])
+        if before == 0:
+            return
+        seen = len(rows)
+        window *= 2
+
+def _remove_file(path: str):
+    for p in (path, _idx_path(path)):
+        if os.path.exists(p):
+            os.remove(p)
+    _rows_cache_invalidate(path)
+
+# ──────────────────────────────────────────────────────────────────────────────
+# ПОМЕСЯЧНЫЕ ПАРТИЦИИ (data/<uid>/tx/YYYY-MM.csv + manifest.json)
+# manifest: {"partitions": {месяц: число строк}, "tail": [месяцы последних
+# добавленных записей в порядке добавления]}. По "tail" восстанавливается
+# глобальный порядок для undo/правки последних записей; более старые записи
+# считаются упорядоченными по месяцам.
+# ──────────────────────────────────────────────────────────────────────────────
+UNDATED_PARTITION = "undated"
+PARTITION_TAIL_LIMIT = 256
+_MONTH_RE = re.compile(r"^(\d{4})-(\d{2})")
+
+def _partition_key(date_str) -> str:
+    m = _MONTH_RE.match(date_str or "")
+    return f"{m.group(1)}-{m.group(2)}" if m else UNDATED_PARTITION
+
+def _partition_overlaps(key: str, start: date = None, end: date = None) -> bool:
+    if key == UNDATED_PARTITION:
+        return False
+    y, m = map(int, key.split("-"))
+    part_start = date(y, m, 1)
+    part_end = date(y + 1, 1, 1) if m == 12 else date(y, m + 1, 1)
+    return (start is None or part_end > start) and (end is None or part_start < end)
+
+def _new_manifest() -> dict:
+    return {"layout": "monthly", "partitions": {}, "tail": [], "last_id": 0}
+
+def _load_manifest(user_id: int) -> dict:
+    m = _read_json(_manifest_path(user_id), None)
+    if not isinstance(m, dict):
+        return _new_manifest()
+    m.setdefault("partitions", {})
+    m.setdefault("tail", [])
+    if "last_id" not in m:
+        # Партиции без id: выдаём id по порядку месяцев и запоминаем счётчик
+        m["last_id"] = 0
+        _save_manifest(user_id, m)
+        for key in sorted(m["partitions"]):
+            _rebuild_index(_partition_path(user_id, key))
+        m = _read_json(_manifest_path(user_id), m)
+    return m
+
+def _save_manifest(user_id: int, m: dict, fsync: bool = True):
+    os.makedirs(_tx_dir(user_id), exist_ok=True)
+    _write_json(_manifest_path(user_id), m, fsync)
+
+def _append_partitioned(user_id: int, rows, fsync: bool = True):
+    groups = OrderedDict()
+    for r in rows:
+        groups.setdefault(_partition_key(r.get("date")), []).append(r)
+    for key in groups:
+        path = _partition_path(user_id, key)
+        _ensure_file(path)
+        _ensure_index(path)
+    # id выдаются из общего счётчика пользователя в manifest
+    m = _load_manifest(user_id)
+    for r in rows:
+        row_id = _parse_id(r.get("id"))
+        if row_id is None:
+            m["last_id"] += 1
+            row_id = m["last_id"]
+        r["id"] = row_id
+        m["last_id"] = max(m["last_id"], row_id)
+    for key, part in groups.items():
+        path = _partition_path(user_id, key)
+        _append_to_file(path, part)
+        m["partitions"][key] = m["partitions"].get(key, 0) + len(part)
+    m["tail"] = (m["tail"] + [_partition_key(r.get("date")) for r in rows])[-PARTITION_TAIL_LIMIT:]
+    _save_manifest(user_id, m, fsync)
+
+def _locate_from_end(m: dict, n: int, in_tail: Counter = None):
+    """(месяц, позиция с конца внутри партиции) для n-й с конца записи"""
+    tail = m["tail"]
+    if 0 < n <= len(tail):
+        key = tail[-n]
+        return key, tail[len(tail) - n:].count(key)
+    if in_tail is None:
+        in_tail = Counter(tail)
+    rest = n - len(tail)
+    for key in sorted(m["partitions"], reverse=True):
+        older = m["partitions"][key] - in_tail[key]
+        if rest <= older:
+            return key, in_tail[key] + rest
+        rest -= older
+    raise ValueError("Неверный индекс")
+
+def _forget_partition_row(user_id: int, m: dict, key: str, k: int):
+    """Убрать из manifest k-ю с конца запись партиции key.
+
+    Внутри партиции порядок строк — порядок добавления, поэтому ей
+    соответствует k-е с конца вхождение key в m["tail"] (если оно там есть).
+    """
+    seen = 0
+    for i in range(len(m["tail"]) - 1, -1, -1):
+        if m["tail"][i] == key:
+            seen += 1
+            if seen == k:
+                del m["tail"][i]
+                break
+    m["partitions"][key] -= 1
+    if m["partitions"][key] <= 0:
+        del m["partitions"][key]
+        _remove_file(_partition_path(user_id, key))
+
+def _move_partitioned(user_id: int, path: str, key: str, pos: int, new: dict):
+    """Запись сменила месяц: убрать из партиции key и дописать в конец новой с тем же id"""
+    keep, start, fieldnames, rows = _read_tail(path, _tail_offsets(path, 0)[0] - pos)
+    rows.pop(0)
+    _write_tail(path, keep, start, fieldnames, rows)
+    m = _load_manifest(user_id)
+    _forget_partition_row(user_id, m, key, len(rows) + 1)
+    _save_manifest(user_id, m)
+    _append_partitioned(user_id, [new])
+
+def _forget_row(user_id: int, m: dict, n: int, key: str):
+    """Убрать из manifest n-ю с конца запись, лежавшую в партиции key"""
+    if n <= len(m["tail"]):
+        del m["tail"][len(m["tail"]) - n]
+    m["partitions"][key] -= 1
+    if m["partitions"][key] <= 0:
+        del m["partitions"][key]
+        _remove_file(_partition_path(user_id, key))
+
+def _update_partitioned(user_id: int, n: int, changes: dict):
+    m = _load_manifest(user_id)
+    key, k = _locate_from_end(m, n)
+    path = _partition_path(user_id, key)
+    keep, start, fieldnames, rows = _read_tail(path, k)
+    if len(rows) < k:
         raise ValueError("Неверный индекс")
-    idx = len(rows) - n
-    old = dict(rows[idx])
-    new = dict(old)
-    for k, v in changes.items():
-        if k == "total":
-            v = float(str(v).replace(",", "."))
-        if k == "currency":
-            v = (v or "").upper()
-        new[k] = v
-    rows[idx] = new
-    _rewrite_rows(user_id, rows)
+    old = dict(rows[0])
+    new = apply_changes(old, changes)
+    if _partition_key(new.get("date")) == key:
+        rows[0] = new
+        _write_tail(path, keep, start, fieldnames, rows)
+        return old, new
+    # Сменился месяц: запись переезжает в свою партицию и становится последней
+    _write_tail(path, keep, start, fieldnames, rows[1:])
+    _forget_row(user_id, m, n, key)
+    _save_manifest(user_id, m)
+    _append_partitioned(user_id, [new])
     return old, new
 
+def _delete_partitioned(user_id: int, n: int):
+    m = _load_manifest(user_id)
+    key, k = _locate_from_end(m, n)
+    removed = _delete_from_end(_partition_path(user_id, key), k)
+    _forget_row(user_id, m, n, key)
+    _save_manifest(user_id, m)
+    return removed
+
+def _iter_partitioned_from_end(user_id: int, window: int):
+    m = _load_manifest(user_id)
+    in_tail = Counter(m["tail"])
+    fetched = {}
+    for n in range(1, sum(m["partitions"].values()) + 1):
+        key, k = _locate_from_end(m, n, in_tail)
+        rows = fetched.get(key, [])
+        if k > len(rows):
+            path = _partition_path(user_id, key)
+            _, _, _, rows = _read_tail(path, max(k, window, 2 * len(rows)))
+            fetched[key] = rows
+            if k > len(rows):
+                return
+        yield n, TransactionRecord(rows[-k])
+
+@_writes
+def csv_export_path(user_id: int):
+    """Путь к CSV со всей историей пользователя (для /export) или None.
+
+    Записи потоково пишутся через iter_rows в finance_export.csv (архивные
+    месяцы — первыми). Сырой finance.csv не отдаётся: правка на месте
+    выравнивает id пробелами до прежней длины строки, а в выгрузке id чистые.
+    """
+    rows = iter_rows(user_id)
+    first = next(rows, None)
+    if first is None:
+        return None
+    out = os.path.join(_user_dir(user_id), "finance_export.csv")
+    with open(out, "w", newline="", encoding="utf-8") as f:
+        w = csv.DictWriter(f, fieldnames=CSV_FIELDS)
+        w.writeheader()
+        w.writerow(first)
+        w.writerows(rows)
+    return out
+
+@_writes
+def migrate_to_partitions(user_id: int) -> int:
+    """Перевести finance.csv пользователя в помесячные партиции на месте.
+
+    Запускать при остановленном боте. Файл читается потоково; manifest
+    пишется последним, поэтому прерванную миграцию можно просто повторить.
+    Возвращает число перенесённых строк.
+    """
+    src = _csv_path(user_id)
+    if os.path.exists(_manifest_path(user_id)) or not os.path.exists(src):
+        return 0
+    os.makedirs(_tx_dir(user_id), exist_ok=True)
+    _ensure_index(src)  # у всех строк есть id
+    m = _new_manifest()
+    m["last_id"] = _read_index_header(src)[1]
+    files, writers = {}, {}
+    tail = deque(maxlen=PARTITION_TAIL_LIMIT)
+    try:
+        with open(src, "r", newline="", encoding="utf-8") as f:
+            for row in csv.DictReader(f):
+                key = _partition_key(row.get("date"))
+                w = writers.get(key)
+                if w is None:
+                    files[key] = open(_partition_path(user_id, key), "w", newline="", encoding="utf-8")
+                    w = writers[key] = csv.DictWriter(files[key], fieldnames=CSV_FIELDS,
+                                                      restval="", extrasaction="ignore")
+                    w.writeheader()
+                row["id"] = int(row["id"])
+                w.writerow(row)
+                m["partitions"][key] = m["partitions"].get(key, 0) + 1
+                tail.append(key)
+    finally:
+        for out in files.values():
+            out.close()
+    for key in m["partitions"]:
+        _rebuild_index(_partition_path(user_id, key))
+    m["tail"] = list(tail)
+    _save_manifest(user_id, m)
+    _remove_file(src)
+    return sum(m["partitions"].values())
+
+# ──────────────────────────────────────────────────────────────────────────────
+# АРХИВ ЗАКРЫТЫХ ЛЕТ (data/<uid>/archive/YYYY.seg)
+# Записи закрытого года переносятся из горячих файлов в неизменяемый сжатый
+# сегмент: по сжатому члену (gzip или lzma) на месяц — CSV с заголовком,
+# затем оглавление JSON {"codec", "fields", "months": {"YYYY-MM": {"offset",
+# "length", "rows"}}}, затем 16 байт: длина оглавления и метка формата.
+# Читатели подключают сегменты, только если период запроса заходит в
+# архивные годы, и распаковывают лишь нужные месяцы (распакованное ложится
+# в общий кэш строк). Сегмент не правится: повторная архивация того же года
+# собирает новый сегмент из старого и новых записей и подменяет его целиком.
+# ──────────────────────────────────────────────────────────────────────────────
+ARCHIVE_CODEC = os.getenv("ARCHIVE_CODEC", "gzip")
+# Сколько последних календарных лет (включая текущий) держать в горячих
+# файлах при плановой архивации; 0 — не архивировать
+ARCHIVE_KEEP_YEARS = int(os.getenv("ARCHIVE_KEEP_YEARS", "2"))
+_SEG_MAGIC = b"FINSEG01"
+_SEG_TRAILER = struct.Struct("<Q8s")
+_SEG_CODECS = {
+    "gzip": (gzip.compress, gzip.decompress),
+    "lzma": (lzma.compress, lzma.decompress),
+}
+_SEG_NAME_RE = re.compile(r"^(\d{4})\.seg$")
+# путь сегмента → (mtime_ns, size, оглавление)
+_segment_footers: dict = {}
+
+def _archive_dir(user_id: int) -> str:
+    return os.path.join(_user_dir(user_id), "archive")
+
+def _segment_path(user_id: int, year: int) -> str:
+    return os.path.join(_archive_dir(user_id), f"{year}.seg")
+
+def _archived_segments(user_id: int) -> list[str]:
+    """Сегменты пользователя по возрастанию года"""
+    folder = _archive_dir(user_id)
+    if not os.path.isdir(folder):
+        return []
+    return [os.path.join(folder, n) for n in sorted(os.listdir(folder)) if _SEG_NAME_RE.match(n)]
+
+def _segment_footer(path: str) -> dict:
+    st = os.stat(path)
+    cached = _segment_footers.get(path)
+    if cached and cached[0] == st.st_mtime_ns and cached[1] == st.st_size:
+        return cached[2]
+    with open(path, "rb") as f:
+        f.seek(-_SEG_TRAILER.size, os.SEEK_END)
+        length, magic = _SEG_TRAILER.unpack(f.read(_SEG_TRAILER.size))
+        if magic != _SEG_MAGIC:
+            raise ValueError(f"Повреждённый сегмент архива: {path}")
+        f.seek(-(_SEG_TRAILER.size + length), os.SEEK_END)
+        footer = json.loads(f.read(length))
+    _segment_footers[path] = (st.st_mtime_ns, st.st_size, footer)
+    return footer
+
+def _archive_parts(user_id: int, start: date = None, end: date = None) -> list[tuple]:
+    """(сегмент, месяц) архивных месяцев, пересекающихся с [start, end)"""
+    parts = []
+    for path in _archived_segments(user_id):
+        year = int(_SEG_NAME_RE.match(os.path.basename(path)).group(1))
+        if (start and date(year + 1, 1, 1) <= start) or (end and date(year, 1, 1) >= end):
+            continue
+        for month in sorted(_segment_footer(path)["months"]):
+            if (start is None and end is None) or _partition_overlaps(month, start, end):
+                parts.append((path, month))
+    return parts
+
+def _read_segment_month(path: str, month: str) -> list:
+    st = os.stat(path)
+    key = f"{path}#{month}"
+    cached = _rows_cache_get(key, st)
+    if cached is not None:
+        return list(cached)
+    footer = _segment_footer(path)
+    entry = footer["months"][month]
+    with open(path, "rb") as f:
+        f.seek(entry["offset"])
+        data = f.read(entry["length"])
+    text = _SEG_CODECS[footer["codec"]][1](data).decode("utf-8")
+    reader = csv.DictReader(io.StringIO(text, newline=""))
+    rows = [TransactionRecord(r) for r in reader]
+    _rows_cache_put(key, st, reader.fieldnames, rows)
+    return list(rows)
+
+def _write_segment(path: str, months: dict, codec: str = None):
+    """Атомарно записать сегмент: months — {"YYYY-MM": [строки]}"""
+    codec = codec or ARCHIVE_CODEC
+    compress = _SEG_CODECS[codec][0]
+    footer = {"codec": codec, "fields": CSV_FIELDS, "months": {}}
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "wb") as f:
+        for month in sorted(months):
+            text = io.StringIO(newline="")
+            w = csv.DictWriter(text, fieldnames=CSV_FIELDS, restval="", extrasaction="ignore")
+            w.writeheader()
+            w.writerows(months[month])
+            data = compress(text.getvalue().encode("utf-8"))
+            footer["months"][month] = {"offset": f.tell(), "length": len(data), "rows": len(months[month])}
+            f.write(data)
+        meta = json.dumps(footer, ensure_ascii=False).encode("utf-8")
+        f.write(meta)
+        f.write(_SEG_TRAILER.pack(len(meta), _SEG_MAGIC))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+def _plain_row(row) -> dict:
+    return {k: row.get(k) for k in CSV_FIELDS}
+
+@_writes
+def archive_year(user_id: int, year: int) -> int:
+    """Перенести записи закрытого года в сжатый сегмент; возвращает число перенесённых записей"""
+    year = int(year)
+    if year >= date.today().year:
+        raise ValueError("Архивировать можно только закрытый год")
+    prefix = f"{year}-"
+    if is_partitioned(user_id):
+        m = _load_manifest(user_id)
+        keys = sorted(k for k in m["partitions"] if k.startswith(prefix))
+        for k in keys:
+            _ensure_index(_partition_path(user_id, k))  # у всех строк должен быть id
+        moved = [r for k in keys for r in _read_file(_partition_path(user_id, k))]
+    else:
+        path = _csv_path(user_id)
+        if not os.path.exists(path):
+            return 0
+        _ensure_index(path)
+        rows = _read_file(path)
+        moved = [r for r in rows if _partition_key(r["date"]).startswith(prefix)]
+    if not moved:
+        return 0
+
+    # Сначала сегмент (старые месяцы + новые записи), потом удаление из
+    # горячих файлов; при сбое между шагами повтор не задвоит записи — слияние по id
+    seg = _segment_path(user_id, year)
+    months = {}
+    if os.path.exists(seg):
+        for month in _segment_footer(seg)["months"]:
+            months[month] = {r.id: _plain_row(r) for r in _read_segment_month(seg, month)}
+    for r in moved:
+        months.setdefault(_partition_key(r["date"]), {})[r.id] = _plain_row(r)
+    _write_segment(seg, {k: list(v.values()) for k, v in months.items()})
+
+    if is_partitioned(user_id):
+        for k in keys:
+            part = _partition_path(user_id, k)
+            _remove_file(part)
+            m["partitions"].pop(k, None)
+        m["tail"] = [k for k in m["tail"] if k not in keys]
+        _save_manifest(user_id, m)
+    else:
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "w", newline="", encoding="utf-8") as f:
+            w = csv.DictWriter(f, fieldnames=CSV_FIELDS, restval="", extrasaction="ignore")
+            w.writeheader()
+            w.writerows(_plain_row(r) for r in rows if not _partition_key(r["date"]).startswith(prefix))
+        os.replace(tmp, path)
+        _rebuild_index(path)
+        _rows_cache_invalidate(path)
+    return len(moved)
+
+def archive_closed_years(user_id: int, keep_years: int = None) -> int:
+    """Архивировать все годы старше последних keep_years (по умолчанию ARCHIVE_KEEP_YEARS)"""
+    keep_years = ARCHIVE_KEEP_YEARS if keep_years is None else keep_years
+    if keep_years <= 0:
+        return 0
+    first_hot = date.today().year - keep_years + 1
+    years = set()
+    for path in _data_files(user_id):
+        if is_partitioned(user_id):
+            key = os.path.splitext(os.path.basename(path))[0]
+            if key != UNDATED_PARTITION:
+                years.add(int(key[:4]))
+        else:
+            years.update(int(k[:4]) for k in map(_partition_key, (r["date"] for r in _read_file(path)))
+                         if k != UNDATED_PARTITION)
+    return sum(archive_year(user_id, y) for y in sorted(years) if y < first_hot)
+
+# ──────────────────────────────────────────────────────────────────────────────
+# КЭШ СТРОК
+# Общий для процесса LRU: путь к CSV → (mtime_ns, size, заголовок, строки).
+# Запись считается актуальной, пока mtime и размер файла не изменились, поэтому
+# правки в обход storage (data_sync, web_server) просто дают промах.
+# Объём ограничен суммарным числом строк (ROWS_CACHE_MAX_ROWS).
+# ──────────────────────────────────────────────────────────────────────────────
+ROWS_CACHE_MAX_ROWS = int(os.getenv("ROWS_CACHE_MAX_ROWS", "200000"))
+
+_rows_cache: "OrderedDict[str, tuple]" = OrderedDict()
+_rows_cache_lock = threading.Lock()
+_rows_cache_stats = {"hits": 0, "misses": 0, "rows": 0}
+# Счётчик перезаписей файла (всё, кроме append) — для снимков rows_since
+_rows_generation: Counter = Counter()
+
+def _rows_cache_get(path: str, st: os.stat_result):
+    with _rows_cache_lock:
+        entry = _rows_cache.get(path)
+        if entry and entry[0] == st.st_mtime_ns and entry[1] == st.st_size:
+            _rows_cache.move_to_end(path)
+            _rows_cache_stats["hits"] += 1
+            return entry[3]
+        _rows_cache_stats["misses"] += 1
+        return None
+
+def _rows_cache_drop(path: str):
+    entry = _rows_cache.pop(path, None)
+    if entry:
+        _rows_cache_stats["rows"] -= len(entry[3])
+
+def _rows_cache_put(path: str, st: os.stat_result, fieldnames, rows: list):
+    if len(rows) > ROWS_CACHE_MAX_ROWS:
+        return
+    with _rows_cache_lock:
+        _rows_cache_drop(path)
+        _rows_cache[path] = (st.st_mtime_ns, st.st_size, fieldnames, rows)
+        _rows_cache_stats["rows"] += len(rows)
+        while _rows_cache_stats["rows"] > ROWS_CACHE_MAX_ROWS:
+            _rows_cache_drop(next(iter(_rows_cache)))
+
+def _rows_cache_extend(path: str, before: os.stat_result, after: os.stat_result, new_rows):
+    """Дописать строки в кэш после append, если кэш соответствовал файлу до записи"""
+    with _rows_cache_lock:
+        entry = _rows_cache.get(path)
+        if not entry:
+            return
+        mtime, size, fieldnames, rows = entry
+        if mtime != before.st_mtime_ns or size != before.st_size or fieldnames != CSV_FIELDS:
+            _rows_cache_drop(path)
+            return
+        # Значения в том виде, в каком их вернул бы csv.DictReader
+        added = [TransactionRecord({k: "" if r.get(k) is None else str(r[k]) for k in CSV_FIELDS})
+                 for r in new_rows]
+        rows.extend(added)
+        _rows_cache[path] = (after.st_mtime_ns, after.st_size, fieldnames, rows)
+        _rows_cache_stats["rows"] += len(added)
+
+def _rows_cache_replace(path: str, before: os.stat_result, after: os.stat_result, pos: int, new_row):
+    """Заменить строку pos в кэше после правки на месте"""
+    with _rows_cache_lock:
+        _rows_generation[path] += 1
+        entry = _rows_cache.get(path)
+        if not entry:
+            return
+        mtime, size, fieldnames, rows = entry
+        if mtime != before.st_mtime_ns or size != before.st_size or pos >= len(rows):
+            _rows_cache_drop(path)
+            return
+        rows[pos] = TransactionRecord({k: "" if new_row.get(k) is None else str(new_row[k]) for k in CSV_FIELDS})
+        _rows_cache[path] = (after.st_mtime_ns, after.st_size, fieldnames, rows)
+
+def _rows_cache_invalidate(path: str):
+    with _rows_cache_lock:
+        _rows_cache_drop(path)
+        _rows_generation[path] += 1
+
+def rows_cache_stats() -> dict:
+    """Счётчики кэша строк: попадания, промахи, число файлов и строк в кэше"""
+    with _rows_cache_lock:
+        return {**_rows_cache_stats, "size": len(_rows_cache)}
+
+def clear_rows_cache():
+    with _rows_cache_lock:
+        _rows_cache.clear()
+        _rows_cache_stats.update(hits=0, misses=0, rows=0)
+
+# ──────────────────────────────────────────────────────────────────────────────
+# ИНДЕКС СМЕЩЕНИЙ И ID (<имя>.idx рядом с каждым CSV)
+# Формат: заголовок 24 байта — метка формата, размер CSV на момент последней
+# синхронизации и последний выданный id; далее по 16 байт на каждую строку
+# данных — смещение её начала в файле и её id. Если размер не совпадает
+# (файл правили в обход storage) или индекс старого формата, он
+# перестраивается одним проходом; строкам без id при этом выдаются id
+# (файл один раз переписывается целиком).
+# ──────────────────────────────────────────────────────────────────────────────
+_IDX_MAGIC = b"FINIDX02"
+_IDX_HEADER = struct.Struct("<8sQQ")
+_IDX_ENTRY = struct.Struct("<QQ")
+
+def _scan_row_offsets(path: str):
+    """Смещения начала строк данных (без заголовка) и размер файла.
+
+    Запись CSV заканчивается на переводе строки вне кавычек, поэтому
+    многострочные поля в кавычках учитываются корректно.
+    """
+    offsets = []
+    pos = row_start = quotes = 0
+    header_done = False
+    with open(path, "rb") as f:
+        for line in f:
+            quotes += line.count(b'"')
+            pos += len(line)
+            if quotes % 2:
+                continue
+            if not header_done:
+                header_done = True
+            elif line.strip() or pos - row_start != len(line):
+                offsets.append(row_start)
+            row_start = pos
+            quotes = 0
+    return offsets, pos
+
+def _parse_id(value):
+    try:
+        return int(value)
+    except (ValueError, TypeError):
+        return None
+
+def _write_index(path: str, entries, csv_size: int, last_id: int):
+    data = [_IDX_HEADER.pack(_IDX_MAGIC, csv_size, last_id)]
+    data.extend(_IDX_ENTRY.pack(o, i) for o, i in entries)
+    # Атомарно: индекс может перестраивать и читатель под общей блокировкой
+    idx = _idx_path(path)
+    tmp = f"{idx}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(b"".join(data))
+    os.replace(tmp, idx)
+
+def _read_index_header(path: str):
+    """(размер CSV, последний id) из заголовка индекса или None"""
+    try:
+        with open(_idx_path(path), "rb") as f:
+            head = f.read(_IDX_HEADER.size)
+    except OSError:
+        return None
+    if len(head) != _IDX_HEADER.size:
+        return None
+    magic, size, last_id = _IDX_HEADER.unpack(head)
+    return (size, last_id) if magic == _IDX_MAGIC else None
+
+def _id_counter_path(path: str):
+    """Для партиции счётчик id общий на пользователя и лежит в manifest.json"""
+    folder = os.path.dirname(path)
+    return os.path.join(folder, "manifest.json") if os.path.basename(folder) == "tx" else None
+
+def _rebuild_index(path: str):
+    if not os.path.exists(path):
+        return
+    header = _read_index_header(path)
+    last_id = header[1] if header else 0
+    with open(path, "r", newline="", encoding="utf-8") as f:
+        r = csv.DictReader(f)
+        ids = [_parse_id(row.get("id")) for row in r]
+        fieldnames = r.fieldnames or []
+    last_id = max([last_id] + [i for i in ids if i is not None])
+    if "id" not in fieldnames or None in ids:
+        last_id = _backfill_ids(path, last_id)
+        with open(path, "r", newline="", encoding="utf-8") as f:
+            ids = [int(row["id"]) for row in csv.DictReader(f)]
+    offsets, size = _scan_row_offsets(path)
+    _write_index(path, zip(offsets, ids), size, last_id)
+
+def _backfill_ids(path: str, last_id: int) -> int:
+    """Выдать id строкам без id (файл переписывается атомарно); возвращает последний id"""
+    counter = _id_counter_path(path)
+    m = _read_json(counter, {}) if counter else {}
+    last_id = max(last_id, int(m.get("last_id", 0)))
+    tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(path, "r", newline="", encoding="utf-8") as src, \
+            open(tmp, "w", newline="", encoding="utf-8") as dst:
+        w = csv.DictWriter(dst, fieldnames=CSV_FIELDS, restval="", extrasaction="ignore")
+        w.writeheader()
+        for row in csv.DictReader(src):
+            row_id = _parse_id(row.get("id"))
+            if row_id is None:
+                last_id += 1
+                row_id = last_id
+            row["id"] = row_id
+            w.writerow(row)
+    os.replace(tmp, path)
+    _rows_cache_invalidate(path)
+    if counter and os.path.exists(counter):
+        m["last_id"] = last_id
+        _write_json(counter, m)
+    return last_id
+
+def _index_is_valid(path: str) -> bool:
+    try:
+        idx_size = os.path.getsize(_idx_path(path))
+    except OSError:
+        return False
+    header = _read_index_header(path)
+    if header is None or (idx_size - _IDX_HEADER.size) % _IDX_ENTRY.size:
+        return False
+    return header[0] == os.path.getsize(path)
+
+def _ensure_index(path: str):
+    if not _index_is_valid(path):
+        _rebuild_index(path)
+
+def _index_count(f) -> int:
+    f.seek(0, os.SEEK_END)
+    return (f.tell() - _IDX_HEADER.size) // _IDX_ENTRY.size
+
+def _tail_offsets(path: str, n: int):
+    """(число строк, смещения последних n строк) — читается только хвост индекса"""
+    _ensure_index(path)
+    with open(_idx_path(path), "rb") as f:
+        count = _index_count(f)
+        take = min(n, count)
+        f.seek(-take * _IDX_ENTRY.size, os.SEEK_END)
+        data = f.read(take * _IDX_ENTRY.size) if take else b""
+    return count, [o for o, _ in _IDX_ENTRY.iter_unpack(data)]
+
+def _find_id(path: str, row_id: int):
+    """(номер строки, её смещение, смещение следующей или конец файла) либо None.
+
+    id в файле обычно возрастают — сначала двоичный поиск по индексу;
+    в партициях, куда запись могла переехать из другого месяца, порядок
+    может нарушаться — тогда линейный просмотр индекса (не CSV).
+    """
+    _ensure_index(path)
+    size = _read_index_header(path)[0]
+    with open(_idx_path(path), "rb") as f:
+        count = _index_count(f)
+
+        def entry(i):
+            f.seek(_IDX_HEADER.size + i * _IDX_ENTRY.size)
+            return _IDX_ENTRY.unpack(f.read(_IDX_ENTRY.size))
+
+        lo, hi = 0, count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if entry(mid)[1] < row_id:
+                lo = mid + 1
+            else:
+                hi = mid
+        pos = lo if lo < count and entry(lo)[1] == row_id else None
+        if pos is None:
+            f.seek(_IDX_HEADER.size)
+            ids = [i for _, i in _IDX_ENTRY.iter_unpack(f.read(count * _IDX_ENTRY.size))]
+            if row_id not in ids:
+                return None
+            pos = ids.index(row_id)
+        start = entry(pos)[0]
+        end = entry(pos + 1)[0] if pos + 1 < count else size
+    return pos, start, end
+
+def _index_append(path: str, old_size: int, entries, new_size: int, last_id: int):
+    try:
+        with open(_idx_path(path), "r+b") as f:
+            head = f.read(_IDX_HEADER.size)
+            if len(head) == _IDX_HEADER.size:
+                magic, size, old_last = _IDX_HEADER.unpack(head)
+                if magic == _IDX_MAGIC and size == old_size:
+                    f.seek(0, os.SEEK_END)
+                    f.write(b"".join(_IDX_ENTRY.pack(o, i) for o, i in entries))
+                    f.seek(0)
+                    f.write(_IDX_HEADER.pack(_IDX_MAGIC, new_size, max(old_last, last_id)))
+                    return
+    except OSError:
+        pass
+    _rebuild_index(path)
+
+def _index_truncate(path: str, keep: int, new_size: int):
+    """Оставить в индексе первые keep строк и записать новый размер CSV"""
+    last_id = (_read_index_header(path) or (0, 0))[1]
+    with open(_idx_path(path), "r+b") as f:
+        f.truncate(_IDX_HEADER.size + keep * _IDX_ENTRY.size)
+        f.seek(0)
+        f.write(_IDX_HEADER.pack(_IDX_MAGIC, new_size, last_id))
+
+def _read_header(path: str) -> list[str]:
+    with open(path, "r", newline="", encoding="utf-8") as f:
+        return next(csv.reader(f), None) or list(CSV_FIELDS)
+
+def _read_tail(path: str, n: int):
+    """Последние n строк: (число строк перед ними, смещение первой, заголовок, строки)"""
+    if not os.path.exists(path):
+        return 0, 0, list(CSV_FIELDS), []
+    count, offsets = _tail_offsets(path, n)
+    fieldnames = _read_header(path)
+    if not offsets:
+        return count, os.path.getsize(path), fieldnames, []
+    with open(path, "rb") as f:
+        f.seek(offsets[0])
+        text = f.read().decode("utf-8")
+    rows = list(csv.DictReader(io.StringIO(text, newline=""), fieldnames=fieldnames))
+    return count - len(offsets), offsets[0], fieldnames, rows
+
+def _write_tail(path: str, keep: int, start: int, fieldnames, rows):
+    """Заменить всё начиная со смещения start на rows и обновить индекс"""
+    ids = []
+    for r in rows:
+        # int() заодно убирает пробелы, которыми id добивался при правке на месте
+        r["id"] = int(r["id"])
+        ids.append(r["id"])
+    data, offsets, end = _encode_rows(fieldnames, rows, start)
+    with open(path, "r+b") as f:
+        f.seek(start)
+        f.write(data)
+        f.truncate()
+    _index_truncate(path, keep, start)
+    _index_append(path, start, zip(offsets, ids), end, max(ids, default=0))
+    _rows_cache_invalidate(path)
+
+# ──────────────────────────────────────────────────────────────────────────────
+# СЖАТИЕ CSV (vacuum)
+# Правка на месте оставляет в файле мёртвые байты (id, добитый пробелами),
+# ручные правки — пустые строки и лишние кавычки. Сжатие переписывает файл
+# одним потоковым проходом во временный <имя>.compact.csv, строит для него
+# индекс и подменяет оба файла. Проход идёт без блокировок (в боте — в
+# отдельном потоке); под блокировкой папки на запись и в потоке event loop
+# выполняется только фиксация: проверка, что файл не правили, дописывание строк,
+# добавленных за время прохода, и rename. Если файл за это время правили
+# не только дописыванием — попытка откладывается до следующего запуска.
+# ──────────────────────────────────────────────────────────────────────────────
+def _compact_tmp_path(path: str) -> str:
+    base, ext = os.path.splitext(path)
+    return f"{base}.compact{ext}"
+
+def _read_text_range(path: str, start: int, end: int):
+    """Строки файла в диапазоне байт [start, end) — потоково"""
+    with open(path, "rb") as f:
+        f.seek(start)
+        pos = start
+        for line in f:
+            if pos >= end:
+                break
+            line = line[:end - pos]
+            pos += len(line)
+            yield line.decode("utf-8")
+
+def _compact_rows(fieldnames, lines):
+    for values in csv.reader(lines):
+        if not any(values):
+            continue
+        row = dict(zip(fieldnames, values))
+        row_id = _parse_id(row.get("id"))
+        if row_id is not None:
+            row["id"] = row_id
+        yield row
+
+def _compact_prepare(path: str):
+    """Тяжёлая часть сжатия: новый файл рядом с исходным; None — сжимать нечего.
+
+    Идёт без блокировки, поэтому файл не переписывает: индекс чинится
+    заранее под блокировкой (_compact_ready), а если он снова устарел —
+    сжатие откладывается.
+    """
+    if not os.path.exists(path) or not _index_is_valid(path):
+        return None
+    before = os.stat(path)
+    if (_read_index_header(path) or (None,))[0] != before.st_size:
+        return None  # файл дописывается прямо сейчас — в следующий раз
+    plan = {"path": path, "tmp": _compact_tmp_path(path), "before": before,
+            "generation": _rows_generation[path], "entries": [], "size": 0}
+    lines = _read_text_range(path, 0, before.st_size)
+    fieldnames = next(csv.reader(lines), None) or list(CSV_FIELDS)
+    head = io.StringIO(newline="")
+    csv.writer(head).writerow(fieldnames)
+    pos = len(head.getvalue().encode("utf-8"))
+    with open(plan["tmp"], "wb") as f:
+        f.write(head.getvalue().encode("utf-8"))
+        for chunk in _batched(_compact_rows(fieldnames, lines), 1000):
+            data, offsets, pos = _encode_rows(fieldnames, chunk, pos)
+            f.write(data)
+            plan["entries"].extend(zip(offsets, (r["id"] for r in chunk)))
+        f.flush()
+        os.fsync(f.fileno())
+    plan["fieldnames"] = fieldnames
+    plan["size"] = pos
+    return plan
+
+def _batched(iterable, n: int):
+    it = iter(iterable)
+    while chunk := list(itertools.islice(it, n)):
+        yield chunk
+
+def _compact_commit(plan) -> int:
+    """Подменить файл сжатой копией; возвращает число освобождённых байт (-1 — отложено)"""
+    path, tmp, before = plan["path"], plan["tmp"], plan["before"]
+    with _states_lock:
+        try:
+            now = os.stat(path)
+        except FileNotFoundError:
+            now = None
+        if (now is None or now.st_ino != before.st_ino or now.st_size < before.st_size
+                or _rows_generation[path] != plan["generation"]
+                or (now.st_size == before.st_size and now.st_mtime_ns != before.st_mtime_ns)):
+            _remove_file(tmp)
+            return -1
+        size, entries = plan["size"], plan["entries"]
+        if now.st_size > before.st_size:
+            # Строки, дописанные за время прохода
+            rows = list(_compact_rows(plan["fieldnames"], _read_text_range(path, before.st_size, now.st_size)))
+            data, offsets, size = _encode_rows(plan["fieldnames"], rows, size)
+            with open(tmp, "ab") as f:
+                f.write(data)
+            entries = entries + list(zip(offsets, (r["id"] for r in rows)))
+        saved = now.st_size - size
+        if saved <= 0:
+            _remove_file(tmp)
+            return 0
+        last_id = (_read_index_header(path) or (0, 0))[1]
+        _write_index(tmp, entries, size, max([last_id] + [i for _, i in entries]))
+        # Сначала CSV: если упасть между rename, старый индекс не совпадёт
+        # по размеру и будет перестроен
+        os.replace(tmp, path)
+        os.replace(_idx_path(tmp), _idx_path(path))
+        _rows_cache_invalidate(path)
+        return saved
+
+def _compact_ready(user_id: int, path: str) -> bool:
+    """Построить/починить индекс под блокировкой записи (перестройка может
+    переписать CSV — выдать id старым строкам)"""
+    with _writing(user_id):
+        if not os.path.exists(path):
+            return False
+        _ensure_index(path)
+        return True
+
+def compact_user(user_id: int) -> int:
+    """Сжать все CSV пользователя; возвращает число освобождённых байт"""
+    _user_state(user_id)  # незавершённый пакет доигрывается до сжатия
+    saved = 0
+    for path in _data_files(user_id):
+        if not _compact_ready(user_id, path):
+            continue
+        plan = _compact_prepare(path)
+        if plan is not None:
+            with _writing(user_id):
+                saved += max(_compact_commit(plan), 0)
+    return saved
+
+async def compact_user_async(user_id: int) -> int:
+    """То же для бота: проход — в отдельном потоке, фиксация — в event loop"""
+    _user_state(user_id)
+    saved = 0
+    for path in _data_files(user_id):
+        if not _compact_ready(user_id, path):
+            continue
+        plan = await asyncio.to_thread(_compact_prepare, path)
+        if plan is not None:
+            with _writing(user_id):
+                saved += max(_compact_commit(plan), 0)
+    return saved
+
+def list_user_ids() -> list[int]:
+    """id пользователей, у которых есть папка в DATA_DIR"""
+    return sorted(uid for uid, _ in iter_user_dirs())
+
+# ──────────────────────────────────────────────────────────────────────────────
+# СОСТОЯНИЕ СЧЕТОВ И БАЛАНСОВ (журнал изменений + снимки)
+# Источник истины — data/<uid>/ledger.jsonl. Первая строка — снимок
+# {"snapshot": {"accounts": ..., "balances": ...}}, дальше по строке на событие
+# {"kind", "op", "key", ["field"], "value", "ts"}: "add" прибавляет value к
+# сумме, "set" присваивает, "del" удаляет ключ. Текущее состояние — снимок
+# плюс хвост событий. Правки применяются к памяти и дописываются в журнал
+# одной записью с fsync через STATE_FLUSH_DELAY секунд (несколько правок
+# подряд — одна запись) и при остановке бота; вне event loop (скрипты,
+# тесты) — сразу. Файл целиком не переписывается: после
+# LEDGER_SNAPSHOT_EVERY событий журнал сворачивается в новый снимок, а
+# прежний остаётся в ledger/<мс>.jsonl для аудита.
+# accounts.json и balances.json — представления для внешних инструментов:
+# обновляются при снимке и при остановке бота, а между снимками отстают от
+# журнала. Если представление поменяли в обход storage (при неизменном
+# журнале), в журнал событиями set/del переносится только сделанная правка —
+# разница с последним записанным или прочитанным содержимым файла, а не с
+# текущим состоянием (иначе отставшее представление откатило бы события).
+# ──────────────────────────────────────────────────────────────────────────────
+STATE_FLUSH_DELAY = float(os.getenv("STATE_FLUSH_DELAY", "0.5"))
+LEDGER_SNAPSHOT_EVERY = int(os.getenv("LEDGER_SNAPSHOT_EVERY", "1000"))
+_STATE_KINDS = ("accounts", "balances")
+
+class _UserState:
+    """Счета и балансы одного пользователя в памяти"""
+
+    def __init__(self, user_id: int):
+        self.user_id = user_id
+        self.dir = _user_dir(user_id)
+        self.ledger = _ledger_path(user_id)
+        self.views = {"accounts": _accounts_path(user_id), "balances": _balances_path(user_id)}
+        self.data = None            # {"accounts": {...}, "balances": {...}}
+        self.view_mtimes = {}
+        self.view_data = {}         # содержимое представлений, последнее записанное или прочитанное
+        self.ledger_id = None       # (st_dev, st_ino) прочитанного журнала, None — журнала нет
+        self.ledger_pos = 0         # до какого байта журнал применён
+        self.events = 0             # событий после последнего снимка
+        self.pending = []           # события, ещё не записанные в журнал
+        self.flush_handle = None
+        self.lock = None
+
+_states: dict = {}
+_states_lock = threading.RLock()
+
+def _user_state(user_id: int) -> _UserState:
+    key = os.path.join(DATA_DIR, str(user_id))
+    st = _states.get(key)
+    if st is None:
+        with _writing(user_id), _states_lock:
+            st = _states.get(key)
+            if st is None:
+                st = _states[key] = _UserState(user_id)
+                # Первое обращение к пользователю в процессе — доигрываем
+                # незавершённый пакет (его изменения тоже идут через журнал)
+                _recover_batch(user_id)
+    return st
+
+def _file_mtime(path: str):
+    try:
+        return os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+def _ledger_line(record: dict) -> bytes:
+    return (json.dumps(record, ensure_ascii=False) + "\n").encode("utf-8")
+
+def _read_ledger_tail(st: _UserState, f):
+    """Применить строки журнала начиная с st.ledger_pos"""
+    f.seek(st.ledger_pos)
+    for line in f:
+        if not line.endswith(b"\n"):
+            # Недописанная строка (падение посреди записи) — отбрасывается
+            # при следующей дозаписи
+            break
+        st.ledger_pos += len(line)
+        try:
+            record = json.loads(line)
+        except ValueError:
+            continue
+        if "snapshot" in record:
+            snap = record["snapshot"]
+            st.data = {kind: {k: dict(v) if isinstance(v, dict) else v
+                              for k, v in (snap.get(kind) or {}).items()}
+                       for kind in _STATE_KINDS}
+            st.events = 0
+        else:
+            apply_event(st.data, record)
+            st.events += 1
+
+def _load_ledger(st: _UserState):
+    """Полностью перечитать журнал; без журнала — взять состояние из представлений"""
+    st.data = {kind: {} for kind in _STATE_KINDS}
+    st.ledger_pos = st.events = 0
+    try:
+        f = open(st.ledger, "rb")
+    except FileNotFoundError:
+        st.ledger_id = None
+        for kind in _STATE_KINDS:
+            st.data[kind] = _read_json(st.views[kind], {})
+    else:
+        with f:
+            info = os.fstat(f.fileno())
+            st.ledger_id = (info.st_dev, info.st_ino)
+            _read_ledger_tail(st, f)
+    # Точка отсчёта для внешних правок представлений — их нынешнее содержимое
+    st.view_mtimes = {kind: _file_mtime(st.views[kind]) for kind in _STATE_KINDS}
+    st.view_data = {kind: _read_json(st.views[kind], {}) for kind in _STATE_KINDS}
+    for ev in st.pending:
+        apply_event(st.data, ev)
+
+def _sync_state(st: _UserState):
+    """Подтянуть изменения журнала и представлений, сделанные в обход процесса"""
+    try:
+        info = os.stat(st.ledger)
+    except FileNotFoundError:
+        info = None
+    if (st.data is None or (info is None) != (st.ledger_id is None)
+            or (info is not None and ((info.st_dev, info.st_ino) != st.ledger_id
+                                      or info.st_size < st.ledger_pos))):
+        _load_ledger(st)
+        return
+    if info is not None and info.st_size > st.ledger_pos:
+        with open(st.ledger, "rb") as f:
+            _read_ledger_tail(st, f)
+        return
+    for kind in _STATE_KINDS:
+        mtime = _file_mtime(st.views[kind])
+        if mtime == st.view_mtimes.get(kind):
+            continue
+        st.view_mtimes[kind] = mtime
+        new = _read_json(st.views[kind], None) if mtime is not None else None
+        if isinstance(new, dict):
+            # Только правка файла: ключи, которых она не коснулась, сохраняют
+            # события журнала после последнего снимка
+            _queue_events(st, diff_events(kind, st.view_data.get(kind, {}), new))
+            st.view_data[kind] = new
+
+def _queue_events(st: _UserState, events):
+    ts = datetime.now().isoformat(timespec="seconds")
+    for ev in events:
+        ev.setdefault("ts", ts)
+        apply_event(st.data, ev)
+        st.pending.append(ev)
+
+def _schedule_flush(st: _UserState):
+    if not st.pending:
+        return
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        loop = None
+    if loop is None:
+        _flush_state(st)
+    elif st.flush_handle is None:
+        st.flush_handle = loop.call_later(STATE_FLUSH_DELAY, _flush_state, st)
+
+def _state_get(user_id: int, kind: str) -> dict:
+    """Текущие данные (живой объект — вызывающий код не должен его менять)"""
+    st = _user_state(user_id)
+    with locking.exclusive(st.dir), _states_lock:
+        _sync_state(st)
+        _schedule_flush(st)
+        return st.data[kind]
+
+def _post_events(user_id: int, events: list):
+    """Применить события к состоянию и поставить их в очередь на запись"""
+    st = _user_state(user_id)
+    with locking.exclusive(st.dir), _states_lock:
+        _sync_state(st)
+        _queue_events(st, events)
+        _schedule_flush(st)
+
+def _state_replace(user_id: int, kind: str, data: dict, durable: bool = True):
+    """Заменить состояние целиком — в журнал уходит только разница"""
+    st = _user_state(user_id)
+    with locking.exclusive(st.dir), _states_lock:
+        _sync_state(st)
+        _queue_events(st, diff_events(kind, st.data[kind], data))
+        if durable:
+            _schedule_flush(st)
+        elif st.pending:
+            _flush_state(st, fsync=False)
+
+def _flush_state(st: _UserState, fsync: bool = True, snapshot: bool = False):
+    with locking.exclusive(st.dir), _states_lock:
+        if st.flush_handle is not None:
+            st.flush_handle.cancel()
+            st.flush_handle = None
+        _sync_state(st)
+        if (snapshot or st.ledger_id is None
+                or st.events + len(st.pending) >= LEDGER_SNAPSHOT_EVERY):
+            _compact_ledger(st, fsync=fsync)
+            return
+        if not st.pending:
+            return
+        payload = b"".join(_ledger_line(ev) for ev in st.pending)
+        with open(st.ledger, "r+b") as f:
+            f.seek(st.ledger_pos)
+            f.truncate()
+            f.write(payload)
+            if fsync:
+                f.flush()
+                os.fsync(f.fileno())
+        st.ledger_pos += len(payload)
+        st.events += len(st.pending)
+        st.pending.clear()
+
+def _compact_ledger(st: _UserState, fsync: bool = True):
+    """Свернуть журнал в снимок текущего состояния и обновить представления"""
+    for kind in _STATE_KINDS:
+        _write_json(st.views[kind], st.data[kind], fsync=False)
+        st.view_mtimes[kind] = _file_mtime(st.views[kind])
+        st.view_data[kind] = copy.deepcopy(st.data[kind])
+    if st.ledger_id is not None and not st.events and not st.pending:
+        return
+    line = _ledger_line({"snapshot": st.data, "ts": datetime.now().isoformat(timespec="seconds")})
+    tmp = f"{st.ledger}.{os.getpid()}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(line)
+        if fsync:
+            f.flush()
+            os.fsync(f.fileno())
+    if st.ledger_id is not None and st.events:
+        # Жёсткая ссылка: прежний журнал доступен под именем архива ещё до
+        # подмены, окна без журнала нет
+        archive_dir = _ledger_archive_dir(st.user_id)
+        os.makedirs(archive_dir, exist_ok=True)
+        os.link(st.ledger, os.path.join(archive_dir, f"{time.time_ns() // 1_000_000}.jsonl"))
+    os.replace(tmp, st.ledger)
+    info = os.stat(st.ledger)
+    st.ledger_id = (info.st_dev, info.st_ino)
+    st.ledger_pos = len(line)
+    st.events = 0
+    st.pending.clear()
+
+@_reads
+def replay_ledger(user_id: int) -> dict:
+    """Состояние, восстановленное только по журналу на диске (для аудита и проверок)"""
+    st = _UserState(user_id)
+    _load_ledger(st)
+    return st.data
+
+def flush_all(snapshot: bool = False):
+    """Сбросить на диск все отложенные изменения счетов и балансов.
+
+    snapshot=True дополнительно сворачивает журналы с событиями в снимки и
+    обновляет accounts.json/balances.json.
+    """
+    with _states_lock:
+        states = list(_states.values())
+    for st in states:
+        if not os.path.isdir(st.dir):
+            continue
+        if st.pending or (snapshot and st.events):
+            _flush_state(st, snapshot=snapshot)
+
+async def flush_on_shutdown(application=None):
+    """Хук post_shutdown для telegram Application"""
+    flush_all(snapshot=True)
+
+atexit.register(flush_all, snapshot=True)
+
+def user_lock(user_id: int) -> asyncio.Lock:
+    """asyncio-блокировка пользователя для многошаговых операций со счетами.
+
+    Сами функции storage атомарны в пределах event loop; блокировка нужна,
+    когда между шагами одной операции есть await.
+    """
+    st = _user_state(user_id)
+    if st.lock is None:
+        st.lock = asyncio.Lock()
+    return st.lock
+
+# ──────────────────────────────────────────────────────────────────────────────
+# ПАКЕТНАЯ ФИКСАЦИЯ (журнал намерений)
+# Операция из нескольких шагов (перевод: новое состояние счетов + две записи
+# в CSV) сначала целиком пишется в journal.json с fsync. Затем изменения
+# применяются без fsync на каждом шаге, и перед удалением журнала на диск
+# сбрасываются затронутые CSV/партиции, manifest, ledger.jsonl и папки (по
+# одному fsync на файл) — журнал не исчезает раньше данных, которые он
+# защищает. Индексы .idx не сбрасываются: при несовпадении размера они
+# перестраиваются. Если процесс упал посередине, журнал остался на диске и
+# при следующем обращении к пользователю операция доигрывается: затронутые
+# CSV обрезаются до размеров из журнала, записи добавляются заново, счета и
+# балансы перезаписываются.
+# ──────────────────────────────────────────────────────────────────────────────
+@_writes
+def apply_batch(user_id: int, rows=(), accounts: dict = None, source: str = "",
+                balances: dict = None):
+    """Атомарно добавить записи и (если передано) сохранить новое состояние счетов и балансов"""
+    ensure_csv(user_id)
+    rows = [make_row(r, source or r.get("source", "")) for r in rows]
+    with _states_lock:
+        _recover_batch(user_id)
+        journal = {"rows": rows, "accounts": accounts, "balances": balances,
+                   "files": {}, "manifest": None}
+        if is_partitioned(user_id):
+            journal["manifest"] = _load_manifest(user_id)
+            paths = {_partition_path(user_id, _partition_key(r["date"])) for r in rows}
+        else:
+            paths = {_csv_path(user_id)}
+        for path in paths:
+            journal["files"][path] = os.path.getsize(path) if os.path.exists(path) else None
+        _write_json(_journal_path(user_id), journal)
+        _apply_journal(user_id, journal)
+        _sync_batch(user_id, journal)
+        os.remove(_journal_path(user_id))
+
+def _apply_journal(user_id: int, journal: dict):
+    if journal["rows"]:
+        if journal["manifest"] is not None:
+            _append_partitioned(user_id, journal["rows"], fsync=False)
+        else:
+            _append_to_file(_csv_path(user_id), journal["rows"])
+    for kind in _STATE_KINDS:
+        data = journal.get(kind)
+        if data is not None:
+            # Журнал намерений уже на диске — повтор даст пустую разницу
+            _state_replace(user_id, kind, data, durable=False)
+
+def _recover_batch(user_id: int):
+    path = _journal_path(user_id)
+    journal = _read_json(path, None)
+    if journal is None:
+        if os.path.exists(path):
+            # Журнал не дописан — до применения дело не дошло
+            os.remove(path)
+        return
+    for file, size in journal["files"].items():
+        if size is None:
+            _remove_file(file)
+        elif os.path.exists(file):
+            with open(file, "r+b") as f:
+                f.truncate(size)
+            _rebuild_index(file)
+            _rows_cache_invalidate(file)
+    if journal["manifest"] is not None:
+        _save_manifest(user_id, journal["manifest"], fsync=False)
+    else:
+        ensure_csv(user_id)
+    _apply_journal(user_id, journal)
+    _sync_batch(user_id, journal)
+    os.remove(path)
+
+def _fsync_path(path: str):
+    """fsync файла или папки (для папки — фиксирует создание и rename в ней)"""
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def _sync_batch(user_id: int, journal: dict):
+    """Сбросить на диск всё, что изменил пакет, — после этого журнал можно удалять"""
+    paths = [f for f in journal["files"] if os.path.exists(f)]
+    if journal["manifest"] is not None:
+        paths += [_manifest_path(user_id), _tx_dir(user_id)]
+    if os.path.exists(_ledger_path(user_id)):
+        paths.append(_ledger_path(user_id))
+    for path in paths + [_user_dir(user_id)]:
+        _fsync_path(path)
+
 # ──────────────────────────────────────────────────────────────────────────────
 # БАЛАНСЫ (валюта/категория — старый функционал)
 # ──────────────────────────────────────────────────────────────────────────────
 def _load_balances(user_id: int):
-    return _read_json(_balances_path(user_id), {})
+    return dict(_state_get(user_id, "balances"))
 
 def _save_balances(user_id: int, data: dict):
-    _write_json(_balances_path(user_id), data)
+    _state_replace(user_id, "balances", dict(data))
 
+@_writes
 def set_balance(user_id: int, data, currency: str = None, category: str = None):
     """Установить баланс. Может принимать словарь балансов или отдельные параметры."""
     if isinstance(data, dict):
@@ -148,118 +1864,105 @@ def set_balance(user_id: int, data, currency: str = None, category: str = None):
         return data
     else:
         # Старый формат для совместимости
-        amount = data
-        bal = _load_balances(user_id)
         key = f"{currency.upper()}" if not category else f"{category}@{currency.upper()}"
-        bal[key] = float(amount)
-        _save_balances(user_id, bal)
-        return key, bal[key]
+        _post_events(user_id, [{"kind": "balances", "op": "set", "key": key, "value": float(data)}])
+        return key, float(data)
 
 def get_balances(user_id: int):
     return _load_balances(user_id)
 
+@_writes
 def dec_balance(user_id: int, amount: float, currency: str | None, category: str | None):
-    bal = _load_balances(user_id)
     if not currency:
         return
     key1 = currency.upper()
     key2 = f"{(category or '')}@{currency.upper()}"
     # Если сумма отрицательная, то это расход, и мы уменьшаем баланс
     # Если сумма положительная, то это доход, и мы увеличиваем баланс
-    for k in (key1, key2):
-        if k in bal:
-            bal[k] = float(bal[k]) - float(amount or 0)
-    _save_balances(user_id, bal)
+    delta = -float(amount or 0)
+    _post_events(user_id, balance_deltas(_state_get(user_id, "balances"),
+                                          ((key1, delta), (key2, delta))))
 
+@_writes
 def rebalance_on_edit(user_id: int, old_row: dict, new_row: dict):
-    def _num(x):
-        try:
-            return float(x)
-        except:
-            return 0.0
-    old_cur = (old_row.get("currency") or "").upper()
-    new_cur = (new_row.get("currency") or "").upper()
-    old_cat = old_row.get("category") or None
-    new_cat = new_row.get("category") or None
-    old_total = _num(old_row.get("total", 0))
-    new_total = _num(new_row.get("total", 0))
-
-    # вернуть старую сумму (отменить предыдущее изменение)
-    if old_cur:
-        bal = _load_balances(user_id)
-        for k in (old_cur, f"{(old_cat or '')}@{old_cur}"):
-            if k in bal:
-                bal[k] = float(bal[k]) + old_total
-        _save_balances(user_id, bal)
-
-    # применить новую сумму (отрицательная = расход, положительная = доход)
-    if new_cur:
-        bal = _load_balances(user_id)
-        for k in (new_cur, f"{(new_cat or '')}@{new_cur}"):
-            if k in bal:
-                bal[k] = float(bal[k]) - new_total
-        _save_balances(user_id, bal)
+    _post_events(user_id, balance_deltas(_state_get(user_id, "balances"),
+                                          rebalance_pairs(old_row, new_row)))
 
 # ──────────────────────────────────────────────────────────────────────────────
 # СЧЕТА (банковские/кошельки)
 # ──────────────────────────────────────────────────────────────────────────────
 def list_accounts(user_id: int) -> dict:
-    return _read_json(_accounts_path(user_id), {})
+    return {name: dict(v) for name, v in _state_get(user_id, "accounts").items()}
+
+def _save_accounts(user_id: int, acc: dict):
+    _state_replace(user_id, "accounts", acc)
 
+def _account_event(name: str, op: str, value, field: str = None) -> dict:
+    ev = {"kind": "accounts", "op": op, "key": name, "value": value}
+    if field:
+        ev["field"] = field
+    return ev
+
+@_writes
 def add_account(user_id: int, name: str, currency: str, amount: float = 0.0):
     name = name.strip()
     currency = (currency or "").upper()
     if not name or not currency:
         raise ValueError("name/currency пустые")
-    acc = list_accounts(user_id)
-    if name in acc:
+    if name in _state_get(user_id, "accounts"):
         raise ValueError("Счёт с таким именем уже существует")
-    acc[name] = {"currency": currency, "amount": float(amount)}
-    _write_json(_accounts_path(user_id), acc)
-    return name, acc[name]
+    value = {"currency": currency, "amount": float(amount)}
+    _post_events(user_id, [_account_event(name, "set", value)])
+    return name, dict(value)
 
+@_writes
 def set_account_amount(user_id: int, name: str, amount: float):
-    acc = list_accounts(user_id)
-    if name not in acc:
+    if name not in _state_get(user_id, "accounts"):
         raise ValueError("Нет такого счёта")
-    acc[name]["amount"] = float(amount)
-    _write_json(_accounts_path(user_id), acc)
-    return name, acc[name]
+    _post_events(user_id, [_account_event(name, "set", float(amount), "amount")])
+    return name, dict(_state_get(user_id, "accounts")[name])
 
+@_writes
 def dec_account(user_id: int, name: str, amount: float):
-    acc = list_accounts(user_id)
-    if name not in acc:
+    if name not in _state_get(user_id, "accounts"):
         raise ValueError("Нет такого счёта")
     # Если сумма отрицательная, то это расход, и мы уменьшаем баланс счета
     # Если сумма положительная, то это доход, и мы увеличиваем баланс счета
-    acc[name]["amount"] = float(acc[name]["amount"]) - float(amount or 0)
-    _write_json(_accounts_path(user_id), acc)
+    _post_events(user_id, [_account_event(name, "add", -float(amount or 0), "amount")])
 
+@_writes
 def inc_account(user_id: int, name: str, amount: float):
     """Увеличить баланс счёта (для доходов)"""
-    acc = list_accounts(user_id)
-    if name not in acc:
+    if name not in _state_get(user_id, "accounts"):
         raise ValueError("Нет такого счёта")
-    acc[name]["amount"] = float(acc[name]["amount"]) + float(amount or 0)
-    _write_json(_accounts_path(user_id), acc)
+    _post_events(user_id, [_account_event(name, "add", float(amount or 0), "amount")])
+
+@_writes
+def adjust_accounts(user_id: int, pairs):
+    """Одной пачкой событий изменить суммы счетов: pairs — (имя, изменение).
 
+    Неизвестные счета пропускаются — так правка записи не падает, если счёт
+    успели удалить.
+    """
+    acc = _state_get(user_id, "accounts")
+    _post_events(user_id, [_account_event(name, "add", float(delta), "amount")
+                           for name, delta in pairs if name in acc and delta])
+
+@_writes
 def delete_account(user_id: int, name: str):
     """Удалить счёт"""
-    acc = list_accounts(user_id)
-    if name not in acc:
+    if name not in _state_get(user_id, "accounts"):
         raise ValueError("Нет такого счёта")
-    del acc[name]
-    _write_json(_accounts_path(user_id), acc)
+    _post_events(user_id, [{"kind": "accounts", "op": "del", "key": name}])
     return name
 
+@_writes
 def update_account_currency(user_id: int, name: str, currency: str):
     """Обновить валюту счёта"""
-    acc = list_accounts(user_id)
-    if name not in acc:
+    if name not in _state_get(user_id, "accounts"):
         raise ValueError("Нет такого счёта")
-    acc[name]["currency"] = (currency or "").upper()
-    _write_json(_accounts_path(user_id), acc)
-    return name, acc[name]
+    _post_events(user_id, [_account_event(name, "set", (currency or "").upper(), "currency")])
+    return name, dict(_state_get(user_id, "accounts")[name])
 
 def find_accounts_by_currency(user_id: int, currency: str) -> list[str]:
     currency = (currency or "").upper()
@@ -267,113 +1970,12 @@ def find_accounts_by_currency(user_id: int, currency: str) -> list[str]:
     return [n for n, v in acc.items() if (v.get("currency") or "").upper() == currency]
 
 def format_accounts(user_id: int) -> str:
-    acc = list_accounts(user_id)
-    if not acc:
-        return "📊 Счетов пока нет.\n\n💡 Добавьте первый счёт, чтобы начать отслеживать баланс!"
-    
-    lines = ["💼 <b>Ваши счета:</b>\n"]
-    total_amounts = {}
-    
-    for name, v in acc.items():
-        amount = float(v.get('amount', 0))
-        currency = v.get('currency', '')
-        
-        # Группируем по валютам для подсчета общего баланса
-        if currency not in total_amounts:
-            total_amounts[currency] = 0
-        total_amounts[currency] += amount
-        
-        # Красивое форматирование счета
-        if amount >= 0:
-            emoji = "💰"
-        else:
-            emoji = "💸"
-            
-        lines.append(f"{emoji} <b>{name}</b>\n   {amount:,.2f} {currency}\n")
-    
-    # Добавляем общий баланс по валютам
-    if total_amounts:
-        lines.append("━━━━━━━━━━━━━━━━━━━━")
-        lines.append("📈 <b>Общий баланс:</b>")
-        for currency, total in total_amounts.items():
-            if total >= 0:
-                emoji = "💚"
-            else:
-                emoji = "❤️"
-            lines.append(f"{emoji} {total:,.2f} {currency}")
-    
-    return "\n".join(lines)
+    return render_accounts(list_accounts(user_id))
 
+@_writes
 def transfer_between_accounts(user_id: int, from_account: str, to_account: str, amount: float, second_amount: float = None):
     """Перевод денег между счетами"""
-    acc = list_accounts(user_id)
-    
-    if from_account not in acc:
-        raise ValueError(f"Счет-источник «{from_account}» не найден")
-    if to_account not in acc:
-        raise ValueError(f"Счет-получатель «{to_account}» не найден")
-    if from_account == to_account:
-        raise ValueError("Нельзя переводить на тот же счет")
-    
-    from_acc = acc[from_account]
-    to_acc = acc[to_account]
-    
-    # Проверяем достаточность средств
-    if float(from_acc["amount"]) < amount:
-        raise ValueError(f"Недостаточно средств на счете «{from_account}». Доступно: {from_acc['amount']:.2f} {from_acc['currency']}")
-    
-    # Определяем валюты
-    from_currency = from_acc["currency"]
-    to_currency = to_acc["currency"]
-    
-    # Если валюты одинаковые, используем одну сумму
-    if from_currency == to_currency:
-        transfer_amount = amount
-    else:
-        # Если валюты разные, используем вторую сумму
-        if second_amount is None:
-            raise ValueError("Для разных валют необходимо указать сумму для счета-получателя")
-        transfer_amount = second_amount
-    
-    # Выполняем перевод
-    acc[from_account]["amount"] = float(acc[from_account]["amount"]) - amount
-    acc[to_account]["amount"] = float(acc[to_account]["amount"]) + transfer_amount
-    
-    _write_json(_accounts_path(user_id), acc)
-    
-    # Записываем переводы в CSV для отображения в экспорте
-    current_date = datetime.now().strftime("%Y-%m-%d")
-    
-    # Запись списания с исходного счета
-    from_transaction = {
-        "date": current_date,
-        "merchant": f"Перевод на {to_account}",
-        "total": -amount,  # Отрицательная сумма для расхода
-        "currency": from_currency,
-        "category": "Банковские операции",
-        "payment_method": from_account,
-        "source": "transfer"
-    }
-    append_row_csv(user_id, from_transaction, source="transfer")
-    
-    # Запись зачисления на целевой счет
-    to_transaction = {
-        "date": current_date,
-        "merchant": f"Перевод с {from_account}",
-        "total": transfer_amount,  # Положительная сумма для дохода
-        "currency": to_currency,
-        "category": "Банковские операции",
-        "payment_method": to_account,
-        "source": "transfer"
-    }
-    append_row_csv(user_id, to_transaction, source="transfer")
-    
-    return {
-        "from_account": from_account,
-        "to_account": to_account,
-        "from_amount": amount,
-        "to_amount": transfer_amount,
-        "from_currency": from_currency,
-        "to_currency": to_currency,
-        "date": current_date
-    }
+    rows, result = transfer_rows(list_accounts(user_id), from_account, to_account, amount, second_amount)
+    # Обе записи и проводка по счетам фиксируются одним шагом
+    append_rows_csv(user_id, rows, source="transfer", update_balances=False)
+    return result
@@ -1,9 +1,14 @@
 # storage.py — база данных хранилище
 import os
+import csv
+import asyncio
+import tempfile
+import functools
 from datetime import datetime
-from typing import List, Dict, Any, Optional
+from typing import List, Dict, Any, Optional, Tuple, Iterator, AsyncIterator
 
-from app.database.service import get_database_service
+from app.database.service import unit_of_work, transaction_cursor
+from app.database.async_service import async_unit_of_work
 from app.utils import format_money as fmt_money
 
 # ──────────────────────────────────────────────────────────────────────────────
@@ -19,48 +24,52 @@ def add_transaction(user_id: int, date: datetime, merchant: str, total: float,
                    currency: str, category: str = None, payment_method: str = None,
                    source: str = None, notes: str = None, account_id: int = None) -> int:
     """Добавить транзакцию в базу данных"""
-    db_service = get_database_service()
+    with unit_of_work() as db_service:
     
-    # Определяем тип транзакции
-    transaction_type = "income" if total > 0 else "expense"
+        # Определяем тип транзакции
+        transaction_type = "income" if total > 0 else "expense"
     
-    transaction = db_service.create_transaction(
-        user_id=user_id,
-        date=date,
-        total=abs(total),
-        currency=currency,
-        category=category,
-        merchant=merchant,
-        payment_method=payment_method,
-        source=source,
-        notes=notes,
-        account_id=account_id,
-        transaction_type=transaction_type
-    )
+        transaction = db_service.create_transaction(
+            user_id=user_id,
+            date=date,
+            total=abs(total),
+            currency=currency,
+            category=category,
+            merchant=merchant,
+            payment_method=payment_method,
+            source=source,
+            notes=notes,
+            account_id=account_id,
+            transaction_type=transaction_type
+        )
     
-    return transaction.id
+        return transaction.id
 
-def get_transactions(user_id: int, limit: int = 100) -> List[Dict[str, Any]]:
-    """Получить транзакции пользователя"""
-    db_service = get_database_service()
-    transactions = db_service.get_transactions(user_id, limit=limit)
-    
-    result = []
-    for t in transactions:
-        result.append({
-            'id': t.id,
-            'date': t.date,
-            'merchant': t.merchant,
-            'total': t.total,
-            'currency': t.currency,
-            'category': t.category,
-            'payment_method': t.payment_method,
-            'source': t.source,
-            'notes': t.notes,
-            'transaction_type': t.transaction_type
-        })
-    
-    return result
+def get_transactions(user_id: int, limit: int = 100, after: Tuple = None) -> List[Dict[str, Any]]:
+    """Получить транзакции пользователя (новые сначала).
+
+    after — курсор (date, id) последней транзакции предыдущей страницы.
+    """
+    with unit_of_work() as db_service:
+        return [row._asdict() for row in db_service.get_transactions(user_id, limit=limit, after=after)]
+
+def iter_transactions(user_id: int, chunk: int = 1000, start_date: datetime = None,
+                      end_date: datetime = None) -> Iterator[Dict[str, Any]]:
+    """Все транзакции пользователя потоком, в хронологическом порядке.
+
+    Каждая пачка читается в своей короткой единице работы — между пачками
+    сессия не держится, сколько бы ни длился обход.
+    """
+    after = None
+    while True:
+        with unit_of_work() as db_service:
+            rows = db_service.get_transactions(user_id, chunk, after=after, start_date=start_date,
+                                               end_date=end_date, descending=False)
+        for row in rows:
+            yield row._asdict()
+        if len(rows) < chunk:
+            return
+        after = transaction_cursor(rows[-1])
 
 def get_last_transaction(user_id: int) -> Optional[Dict[str, Any]]:
     """Получить последнюю транзакцию"""
@@ -69,13 +78,13 @@ def get_last_transaction(user_id: int) -> Optional[Dict[str, Any]]:
 
 def delete_transaction(transaction_id: int):
     """Удалить транзакцию"""
-    db_service = get_database_service()
-    db_service.delete_transaction(transaction_id)
+    with unit_of_work() as db_service:
+        db_service.delete_transaction(transaction_id)
 
 def update_transaction(transaction_id: int, **kwargs):
     """Обновить транзакцию"""
-    db_service = get_database_service()
-    return db_service.update_transaction(transaction_id, **kwargs)
+    with unit_of_work() as db_service:
+        return db_service.update_transaction(transaction_id, **kwargs)
 
 # ──────────────────────────────────────────────────────────────────────────────
 # СЧЕТА И БАЛАНСЫ
@@ -83,55 +92,55 @@ def update_transaction(transaction_id: int, **kwargs):
 
 def add_account(user_id: int, name: str, currency: str = "EUR", balance: float = 0.0) -> int:
     """Добавить счет"""
-    db_service = get_database_service()
-    account = db_service.create_account(user_id, name, currency, balance)
-    return account.id
+    with unit_of_work() as db_service:
+        account = db_service.create_account(user_id, name, currency, balance)
+        return account.id
 
 def get_accounts(user_id: int) -> List[Dict[str, Any]]:
     """Получить все счета пользователя"""
-    db_service = get_database_service()
-    accounts = db_service.get_accounts(user_id)
+    with unit_of_work() as db_service:
+        accounts = db_service.get_accounts(user_id)
     
-    result = []
-    for a in accounts:
-        result.append({
-            'id': a.id,
-            'name': a.name,
-            'currency': a.currency,
-            'balance': a.balance,
-            'is_active': a.is_active
-        })
+        result = []
+        for a in accounts:
+            result.append({
+                'id': a.id,
+                'name': a.name,
+                'currency': a.currency,
+                'balance': a.balance,
+                'is_active': a.is_active
+            })
     
-    return result
+        return result
 
 def set_balance(user_id: int, amount: float, currency: str, category: str = None) -> tuple:
     """Установить баланс (совместимость со старым API)"""
-    db_service = get_database_service()
+    with unit_of_work() as db_service:
     
-    # Если указана категория, ищем счет по категории
-    if category:
-        accounts = db_service.get_accounts(user_id)
-        for account in accounts:
-            if account.name.lower() == category.lower():
-                db_service.update_account_balance(account.id, amount)
-                return (account.name, amount)
+        # Если указана категория, ищем счет по категории
+        if category:
+            accounts = db_service.get_accounts(user_id)
+            for account in accounts:
+                if account.name.lower() == category.lower():
+                    db_service.update_account_balance(account.id, amount)
+                    return (account.name, amount)
     
-    # Иначе создаем новый счет
-    account_name = f"Account {currency}"
-    account = db_service.create_account(user_id, account_name, currency, amount)
-    return (account.name, amount)
+        # Иначе создаем новый счет
+        account_name = f"Account {currency}"
+        account = db_service.create_account(user_id, account_name, currency, amount)
+        return (account.name, amount)
 
 def get_balance(user_id: int, currency: str = "EUR") -> float:
     """Получить общий баланс по валюте"""
-    db_service = get_database_service()
-    accounts = db_service.get_accounts(user_id)
+    with unit_of_work() as db_service:
+        accounts = db_service.get_accounts(user_id)
     
-    total_balance = 0.0
-    for account in accounts:
-        if account.currency == currency:
-            total_balance += account.balance
+        total_balance = 0.0
+        for account in accounts:
+            if account.currency == currency:
+                total_balance += account.balance
     
-    return total_balance
+        return total_balance
 
 # ──────────────────────────────────────────────────────────────────────────────
 # ПРАВИЛА КАТЕГОРИЗАЦИИ
@@ -139,31 +148,31 @@ def get_balance(user_id: int, currency: str = "EUR") -> float:
 
 def add_rule(user_id: int, category: str, match_conditions: Dict[str, Any]) -> int:
     """Добавить правило категоризации"""
-    db_service = get_database_service()
-    rule = db_service.create_rule(user_id, category, match_conditions)
-    return rule.id
+    with unit_of_work() as db_service:
+        rule = db_service.create_rule(user_id, category, match_conditions)
+        return rule.id
 
 def get_rules(user_id: int) -> List[Dict[str, Any]]:
     """Получить правила пользователя"""
-    db_service = get_database_service()
-    rules = db_service.get_rules(user_id)
+    with unit_of_work() as db_service:
+        rules = db_service.get_rules(user_id)
     
-    result = []
-    for r in rules:
-        import json
-        result.append({
-            'id': r.id,
-            'category': r.category,
-            'match': json.loads(r.match_conditions),
-            'is_active': r.is_active
-        })
+        result = []
+        for r in rules:
+            import json
+            result.append({
+                'id': r.id,
+                'category': r.category,
+                'match': json.loads(r.match_conditions),
+                'is_active': r.is_active
+            })
     
-    return result
+        return result
 
 def delete_rule(rule_id: int):
     """Удалить правило"""
-    db_service = get_database_service()
-    db_service.delete_rule(rule_id)
+    with unit_of_work() as db_service:
+        db_service.delete_rule(rule_id)
 
 # ──────────────────────────────────────────────────────────────────────────────
 # СТАТИСТИКА
@@ -171,53 +180,88 @@ def delete_rule(rule_id: int):
 
 def get_user_stats(user_id: int) -> Dict[str, Any]:
     """Получить статистику пользователя"""
-    db_service = get_database_service()
-    return db_service.get_user_stats(user_id)
+    with unit_of_work() as db_service:
+        return db_service.get_user_stats(user_id)
 
 def get_category_stats(user_id: int, start_date: datetime = None, end_date: datetime = None) -> Dict[str, float]:
     """Получить статистику по категориям"""
-    db_service = get_database_service()
-    return db_service.get_category_stats(user_id, start_date, end_date)
+    with unit_of_work() as db_service:
+        return db_service.get_category_stats(user_id, start_date, end_date)
+
+def get_monthly_stats(user_id: int, start_date: datetime = None, end_date: datetime = None,
+                      transaction_type: str = None) -> List[Tuple[str, str, str, float, int]]:
+    """Итоги по месяцам: (месяц, тип, валюта, сумма, число транзакций)"""
+    with unit_of_work() as db_service:
+        return db_service.get_monthly_stats(user_id, start_date, end_date, transaction_type)
+
+def get_merchant_stats(user_id: int, start_date: datetime = None, end_date: datetime = None,
+                       limit: int = None) -> List[Tuple[str, str, float, int]]:
+    """Итоги по магазинам: (магазин, валюта, сумма, число транзакций)"""
+    with unit_of_work() as db_service:
+        return db_service.get_merchant_stats(user_id, start_date, end_date, limit=limit)
+
+def get_currency_stats(user_id: int, start_date: datetime = None,
+                       end_date: datetime = None) -> List[Tuple[str, str, float, int]]:
+    """Итоги по валютам: (валюта, тип, сумма, число транзакций)"""
+    with unit_of_work() as db_service:
+        return db_service.get_currency_stats(user_id, start_date, end_date)
+
+def get_monthly_summary(user_id: int, month: str = None, start_month: str = None,
+                        end_month: str = None) -> List[Tuple]:
+    """Помесячные итоги: (месяц, тип, категория, валюта, сумма, число, минимум, максимум)"""
+    with unit_of_work() as db_service:
+        return db_service.get_monthly_summary(user_id, month, start_month, end_month)
 
 # ──────────────────────────────────────────────────────────────────────────────
 # ЭКСПОРТ ДАННЫХ
 # ──────────────────────────────────────────────────────────────────────────────
 
-def export_to_csv(user_id: int) -> str:
-    """Экспортировать данные в CSV (для совместимости)"""
-    import csv
-    import tempfile
-    
-    # Создаем временный файл
+_EXPORT_FIELDS = ['date', 'merchant', 'total', 'currency', 'category', 'payment_method', 'source', 'notes']
+# Транзакций на одну запись в файл при асинхронном экспорте
+_EXPORT_CHUNK = 1000
+
+def _open_export():
+    """Временный CSV-файл экспорта с заголовком: (файл, writer)"""
     temp_file = tempfile.NamedTemporaryFile(mode='w', delete=False, suffix='.csv', encoding='utf-8')
-    
-    # Получаем транзакции
-    transactions = get_transactions(user_id)
-    
-    if not transactions:
-        temp_file.close()
-        return None
-    
-    # Записываем CSV
-    fieldnames = ['date', 'merchant', 'total', 'currency', 'category', 'payment_method', 'source', 'notes']
-    writer = csv.DictWriter(temp_file, fieldnames=fieldnames)
+    writer = csv.DictWriter(temp_file, fieldnames=_EXPORT_FIELDS)
     writer.writeheader()
-    
-    for t in transactions:
-        writer.writerow({
-            'date': t['date'].strftime('%Y-%m-%d %H:%M:%S'),
-            'merchant': t['merchant'] or '',
-            'total': t['total'],
-            'currency': t['currency'],
-            'category': t['category'] or '',
-            'payment_method': t['payment_method'] or '',
-            'source': t['source'] or '',
-            'notes': t['notes'] or ''
-        })
-    
+    return temp_file, writer
+
+def _export_row(t: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        'date': t['date'].strftime('%Y-%m-%d %H:%M:%S'),
+        'merchant': t['merchant'] or '',
+        'total': t['total'],
+        'currency': t['currency'],
+        'category': t['category'] or '',
+        'payment_method': t['payment_method'] or '',
+        'source': t['source'] or '',
+        'notes': t['notes'] or ''
+    }
+
+def _close_export(temp_file, written: int, ok: bool = True) -> Optional[str]:
+    """Закрыть файл экспорта; пустой или недописанный — удалить"""
     temp_file.close()
+    if not (ok and written):
+        os.unlink(temp_file.name)
+        return None
     return temp_file.name
 
+def export_to_csv(user_id: int) -> Optional[str]:
+    """Экспортировать данные в CSV (для совместимости)"""
+    temp_file, writer = _open_export()
+    
+    # Записываем CSV потоком — все транзакции, не держа их в памяти
+    written = 0
+    try:
+        for t in iter_transactions(user_id):
+            writer.writerow(_export_row(t))
+            written += 1
+    except BaseException:
+        _close_export(temp_file, written, ok=False)
+        raise
+    return _close_export(temp_file, written)
+
 # ──────────────────────────────────────────────────────────────────────────────
 # СОВМЕСТИМОСТЬ СО СТАРЫМ API
 # ──────────────────────────────────────────────────────────────────────────────
@@ -227,15 +271,16 @@ def load_rules(user_id: int) -> List[Dict[str, Any]]:
     return get_rules(user_id)
 
 def save_rules(user_id: int, rules: List[Dict[str, Any]]):
-    """Сохранить правила (совместимость)"""
-    # Удаляем старые правила
-    old_rules = get_rules(user_id)
-    for rule in old_rules:
-        delete_rule(rule['id'])
-    
-    # Добавляем новые
-    for rule in rules:
-        add_rule(user_id, rule['category'], rule['match'])
+    """Сохранить правила (совместимость) — одной транзакцией"""
+    with unit_of_work():
+        # Удаляем старые правила
+        old_rules = get_rules(user_id)
+        for rule in old_rules:
+            delete_rule(rule['id'])
+        
+        # Добавляем новые
+        for rule in rules:
+            add_rule(user_id, rule['category'], rule['match'])
 
 def load_accounts(user_id: int) -> Dict[str, Dict[str, Any]]:
     """Загрузить счета в старом формате"""
@@ -251,13 +296,89 @@ def load_accounts(user_id: int) -> Dict[str, Dict[str, Any]]:
     return result
 
 def save_accounts(user_id: int, accounts: Dict[str, Dict[str, Any]]):
-    """Сохранить счета в старом формате"""
-    # Удаляем старые счета
-    old_accounts = get_accounts(user_id)
-    for account in old_accounts:
-        db_service = get_database_service()
-        db_service.delete_account(account['id'])
-    
-    # Добавляем новые
-    for name, data in accounts.items():
-        add_account(user_id, name, data['currency'], data['amount'])
+    """Сохранить счета в старом формате — одной транзакцией"""
+    with unit_of_work() as db_service:
+        # Удаляем старые счета
+        old_accounts = get_accounts(user_id)
+        for account in old_accounts:
+            db_service.delete_account(account['id'])
+        
+        # Добавляем новые
+        for name, data in accounts.items():
+            add_account(user_id, name, data['currency'], data['amount'])
+
+# ──────────────────────────────────────────────────────────────────────────────
+# АСИНХРОННЫЕ ВЕРСИИ
+# Для async-обработчиков: <функция>_async выполняет ту же функцию в
+# async_unit_of_work — запросы и commit идут через асинхронный драйвер и не
+# блокируют цикл событий. Несколько вызовов внутри одного
+# `async with async_unit_of_work()` делят сессию и транзакцию.
+# ──────────────────────────────────────────────────────────────────────────────
+
+def _awaitable(func):
+    @functools.wraps(func)
+    async def call(*args, **kwargs):
+        async with async_unit_of_work() as db_service:
+            return await db_service.run_sync(func, *args, **kwargs)
+    call.__name__ = call.__qualname__ = f"{func.__name__}_async"
+    return call
+
+add_transaction_async = _awaitable(add_transaction)
+get_transactions_async = _awaitable(get_transactions)
+get_last_transaction_async = _awaitable(get_last_transaction)
+delete_transaction_async = _awaitable(delete_transaction)
+update_transaction_async = _awaitable(update_transaction)
+add_account_async = _awaitable(add_account)
+get_accounts_async = _awaitable(get_accounts)
+set_balance_async = _awaitable(set_balance)
+get_balance_async = _awaitable(get_balance)
+add_rule_async = _awaitable(add_rule)
+get_rules_async = _awaitable(get_rules)
+delete_rule_async = _awaitable(delete_rule)
+get_user_stats_async = _awaitable(get_user_stats)
+get_category_stats_async = _awaitable(get_category_stats)
+get_monthly_stats_async = _awaitable(get_monthly_stats)
+get_merchant_stats_async = _awaitable(get_merchant_stats)
+get_currency_stats_async = _awaitable(get_currency_stats)
+get_monthly_summary_async = _awaitable(get_monthly_summary)
+load_rules_async = _awaitable(load_rules)
+save_rules_async = _awaitable(save_rules)
+load_accounts_async = _awaitable(load_accounts)
+save_accounts_async = _awaitable(save_accounts)
+
+async def iter_transactions_async(user_id: int, chunk: int = 1000, start_date: datetime = None,
+                                  end_date: datetime = None) -> AsyncIterator[Dict[str, Any]]:
+    """Все транзакции пользователя потоком (см. iter_transactions), пачка — своя единица работы"""
+    after = None
+    while True:
+        async with async_unit_of_work() as db_service:
+            rows = await db_service.get_transactions(user_id, chunk, after=after, start_date=start_date,
+                                                     end_date=end_date, descending=False)
+        for row in rows:
+            yield row._asdict()
+        if len(rows) < chunk:
+            return
+        after = transaction_cursor(rows[-1])
+
+async def export_to_csv_async(user_id: int) -> Optional[str]:
+    """Экспорт в CSV (см. export_to_csv) для async-обработчиков.
+
+    Транзакции читаются через iter_transactions_async, а открытие, запись и
+    закрытие файла идут в потоке (asyncio.to_thread) — пачками по
+    _EXPORT_CHUNK строк, так что цикл событий не ждёт диск.
+    """
+    temp_file, writer = await asyncio.to_thread(_open_export)
+    written, batch = 0, []
+    try:
+        async for t in iter_transactions_async(user_id, chunk=_EXPORT_CHUNK):
+            batch.append(_export_row(t))
+            if len(batch) >= _EXPORT_CHUNK:
+                await asyncio.to_thread(writer.writerows, batch)
+                written, batch = written + len(batch), []
+        if batch:
+            await asyncio.to_thread(writer.writerows, batch)
+            written += len(batch)
+    except BaseException:
+        await asyncio.to_thread(_close_export, temp_file, written, False)
+        raise
+    return await asyncio.to_thread(_close_export, temp_file, written)
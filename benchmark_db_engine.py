@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+"""
+Бенчмарк настроек движка SQLite (app/database/engine.py)
+
+Сравнивает create_engine(url) по умолчанию (rollback-журнал,
+synchronous=FULL) и create_database_engine(url) (WAL, synchronous=NORMAL,
+mmap, кэш страниц, busy_timeout) на одинаковых временных базах:
+
+  вставка по одной   — commit на каждую транзакцию, как в боте
+  вставка пачками    — executemany по --batch строк в одной транзакции
+  чтение             — страницы get_transactions и полный iter_transactions
+  чтение при записи  — страницы get_transactions, пока другой поток пишет
+
+    python benchmark_db_engine.py --single 2000 --rows 200000
+"""
+import os
+import sys
+import time
+import random
+import argparse
+import tempfile
+import threading
+from datetime import datetime, timedelta
+
+# Добавляем текущую директорию в Python path
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from sqlalchemy import create_engine, insert
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import sessionmaker
+
+from app.database.engine import create_database_engine
+from app.database.models import Base, User, Transaction
+from app.database.service import DatabaseService
+
+USERS = 50
+
+
+def _row(rnd: random.Random) -> dict:
+    return {
+        "user_id": rnd.randint(1, USERS),
+        "date": datetime(2020, 1, 1) + timedelta(minutes=rnd.randint(0, 4 * 365 * 24 * 60)),
+        "total": round(rnd.uniform(1, 200), 2),
+        "currency": "EUR",
+        "category": rnd.choice(["Продукты", "Транспорт", "Кафе", "Дом"]),
+        "merchant": f"m{rnd.randint(1, 300)}",
+        "transaction_type": "expense",
+        "is_verified": False,
+    }
+
+
+def _rate(count: int, seconds: float) -> str:
+    return f"{count / seconds:10,.0f} оп/с"
+
+
+def _run(engine, args) -> dict:
+    rnd = random.Random(42)
+    Base.metadata.create_all(engine)
+    Session = sessionmaker(bind=engine, expire_on_commit=False)
+    results = {}
+
+    with engine.begin() as conn:
+        conn.execute(insert(User), [{"id": u, "telegram_id": u} for u in range(1, USERS + 1)])
+
+    # Вставка по одной: commit на каждую запись
+    with Session() as session:
+        service = DatabaseService(session)
+        started = time.perf_counter()
+        for _ in range(args.single):
+            service.create_transaction(**{k: v for k, v in _row(rnd).items() if k != "is_verified"})
+        results["вставка по одной"] = _rate(args.single, time.perf_counter() - started)
+
+    # Вставка пачками
+    started = time.perf_counter()
+    for offset in range(0, args.rows, args.batch):
+        with engine.begin() as conn:
+            conn.execute(insert(Transaction), [_row(rnd) for _ in range(min(args.batch, args.rows - offset))])
+    results["вставка пачками"] = _rate(args.rows, time.perf_counter() - started)
+
+    # Чтение
+    with Session() as session:
+        service = DatabaseService(session)
+        started = time.perf_counter()
+        for i in range(args.reads):
+            service.get_transactions(1 + i % USERS, limit=100)
+        results["чтение страниц"] = _rate(args.reads, time.perf_counter() - started)
+        started = time.perf_counter()
+        count = sum(1 for _ in service.iter_transactions(1, chunk=1000))
+        results["iter_transactions"] = _rate(count, time.perf_counter() - started)
+
+    # Чтение, пока другой поток пишет
+    stop = threading.Event()
+    errors = []
+
+    def writer():
+        wrnd = random.Random(7)
+        while not stop.is_set():
+            try:
+                with engine.begin() as conn:
+                    conn.execute(insert(Transaction), [_row(wrnd) for _ in range(200)])
+            except OperationalError as e:
+                errors.append(e)
+
+    thread = threading.Thread(target=writer)
+    thread.start()
+    reads = 0
+    started = time.perf_counter()
+    with Session() as session:
+        service = DatabaseService(session)
+        while time.perf_counter() - started < args.seconds:
+            try:
+                service.get_transactions(1 + reads % USERS, limit=100)
+                session.rollback()
+                reads += 1
+            except OperationalError as e:
+                errors.append(e)
+                session.rollback()
+    stop.set()
+    thread.join()
+    results["чтение при записи"] = _rate(reads, args.seconds) + f"  (ошибок блокировки: {len(errors)})"
+    engine.dispose()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--single", type=int, default=2000, help="вставок с commit на каждую")
+    parser.add_argument("--rows", type=int, default=200_000, help="строк для вставки пачками")
+    parser.add_argument("--batch", type=int, default=5000)
+    parser.add_argument("--reads", type=int, default=2000, help="запросов страниц get_transactions")
+    parser.add_argument("--seconds", type=float, default=3.0, help="длительность чтения при записи")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        results = {}
+        for name, factory in (("по умолчанию", create_engine), ("настроенный", create_database_engine)):
+            print(f"⏱️ Движок: {name}...")
+            results[name] = _run(factory(f"sqlite:///{os.path.join(tmp, name + '.db')}"), args)
+
+    for test in results["по умолчанию"]:
+        print(f"\n🔎 {test}")
+        for name, values in results.items():
+            print(f"   {name:13} {values[test]}")
+
+
+if __name__ == "__main__":
+    main()
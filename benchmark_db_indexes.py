@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+"""
+Бенчмарк индексов таблицы transactions (миграция 0002_transaction_indexes)
+
+Создаёт временную SQLite-базу по миграции 0001_baseline, заливает N
+транзакций (по умолчанию 1 000 000) и для запросов DatabaseService
+печатает план (EXPLAIN QUERY PLAN) и время — до и после `alembic upgrade
+head`. До миграции планы — SCAN transactions, после — SEARCH по индексам.
+
+    python benchmark_db_indexes.py --rows 1000000 --users 1000
+"""
+import os
+import sys
+import time
+import random
+import argparse
+import tempfile
+import statistics
+from datetime import datetime, timedelta
+
+# Добавляем текущую директорию в Python path
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from alembic import command
+from alembic.config import Config
+from sqlalchemy import create_engine, event, insert
+from sqlalchemy.orm import sessionmaker
+
+from app.database.models import User, Transaction
+from app.database.service import DatabaseService
+
+CATEGORIES = ["Продукты", "Транспорт", "Кафе", "Дом", "Здоровье", "Развлечения", "Одежда", "Связь"]
+CHUNK = 50_000
+
+
+def _alembic(url: str, connection) -> Config:
+    cfg = Config(os.path.join(os.path.dirname(os.path.abspath(__file__)), "alembic.ini"))
+    cfg.set_main_option("sqlalchemy.url", url)
+    cfg.attributes["connection"] = connection
+    cfg.attributes["configure_logger"] = False
+    return cfg
+
+
+def _fill(engine, rows: int, users: int):
+    rnd = random.Random(42)
+    start = datetime(2020, 1, 1)
+    with engine.begin() as conn:
+        conn.execute(insert(User.__table__), [{"id": u, "telegram_id": 1_000_000 + u} for u in range(1, users + 1)])
+        for offset in range(0, rows, CHUNK):
+            batch = []
+            for _ in range(min(CHUNK, rows - offset)):
+                income = rnd.random() < 0.1
+                batch.append({
+                    "user_id": rnd.randint(1, users),
+                    "date": start + timedelta(minutes=rnd.randint(0, 5 * 365 * 24 * 60)),
+                    "total": round(rnd.uniform(1, 3000 if income else 200), 2),
+                    "currency": "EUR",
+                    "category": rnd.choice(CATEGORIES),
+                    "merchant": f"m{rnd.randint(1, 500)}",
+                    "transaction_type": "income" if income else "expense",
+                    "is_verified": False,
+                })
+            conn.execute(insert(Transaction.__table__), batch)
+        conn.exec_driver_sql("ANALYZE")
+
+
+def _queries(user_id: int):
+    since, until = datetime(2023, 1, 1), datetime(2023, 3, 31)
+    return {
+        "get_transactions": lambda s: s.get_transactions(user_id, limit=100),
+        "get_transactions(type)": lambda s: s.get_transactions(user_id, limit=100, transaction_type="income"),
+        "by_date_range": lambda s: s.get_transactions_by_date_range(user_id, since, until),
+        "get_category_stats": lambda s: s.get_category_stats(user_id, since, until),
+    }
+
+
+def _measure(engine, user_id: int, repeat: int) -> dict:
+    """{запрос: (план, медиана мс)}"""
+    statements = []
+
+    def capture(conn, cursor, statement, parameters, context, executemany):
+        statements.append((statement, parameters))
+
+    results = {}
+    session = sessionmaker(bind=engine)()
+    service = DatabaseService(session)
+    try:
+        for name, query in _queries(user_id).items():
+            statements.clear()
+            event.listen(engine, "before_cursor_execute", capture)
+            query(service)
+            event.remove(engine, "before_cursor_execute", capture)
+            sql, params = statements[-1]
+            plan = session.connection().exec_driver_sql(f"EXPLAIN QUERY PLAN {sql}", params).fetchall()
+            times = []
+            for _ in range(repeat):
+                started = time.perf_counter()
+                query(service)
+                times.append((time.perf_counter() - started) * 1000)
+                session.expunge_all()
+            results[name] = ("; ".join(row[-1] for row in plan), statistics.median(times))
+    finally:
+        session.close()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=1_000_000)
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        url = f"sqlite:///{os.path.join(tmp, 'bench.db')}"
+        engine = create_engine(url)
+        with engine.begin() as conn:
+            command.upgrade(_alembic(url, conn), "0001_baseline")
+
+        print(f"📥 Заливаем {args.rows:,} транзакций ({args.users} пользователей)...")
+        started = time.perf_counter()
+        _fill(engine, args.rows, args.users)
+        print(f"   готово за {time.perf_counter() - started:.1f} с")
+
+        before = _measure(engine, 1, args.repeat)
+        with engine.begin() as conn:
+            command.upgrade(_alembic(url, conn), "head")
+            conn.exec_driver_sql("ANALYZE")
+        after = _measure(engine, 1, args.repeat)
+        engine.dispose()
+
+    for name in before:
+        print(f"\n🔎 {name}")
+        print(f"   до:    {before[name][1]:9.2f} мс  {before[name][0]}")
+        print(f"   после: {after[name][1]:9.2f} мс  {after[name][0]}")
+
+
+if __name__ == "__main__":
+    main()
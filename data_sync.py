@@ -14,6 +14,9 @@ from datetime import datetime
 from typing import Dict, Any
 import logging
 
+from app import locking
+from app.storage import iter_user_dirs
+
 # Настройка логирования
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -75,9 +78,10 @@ class DataSync:
             message = f"Auto-sync data: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}"
         
         try:
-            # Добавляем все файлы данных
-            subprocess.run(["git", "add", str(self.data_dir)], 
-                         cwd=self.repo_dir, check=True, capture_output=True)
+            # Добавляем все файлы данных (бот в это время может только читать)
+            with locking.lock_dirs(d for _, d in iter_user_dirs(str(self.data_dir))):
+                subprocess.run(["git", "add", str(self.data_dir)], 
+                             cwd=self.repo_dir, check=True, capture_output=True)
             
             # Коммитим изменения
             subprocess.run(["git", "commit", "-m", message], 
@@ -101,8 +105,13 @@ class DataSync:
     def pull_changes(self) -> bool:
         """Получение изменений из репозитория"""
         try:
-            result = subprocess.run(["git", "pull", "origin", "main"], 
+            # Сеть — без блокировок, слияние файлов — под блокировкой на запись
+            result = subprocess.run(["git", "fetch", "origin", "main"], 
                                   cwd=self.repo_dir, capture_output=True, text=True)
+            if result.returncode == 0:
+                with locking.lock_dirs((d for _, d in iter_user_dirs(str(self.data_dir))), write=True):
+                    result = subprocess.run(["git", "merge", "FETCH_HEAD"], 
+                                          cwd=self.repo_dir, capture_output=True, text=True)
             if result.returncode == 0:
                 logger.info("Изменения получены из GitHub")
                 return True
@@ -22,6 +22,10 @@ def main():
     try:
         # Создаем таблицы
         init_database()
+        # Схема создана по текущей модели — все миграции считаем применёнными
+        from alembic import command
+        from alembic.config import Config
+        command.stamp(Config(os.path.join(os.path.dirname(os.path.abspath(__file__)), "alembic.ini")), "head")
         print("✅ База данных успешно инициализирована!")
         print("📊 Созданы таблицы: users, accounts, transactions, rules, balances")
         
@@ -19,6 +19,9 @@ from telegram.ext import (
 # Наши модули
 from app.config import config
 from app.logger import get_logger
+from app.backends import flush_on_shutdown
+from app.services.compaction import schedule_compaction
+from app.services.balance_retention import schedule_balance_retention
 from app.commands import (
     start_command, menu_command, hide_menu_command, export_csv_command,
     rules_list_command, setcat_command, delrule_command, setbalance_command,
@@ -250,11 +253,17 @@ def main():
     
     try:
         # Создаем приложение
-        app = Application.builder().token(config.bot.token).build()
+        app = Application.builder().token(config.bot.token).post_shutdown(flush_on_shutdown).build()
         
         # Настраиваем обработчики
         setup_handlers(app)
         
+        # Плановое сжатие CSV
+        schedule_compaction(app)
+        
+        # Плановое прореживание истории балансов в базе
+        schedule_balance_retention(app)
+        
         # Добавляем обработчик ошибок
         app.add_error_handler(error_handler)
         
@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+"""
+Перевод finance.csv всех пользователей в помесячные партиции data/<uid>/tx/
+
+Запускать при остановленном боте. Перед миграцией рекомендуется сделать
+резервную копию (backup_data.py).
+"""
+import os
+import sys
+
+# Добавляем текущую директорию в Python path
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from app import storage
+
+
+def main():
+    """Главная функция миграции"""
+    print("🚀 Перевод транзакций в помесячные партиции...")
+
+    data_dir = storage.DATA_DIR
+    if not os.path.isdir(data_dir):
+        print(f"❌ Папка {data_dir} не найдена")
+        return
+
+    user_ids = storage.list_user_ids()
+    if not user_ids:
+        print("❌ Пользователи не найдены в папке data")
+        return
+
+    print(f"👥 Найдено пользователей: {len(user_ids)}")
+
+    migrated_users = migrated_rows = 0
+    for user_id in user_ids:
+        if storage.is_partitioned(user_id):
+            print(f"⏭ Пользователь {user_id}: уже в помесячной раскладке")
+            continue
+        try:
+            rows = storage.migrate_to_partitions(user_id)
+            migrated_users += 1
+            migrated_rows += rows
+            print(f"✅ Пользователь {user_id}: {rows} транзакций")
+        except Exception as e:
+            print(f"❌ Ошибка при миграции пользователя {user_id}: {e}")
+
+    print("\n🎉 Миграция завершена!")
+    print(f"   👥 Пользователей: {migrated_users}")
+    print(f"   💰 Транзакций: {migrated_rows}")
+    print("\n💡 Для новых пользователей установите STORAGE_LAYOUT=monthly")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+"""Исходная схема: users, accounts, transactions, rules, balances
+
+Базы, созданные раньше через create_all (init_database.py), уже содержат
+эти таблицы — миграция создаёт только недостающие, поэтому
+`alembic upgrade head` подходит и для новых, и для существующих баз.
+
+Revision ID: 0001_baseline
+Revises:
+Create Date: 2026-10-17
+"""
+from alembic import op
+import sqlalchemy as sa
+
+revision = "0001_baseline"
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+def _timestamps():
+    return [sa.Column("created_at", sa.DateTime(), nullable=True),
+            sa.Column("updated_at", sa.DateTime(), nullable=True)]
+
+
+def upgrade() -> None:
+    existing = set(sa.inspect(op.get_bind()).get_table_names())
+
+    if "users" not in existing:
+        op.create_table(
+            "users",
+            sa.Column("id", sa.Integer(), primary_key=True),
+            sa.Column("telegram_id", sa.Integer(), nullable=False),
+            sa.Column("username", sa.String(255), nullable=True),
+            sa.Column("first_name", sa.String(255), nullable=True),
+            sa.Column("last_name", sa.String(255), nullable=True),
+            *_timestamps(),
+        )
+        op.create_index("ix_users_id", "users", ["id"])
+        op.create_index("ix_users_telegram_id", "users", ["telegram_id"], unique=True)
+
+    if "accounts" not in existing:
+        op.create_table(
+            "accounts",
+            sa.Column("id", sa.Integer(), primary_key=True),
+            sa.Column("user_id", sa.Integer(), sa.ForeignKey("users.id"), nullable=False),
+            sa.Column("name", sa.String(255), nullable=False),
+            sa.Column("currency", sa.String(10), nullable=False),
+            sa.Column("balance", sa.Float(), nullable=True),
+            sa.Column("is_active", sa.Boolean(), nullable=True),
+            *_timestamps(),
+        )
+        op.create_index("ix_accounts_id", "accounts", ["id"])
+
+    if "transactions" not in existing:
+        op.create_table(
+            "transactions",
+            sa.Column("id", sa.Integer(), primary_key=True),
+            sa.Column("user_id", sa.Integer(), sa.ForeignKey("users.id"), nullable=False),
+            sa.Column("account_id", sa.Integer(), sa.ForeignKey("accounts.id"), nullable=True),
+            sa.Column("date", sa.DateTime(), nullable=False),
+            sa.Column("merchant", sa.String(255), nullable=True),
+            sa.Column("total", sa.Float(), nullable=False),
+            sa.Column("currency", sa.String(10), nullable=False),
+            sa.Column("category", sa.String(100), nullable=True),
+            sa.Column("payment_method", sa.String(100), nullable=True),
+            sa.Column("source", sa.String(255), nullable=True),
+            sa.Column("notes", sa.Text(), nullable=True),
+            sa.Column("transaction_type", sa.String(20), nullable=False),
+            sa.Column("is_verified", sa.Boolean(), nullable=True),
+            *_timestamps(),
+        )
+        op.create_index("ix_transactions_id", "transactions", ["id"])
+
+    if "rules" not in existing:
+        op.create_table(
+            "rules",
+            sa.Column("id", sa.Integer(), primary_key=True),
+            sa.Column("user_id", sa.Integer(), sa.ForeignKey("users.id"), nullable=False),
+            sa.Column("category", sa.String(100), nullable=False),
+            sa.Column("match_conditions", sa.Text(), nullable=False),
+            sa.Column("is_active", sa.Boolean(), nullable=True),
+            *_timestamps(),
+        )
+        op.create_index("ix_rules_id", "rules", ["id"])
+
+    if "balances" not in existing:
+        op.create_table(
+            "balances",
+            sa.Column("id", sa.Integer(), primary_key=True),
+            sa.Column("user_id", sa.Integer(), sa.ForeignKey("users.id"), nullable=False),
+            sa.Column("account_id", sa.Integer(), sa.ForeignKey("accounts.id"), nullable=False),
+            sa.Column("balance", sa.Float(), nullable=False),
+            sa.Column("currency", sa.String(10), nullable=False),
+            sa.Column("date", sa.DateTime(), nullable=False),
+        )
+        op.create_index("ix_balances_id", "balances", ["id"])
+
+
+def downgrade() -> None:
+    for table in ("balances", "rules", "transactions", "accounts", "users"):
+        op.drop_table(table)
@@ -0,0 +1,34 @@
+"""Составные индексы для горячих запросов по транзакциям
+
+get_transactions / get_transactions_by_date_range фильтруют по user_id и
+date и сортируют по date; с фильтром по типу — ещё и по transaction_type;
+get_category_stats группирует по category. Без индексов каждый такой
+запрос — полный проход по transactions.
+
+Revision ID: 0002_transaction_indexes
+Revises: 0001_baseline
+Create Date: 2026-10-17
+"""
+from alembic import op
+
+revision = "0002_transaction_indexes"
+down_revision = "0001_baseline"
+branch_labels = None
+depends_on = None
+
+INDEXES = {
+    "ix_transactions_user_date": ["user_id", "date"],
+    "ix_transactions_user_type_date": ["user_id", "transaction_type", "date"],
+    "ix_transactions_user_category": ["user_id", "category"],
+}
+
+
+def upgrade() -> None:
+    # if_not_exists: базы, созданные create_all по новой модели, уже с индексами
+    for name, columns in INDEXES.items():
+        op.create_index(name, "transactions", columns, if_not_exists=True)
+
+
+def downgrade() -> None:
+    for name in INDEXES:
+        op.drop_index(name, table_name="transactions", if_exists=True)
@@ -0,0 +1,30 @@
+"""Таблица migration_progress — возобновляемый перенос данных из файлов
+
+Revision ID: 0003_migration_progress
+Revises: 0002_transaction_indexes
+Create Date: 2026-10-17
+"""
+from alembic import op
+import sqlalchemy as sa
+
+revision = "0003_migration_progress"
+down_revision = "0002_transaction_indexes"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    if "migration_progress" in sa.inspect(op.get_bind()).get_table_names():
+        return
+    op.create_table(
+        "migration_progress",
+        sa.Column("telegram_id", sa.Integer(), primary_key=True),
+        sa.Column("user_id", sa.Integer(), sa.ForeignKey("users.id"), nullable=False),
+        sa.Column("rows_done", sa.Integer(), nullable=False),
+        sa.Column("finished", sa.Boolean(), nullable=False),
+        sa.Column("updated_at", sa.DateTime(), nullable=True),
+    )
+
+
+def downgrade() -> None:
+    op.drop_table("migration_progress")
@@ -0,0 +1,52 @@
+"""Таблица monthly_summary — помесячные итоги транзакций
+
+Создаёт таблицу и заполняет её по уже существующим транзакциям; дальше
+итоги поддерживает DatabaseService.
+
+Revision ID: 0004_monthly_summary
+Revises: 0003_migration_progress
+Create Date: 2026-10-17
+"""
+from alembic import op
+import sqlalchemy as sa
+
+revision = "0004_monthly_summary"
+down_revision = "0003_migration_progress"
+branch_labels = None
+depends_on = None
+
+MONTH = {
+    "sqlite": "strftime('%Y-%m', date)",
+    "mysql": "date_format(date, '%Y-%m')",
+    "mariadb": "date_format(date, '%Y-%m')",
+}
+
+
+def upgrade() -> None:
+    bind = op.get_bind()
+    if "monthly_summary" not in sa.inspect(bind).get_table_names():
+        op.create_table(
+            "monthly_summary",
+            sa.Column("user_id", sa.Integer(), sa.ForeignKey("users.id"), primary_key=True),
+            sa.Column("month", sa.String(7), primary_key=True),
+            sa.Column("transaction_type", sa.String(20), primary_key=True),
+            sa.Column("category", sa.String(100), primary_key=True),
+            sa.Column("currency", sa.String(10), primary_key=True),
+            sa.Column("total", sa.Float(), nullable=False),
+            sa.Column("count", sa.Integer(), nullable=False),
+            sa.Column("min_total", sa.Float(), nullable=False),
+            sa.Column("max_total", sa.Float(), nullable=False),
+        )
+    month = MONTH.get(bind.dialect.name, "to_char(date, 'YYYY-MM')")
+    op.execute("DELETE FROM monthly_summary")
+    op.execute(
+        "INSERT INTO monthly_summary (user_id, month, transaction_type, category, currency,"
+        " total, count, min_total, max_total)"
+        f" SELECT user_id, {month}, transaction_type, coalesce(category, ''), currency,"
+        " sum(total), count(*), min(total), max(total) FROM transactions"
+        f" GROUP BY user_id, {month}, transaction_type, coalesce(category, ''), currency"
+    )
+
+
+def downgrade() -> None:
+    op.drop_table("monthly_summary")
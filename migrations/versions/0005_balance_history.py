@@ -0,0 +1,24 @@
+"""Индекс истории балансов по (user_id, account_id, date)
+
+Нужен выборке последнего снимка по каждому счёту (get_latest_balances) и
+прореживанию старых снимков (app/database/retention.py).
+
+Revision ID: 0005_balance_history
+Revises: 0004_monthly_summary
+Create Date: 2026-10-17
+"""
+from alembic import op
+
+revision = "0005_balance_history"
+down_revision = "0004_monthly_summary"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.create_index("ix_balances_user_account_date", "balances", ["user_id", "account_id", "date"],
+                    if_not_exists=True)
+
+
+def downgrade() -> None:
+    op.drop_index("ix_balances_user_account_date", table_name="balances", if_exists=True)
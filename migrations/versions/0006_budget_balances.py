@@ -0,0 +1,28 @@
+"""Таблица budget_balances — остатки бюджета для STORAGE_BACKEND=database
+
+Revision ID: 0006_budget_balances
+Revises: 0005_balance_history
+Create Date: 2026-10-17
+"""
+from alembic import op
+import sqlalchemy as sa
+
+revision = "0006_budget_balances"
+down_revision = "0005_balance_history"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    if "budget_balances" in sa.inspect(op.get_bind()).get_table_names():
+        return
+    op.create_table(
+        "budget_balances",
+        sa.Column("user_id", sa.Integer(), sa.ForeignKey("users.id"), primary_key=True),
+        sa.Column("key", sa.String(150), primary_key=True),
+        sa.Column("amount", sa.Float(), nullable=False),
+    )
+
+
+def downgrade() -> None:
+    op.drop_table("budget_balances")
@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+"""
+Перенос папок пользователей в шардированную раскладку data/ab/cd/<uid>/
+(или обратно в data/<uid>/ с флагом --flat)
+
+Запускать при остановленном боте. После переноса установите
+DATA_SHARDING=hashed (или flat). Перед миграцией рекомендуется сделать
+резервную копию (backup_data.py).
+"""
+import os
+import sys
+
+# Добавляем текущую директорию в Python path
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from app import storage
+
+
+def main():
+    """Главная функция миграции"""
+    sharding = "flat" if "--flat" in sys.argv[1:] else "hashed"
+    print(f"🚀 Перенос папок пользователей в раскладку {sharding}...")
+
+    if not os.path.isdir(storage.DATA_DIR):
+        print(f"❌ Папка {storage.DATA_DIR} не найдена")
+        return
+
+    user_ids = storage.list_user_ids()
+    if not user_ids:
+        print("❌ Пользователи не найдены в папке data")
+        return
+
+    print(f"👥 Найдено пользователей: {len(user_ids)}")
+
+    moved = 0
+    for user_id in user_ids:
+        try:
+            target = storage.relocate_user_dir(user_id, sharding)
+        except OSError as e:
+            print(f"❌ Ошибка при переносе пользователя {user_id}: {e}")
+            continue
+        if target is None:
+            print(f"⏭ Пользователь {user_id}: уже на месте")
+            continue
+        moved += 1
+        print(f"✅ Пользователь {user_id}: {target}")
+
+    print("\n🎉 Перенос завершён!")
+    print(f"   👥 Перенесено пользователей: {moved}")
+    print(f"\n💡 Установите DATA_SHARDING={sharding}")
+
+
+if __name__ == "__main__":
+    main()
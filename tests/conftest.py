@@ -10,12 +10,29 @@ from app.config import config
 
 
 @pytest.fixture
-def temp_data_dir():
-    """Временная директория для тестов"""
+def temp_data_dir(monkeypatch):
+    """Временная директория для тестов (подменяет DATA_DIR хранилища)"""
+    import app.storage
     with tempfile.TemporaryDirectory() as temp_dir:
+        monkeypatch.setattr(app.storage, "DATA_DIR", temp_dir)
         yield temp_dir
 
 
+@pytest.fixture
+def engine(tmp_path, monkeypatch):
+    """Временная база SQLite вместо DATABASE_URL (models.engine и SessionLocal)"""
+    from sqlalchemy.orm import sessionmaker
+    from app.database import models
+    from app.database.engine import create_database_engine
+    engine = create_database_engine(f"sqlite:///{tmp_path / 'finance.db'}")
+    models.Base.metadata.create_all(engine)
+    monkeypatch.setattr(models, "engine", engine)
+    monkeypatch.setattr(models, "SessionLocal", sessionmaker(
+        autocommit=False, autoflush=False, expire_on_commit=False, bind=engine))
+    yield engine
+    engine.dispose()
+
+
 @pytest.fixture
 def mock_user():
     """Мок пользователя"""
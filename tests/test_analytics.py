@@ -0,0 +1,76 @@
+# tests/test_analytics.py
+"""Тесты аналитики поверх колоночного кэша транзакций"""
+
+from datetime import date, timedelta
+
+from app.storage import append_row_csv, update_row_from_end
+from app.services.analytics import AnalyticsService, get_columns
+
+
+def _add(user_id, days_ago, merchant, total, category="Food"):
+    append_row_csv(user_id, {
+        "date": (date.today() - timedelta(days=days_ago)).isoformat(),
+        "merchant": merchant, "total": total, "currency": "EUR", "category": category,
+    })
+
+
+class TestTransactionColumns:
+    def test_columns_extend_on_append(self, temp_data_dir, mock_user):
+        user_id = mock_user.id
+        _add(user_id, 1, "Shop", 10)
+        cols = get_columns(user_id)
+        assert len(cols) == 1
+        _add(user_id, 2, "Cafe", 5)
+        assert get_columns(user_id) is cols
+        assert len(cols) == 2
+        assert cols.labels["merchant"] == ["Shop", "Cafe"]
+
+    def test_columns_rebuilt_on_edit(self, temp_data_dir, mock_user):
+        user_id = mock_user.id
+        _add(user_id, 1, "Shop", 10)
+        _add(user_id, 2, "Cafe", 5)
+        get_columns(user_id)
+        update_row_from_end(user_id, 2, total=20)
+        assert list(get_columns(user_id).totals) == [20.0, 5.0]
+
+
+class TestAnalyticsService:
+    def test_empty(self, temp_data_dir, mock_user):
+        service = AnalyticsService(mock_user.id)
+        assert service.get_monthly_trends() == {"error": "Нет данных"}
+        assert service.get_category_analysis() == {"error": "Нет данных за период"}
+
+    def test_category_and_merchant_analysis(self, temp_data_dir, mock_user):
+        user_id = mock_user.id
+        _add(user_id, 1, "Shop", 10, "Food")
+        _add(user_id, 3, "Shop", 20, "Food")
+        _add(user_id, 2, "Cinema", 15, "Fun")
+        _add(user_id, 90, "Old", 100, "Fun")
+        service = AnalyticsService(user_id)
+
+        categories = service.get_category_analysis(30)
+        assert list(categories["categories"]) == ["Food", "Fun"]
+        assert categories["categories"]["Food"] == {"total": 30.0, "count": 2, "avg": 15.0}
+        assert categories["total_spent"] == 45.0
+        assert categories["total_transactions"] == 3
+
+        merchants = service.get_merchant_analysis(30)
+        assert merchants["total_merchants"] == 2
+        assert merchants["merchants"]["Shop"]["last_visit"] == date.today() - timedelta(days=1)
+
+    def test_monthly_trends_and_patterns(self, temp_data_dir, mock_user):
+        user_id = mock_user.id
+        append_row_csv(user_id, {"date": "2024-01-01", "merchant": "A", "total": 10, "category": "Food"})
+        append_row_csv(user_id, {"date": "2024-01-15", "merchant": "B", "total": 5, "category": "Fun"})
+        append_row_csv(user_id, {"date": "2024-02-01", "merchant": "A", "total": 7, "category": "Food"})
+        service = AnalyticsService(user_id)
+
+        trends = service.get_monthly_trends()
+        assert trends["months"] == ["2024-01", "2024-02"]
+        assert trends["data"]["2024-01"] == {"total": 15.0, "count": 2, "categories": {"Food": 10.0, "Fun": 5.0}}
+
+        patterns = service.get_spending_patterns()
+        # 2024-01-01 и 2024-01-15 — понедельники, 2024-02-01 — четверг
+        assert patterns["weekday_pattern"] == {"Понедельник": 15.0, "Четверг": 7.0}
+        assert patterns["monthly_pattern"] == {1: 17.0, 15: 5.0}
+        assert patterns["most_expensive_day"] == "Понедельник"
@@ -0,0 +1,179 @@
+# tests/test_backends.py
+from datetime import date
+
+import pytest
+
+import app.backends as backends
+from app.backends.base import BaseBackend, StorageBackend
+from app.backends.file import FileBackend
+from app.backends.database import DatabaseBackend
+from app.backends.memory import MemoryBackend
+
+UID = 12345
+
+
+@pytest.fixture(params=["file", "database", "memory"])
+def backend(request, temp_data_dir):
+    if request.param == "database":
+        request.getfixturevalue("engine")
+        return DatabaseBackend()
+    return FileBackend() if request.param == "file" else MemoryBackend()
+
+
+def _rows(b):
+    return [(r["merchant"], r["total"], r.id) for r in b.read_rows(UID)]
+
+
+class TestBackends:
+    def test_protocol(self, backend):
+        assert isinstance(backend, StorageBackend)
+
+    def test_primitives_are_abstract(self):
+        class Partial(BaseBackend):
+            def _state_get(self, user_id, kind):
+                return {}
+
+        with pytest.raises(TypeError, match="_post_events"):
+            Partial()
+
+    def test_rows(self, backend):
+        backend.ensure_csv(UID)
+        backend.append_row_csv(UID, {"date": "2024-01-05", "merchant": "A", "total": -10, "currency": "eur"})
+        backend.append_row_csv(UID, {"date": "2024-02-05", "merchant": "B", "total": -20, "currency": "USD",
+                                     "category": "Food"})
+        backend.append_row_csv(UID, {"date": "2024-03-05", "merchant": "C", "total": 5, "currency": "EUR"})
+        assert _rows(backend) == [("A", "-10.0", 1), ("B", "-20.0", 2), ("C", "5.0", 3)]
+        assert [r.merchant for r in backend.iter_rows(UID, start=date(2024, 2, 1))] == ["B", "C"]
+        assert [r.merchant for r in backend.iter_rows(UID, end=date(2024, 3, 1), currency="eur")] == ["A"]
+        assert [r.merchant for r in backend.iter_rows(UID, category="Food")] == ["B"]
+
+        assert backend.find_last_row(UID, lambda r: r["total"].startswith("-"))[0] == 2
+        old, new = backend.update_last_row(UID, total="7,5", currency="usd")
+        assert old["total"] == "5.0" and new["total"] == 7.5 and new["currency"] == "USD"
+        backend.update_row_by_id(UID, 1, merchant="AA")
+        assert backend.delete_row_from_end(UID, 2)["merchant"] == "B"
+        assert _rows(backend) == [("AA", "-10.0", 1), ("C", "7.5", 3)]
+        assert backend.delete_row_by_id(UID, 3)["merchant"] == "C"
+        assert backend.undo_last_row(UID) is True
+        assert backend.undo_last_row(UID) is False
+        with pytest.raises(ValueError):
+            backend.update_last_row(UID, total=1)
+        with pytest.raises(ValueError):
+            backend.update_row_by_id(UID, 99, total=1)
+
+        backend.append_row_csv(UID, {"date": "2024-04-01", "merchant": "D", "total": -1, "currency": "EUR"})
+        assert [r[:2] for r in _rows(backend)] == [("D", "-1.0")]
+        with open(backend.csv_export_path(UID), encoding="utf-8") as f:
+            assert "D" in f.read()
+
+    def test_rows_since(self, backend):
+        backend.append_row_csv(UID, {"date": "2024-01-05", "merchant": "A", "total": -10, "currency": "EUR"})
+        marks, rows, full = backend.rows_since(UID)
+        assert full and [r.merchant for r in rows] == ["A"]
+        backend.append_row_csv(UID, {"date": "2024-01-06", "merchant": "B", "total": -1, "currency": "EUR"})
+        marks, rows, full = backend.rows_since(UID, marks)
+        assert not full and [r.merchant for r in rows] == ["B"]
+        backend.update_last_row(UID, merchant="BB")
+        marks, rows, full = backend.rows_since(UID, marks)
+        assert full and [r.merchant for r in rows] == ["A", "BB"]
+        assert backend.rows_since(UID, marks)[1:] == ([], False)
+
+    def test_accounts_and_balances(self, backend):
+        backend.add_account(UID, "Card", "eur", 100)
+        backend.add_account(UID, "Cash", "EUR", 10)
+        with pytest.raises(ValueError):
+            backend.add_account(UID, "Card", "EUR")
+        backend.set_balance(UID, {"EUR": 50.0, "Food@EUR": 20.0})
+        backend.append_rows_csv(UID, [{"date": "2024-01-01", "merchant": "Shop", "total": -5,
+                                       "currency": "EUR", "category": "Food", "payment_method": "Card"}])
+        assert backend.list_accounts(UID)["Card"] == {"currency": "EUR", "amount": 95.0}
+        assert backend.get_balances(UID) == {"EUR": 45.0, "Food@EUR": 15.0}
+
+        backend.dec_balance(UID, 5, "eur", "Food")
+        backend.rebalance_on_edit(UID, {"total": -5, "currency": "EUR", "category": "Food"},
+                                  {"total": -8, "currency": "EUR", "category": "Food"})
+        assert backend.get_balances(UID) == {"EUR": 43.0, "Food@EUR": 13.0}
+
+        backend.inc_account(UID, "Cash", 5)
+        backend.dec_account(UID, "Cash", 1)
+        backend.adjust_accounts(UID, [("Cash", 2), ("Gone", 100)])
+        assert backend.set_account_amount(UID, "Card", 90)[1]["amount"] == 90.0
+        assert backend.update_account_currency(UID, "Cash", "usd")[1] == {"currency": "USD", "amount": 16.0}
+        assert backend.find_accounts_by_currency(UID, "eur") == ["Card"]
+        assert "Card" in backend.format_accounts(UID)
+
+        backend.update_account_currency(UID, "Cash", "EUR")
+        result = backend.transfer_between_accounts(UID, "Card", "Cash", 30)
+        assert result["to_amount"] == 30
+        assert {n: v["amount"] for n, v in backend.list_accounts(UID).items()} == {"Card": 60.0, "Cash": 46.0}
+        assert [r.source for r in backend.read_rows(UID)][-2:] == ["transfer", "transfer"]
+        assert backend.delete_account(UID, "Cash") == "Cash"
+        with pytest.raises(ValueError):
+            backend.inc_account(UID, "Cash", 1)
+
+    def test_rules(self, backend, sample_rules):
+        backend.save_rules(UID, sample_rules)
+        assert backend.load_rules(UID) == sample_rules
+
+
+class TestDatabaseBackend:
+    def test_sees_migrated_data(self, engine, temp_data_dir):
+        from app import storage
+        from app.database import bulk
+        storage.add_account(UID, "Card", "EUR", 50.0)
+        storage.set_balance(UID, {"EUR": 20.0})
+        storage.append_rows_csv(UID, [{"date": "2024-01-02", "merchant": "Shop", "total": -5,
+                                       "currency": "EUR", "payment_method": "Card"}])
+        storage.flush_all()
+        bulk.migrate_user(UID)
+
+        b = DatabaseBackend()
+        assert [(r.date, r.merchant, r.total) for r in b.read_rows(UID)] == [("2024-01-02", "Shop", "-5.0")]
+        assert b.list_accounts(UID) == {"Card": {"currency": "EUR", "amount": 45.0}}
+        assert b.get_balances(UID) == {"EUR": 15.0}
+
+    def test_summary_and_balance_history(self, engine):
+        from app.database.service import unit_of_work
+        b = DatabaseBackend()
+        b.add_account(UID, "Card", "EUR", 100)
+        b.append_rows_csv(UID, [{"date": "2024-01-01", "merchant": "A", "total": -5, "currency": "EUR",
+                                 "payment_method": "Card"},
+                                {"date": "2024-01-02", "merchant": "B", "total": 7, "currency": "EUR"}])
+        b.update_last_row(UID, total=9)
+        with unit_of_work() as db:
+            user = db.get_user(UID)
+            summary = {(r[1], r[4]) for r in db.get_monthly_summary(user.id)}
+            history = [h[3] for h in db.get_balance_history(user.id)]
+        assert summary == {("expense", 5.0), ("income", 9.0)}
+        assert history == [100.0, 95.0]
+
+    def test_append_posts_deltas_in_sql(self, engine, monkeypatch):
+        b = DatabaseBackend()
+        b.add_account(UID, "Card", "EUR", 100)
+        b.set_balance(UID, {"EUR": 50.0, "Food@EUR": 20.0})
+        # Проводка не читает счета и балансы заранее: приращения считает база
+        with monkeypatch.context() as m:
+            m.setattr(b, "_state_get", lambda *a: pytest.fail("чтение перед записью"))
+            b.append_rows_csv(UID, [{"date": "2024-01-01", "merchant": "A", "total": -5, "currency": "EUR",
+                                     "category": "Food", "payment_method": "Card"},
+                                    {"date": "2024-01-02", "merchant": "B", "total": 7, "currency": "usd"},
+                                    {"date": "2024-01-03", "merchant": "C", "total": -2, "currency": "USD",
+                                     "payment_method": "Gone"}])
+        assert b.list_accounts(UID) == {"Card": {"currency": "EUR", "amount": 95.0}}
+        assert b.get_balances(UID) == {"EUR": 45.0, "Food@EUR": 15.0, "USD": 5.0}
+
+
+class TestSelection:
+    def test_facade_uses_selected_backend(self, monkeypatch):
+        monkeypatch.setattr(backends, "STORAGE_BACKEND", "memory")
+        backends.set_backend(None)
+        try:
+            backends.add_account(UID, "Card", "EUR", 1)
+            assert isinstance(backends.get_backend(), MemoryBackend)
+            assert backends.list_accounts(UID) == {"Card": {"currency": "EUR", "amount": 1.0}}
+        finally:
+            backends.set_backend(None)
+
+    def test_unknown_backend(self):
+        with pytest.raises(ValueError):
+            backends.create_backend("redis")
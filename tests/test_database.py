@@ -0,0 +1,561 @@
+# tests/test_database.py
+import os
+import asyncio
+from datetime import datetime
+
+import pytest
+from alembic import command
+from alembic.config import Config
+from sqlalchemy import create_engine, event, inspect
+
+from app.database.engine import _pool_options
+from app.database.models import Transaction
+from app.database.service import unit_of_work, get_database_service
+
+
+def _count(engine) -> int:
+    with engine.connect() as conn:
+        return conn.exec_driver_sql("SELECT count(*) FROM transactions").scalar()
+
+
+def _add(db_service, user_id: int, total: float):
+    return db_service.create_transaction(user_id=user_id, date=datetime(2024, 1, 1),
+                                         total=total, currency="EUR")
+
+
+class TestEngine:
+    def test_sqlite_pragmas(self, engine):
+        with engine.connect() as conn:
+            pragma = lambda name: conn.exec_driver_sql(f"PRAGMA {name}").scalar()
+            assert pragma("journal_mode") == "wal"
+            assert pragma("synchronous") == 1  # NORMAL
+            assert pragma("busy_timeout") == 5000
+            assert pragma("cache_size") == -65536
+
+    def test_pool_options(self):
+        assert _pool_options("sqlite:///finance.db") == {}
+        options = _pool_options("postgresql://user:pw@localhost/finance")
+        assert options["pool_pre_ping"] and options["pool_size"] == 5
+
+
+class TestUnitOfWork:
+    def test_single_commit(self, engine):
+        commits = []
+        event.listen(engine, "commit", lambda conn: commits.append(1))
+        with unit_of_work() as db_service:
+            user = db_service.get_or_create_user(1, username="u")
+            ids = [_add(db_service, user.id, t).id for t in (1, 2, 3)]
+            # Вложенные вызовы переиспользуют ту же сессию
+            with unit_of_work() as inner:
+                assert inner is db_service
+            assert get_database_service() is db_service
+            assert all(ids) and _count(engine) == 0
+        assert len(commits) == 1
+        assert _count(engine) == 3
+        # Объекты доступны и после закрытия сессии
+        assert user.username == "u"
+
+    def test_rollback_on_error(self, engine):
+        with pytest.raises(RuntimeError):
+            with unit_of_work() as db_service:
+                _add(db_service, 1, 5)
+                raise RuntimeError("boom")
+        assert _count(engine) == 0
+        with unit_of_work() as db_service:
+            assert db_service.db.query(Transaction).count() == 0
+
+    def test_standalone_service(self, engine):
+        with get_database_service() as db_service:
+            assert db_service.autocommit
+            _add(db_service, 1, 5)
+            assert _count(engine) == 1
+        assert not db_service.db.in_transaction()
+
+    def test_storage_new_uses_current_unit(self, engine):
+        from app import storage_new
+        with unit_of_work():
+            storage_new.save_accounts(1, {"Card": {"currency": "EUR", "amount": 10.0}})
+            storage_new.add_transaction(1, datetime(2024, 1, 1), "Shop", -5, "EUR")
+            assert _count(engine) == 0
+        assert _count(engine) == 1
+        assert storage_new.load_accounts(1) == {"Card": {"currency": "EUR", "amount": 10.0}}
+
+    def test_sheets_sync_calls_api_outside_unit(self, engine, monkeypatch):
+        from unittest.mock import MagicMock
+        from app.database.service import _current_service
+        from app.services import google_sheets_sync as sheets
+        with unit_of_work() as db_service:
+            user = db_service.get_or_create_user(7)
+            db_service.create_account(user.id, "Card")
+            for t in (1, 2, 3):
+                _add(db_service, user.id, t)
+        monkeypatch.setattr(sheets, "SHEET_BATCH", 2)
+
+        in_unit, batches = [], []
+
+        def api(*args, **kwargs):
+            # Ошибки листов гасятся внутри sync_user_data, поэтому не assert, а запись
+            in_unit.append(_current_service.get() is not None)
+
+        def append_rows(rows, **kwargs):
+            api()
+            batches.append(rows)
+
+        worksheet = MagicMock(**{"append_row.side_effect": api, "format.side_effect": api,
+                                 "append_rows.side_effect": append_rows})
+        spreadsheet = MagicMock(**{"worksheet.side_effect": LookupError,
+                                   "add_worksheet.return_value": worksheet})
+        sync = sheets.GoogleSheetsSync.__new__(sheets.GoogleSheetsSync)
+        sync.client = MagicMock(**{"open_by_key.return_value": spreadsheet})
+
+        assert sync.sync_user_data(7, "sheet")
+        assert in_unit and not any(in_unit)
+        # Транзакции — пачками по SHEET_BATCH
+        assert [[row[3] for row in batch] for batch in batches[:2]] == [[1.0, 2.0], [3.0]]
+
+
+class TestAsyncService:
+    @pytest.fixture
+    def async_engine(self, engine, monkeypatch):
+        from sqlalchemy.ext.asyncio import async_sessionmaker
+        from app.database import async_service
+        from app.database.engine import create_async_database_engine
+        async_engine = create_async_database_engine(str(engine.url))
+        monkeypatch.setattr(async_service, "AsyncSessionLocal",
+                            async_sessionmaker(async_engine, expire_on_commit=False))
+        yield async_engine
+        asyncio.run(async_engine.dispose())
+
+    def test_unit_of_work(self, engine, async_engine):
+        from app.database.async_service import async_unit_of_work, get_async_database_service
+
+        async def scenario():
+            async with async_unit_of_work() as db_service:
+                user = await db_service.get_or_create_user(1, username="u")
+                for total in (1, 2, 3):
+                    await db_service.create_transaction(user_id=user.id, date=datetime(2024, 1, total),
+                                                        total=total, currency="EUR")
+                async with async_unit_of_work() as inner:
+                    assert inner is db_service and get_async_database_service() is db_service
+                assert _count(engine) == 0
+            with pytest.raises(RuntimeError):
+                async with async_unit_of_work() as db_service:
+                    await db_service.create_transaction(user_id=1, date=datetime(2024, 2, 1),
+                                                        total=9, currency="EUR")
+                    raise RuntimeError("boom")
+            async with get_async_database_service() as db_service:
+                assert db_service.autocommit
+                assert (await db_service.get_user_stats(1))["transactions_count"] == 3
+                assert [row.total async for row in db_service.iter_transactions(1, chunk=2)] == [1.0, 2.0, 3.0]
+            return user
+
+        user = asyncio.run(scenario())
+        assert _count(engine) == 3 and user.username == "u"
+
+    def test_storage_new_async(self, engine, async_engine):
+        from app import storage_new
+
+        async def add(user_id):
+            await storage_new.save_accounts_async(user_id, {"Card": {"currency": "EUR", "amount": 10.0}})
+            await storage_new.add_transaction_async(user_id, datetime(2024, 1, 1), "Shop", -5, "EUR")
+
+        async def scenario():
+            # Параллельные задачи — независимые единицы работы
+            await asyncio.gather(add(1), add(2))
+            assert await storage_new.load_accounts_async(1) == {"Card": {"currency": "EUR", "amount": 10.0}}
+            last = await storage_new.get_last_transaction_async(2)
+            assert (last["merchant"], last["total"], last["transaction_type"]) == ("Shop", 5.0, "expense")
+            assert [t["merchant"] async for t in storage_new.iter_transactions_async(1)] == ["Shop"]
+
+        asyncio.run(scenario())
+        assert _count(engine) == 2
+        assert storage_new.add_transaction_async.__name__ == "add_transaction_async"
+
+    def test_export_to_csv_async(self, engine, async_engine, monkeypatch):
+        from app import storage_new
+        monkeypatch.setattr(storage_new, "_EXPORT_CHUNK", 2)
+        for day in (1, 2, 3):
+            storage_new.add_transaction(1, datetime(2024, 1, day), f"m{day}", -day, "EUR")
+        # Файл пишется в потоке, а не в цикле событий
+        writes = []
+        to_thread = asyncio.to_thread
+        monkeypatch.setattr(asyncio, "to_thread", lambda func, *a: writes.append(func) or to_thread(func, *a))
+
+        path = asyncio.run(storage_new.export_to_csv_async(1))
+        sync_path = storage_new.export_to_csv(1)
+        try:
+            with open(path, encoding="utf-8") as f, open(sync_path, encoding="utf-8") as g:
+                assert f.read() == g.read()
+        finally:
+            os.unlink(path)
+            os.unlink(sync_path)
+        assert len(writes) == 4  # открытие, две пачки, закрытие
+        assert asyncio.run(storage_new.export_to_csv_async(2)) is None
+
+
+class TestAggregates:
+    @pytest.fixture
+    def filled(self, engine):
+        with unit_of_work() as db_service:
+            for day, total, kind, category, merchant, currency in [
+                (datetime(2024, 1, 5), 10.0, "expense", "Food", "Shop", "EUR"),
+                (datetime(2024, 1, 20), 5.0, "expense", "Food", "Shop", "EUR"),
+                (datetime(2024, 2, 1), 7.0, "expense", "Cafe", "Bar", "EUR"),
+                (datetime(2024, 2, 3), 100.0, "income", None, "", "USD"),
+            ]:
+                db_service.create_transaction(user_id=1, date=day, total=total, currency=currency,
+                                              category=category, merchant=merchant, transaction_type=kind)
+            db_service.create_transaction(user_id=2, date=datetime(2024, 1, 1), total=1.0,
+                                          currency="EUR", category="Food")
+        loaded = []
+
+        def on_load(target, context):
+            loaded.append(target)
+
+        event.listen(Transaction, "load", on_load)
+        yield loaded
+        event.remove(Transaction, "load", on_load)
+
+    def test_aggregates_without_orm_objects(self, filled):
+        with unit_of_work() as db_service:
+            assert db_service.get_category_stats(1) == {"Food": 15.0, "Cafe": 7.0}
+            assert db_service.get_category_stats(1, start_date=datetime(2024, 2, 1)) == {"Cafe": 7.0}
+            assert db_service.get_user_stats(1) == {"accounts_count": 0, "transactions_count": 4,
+                                                    "rules_count": 0}
+            assert db_service.get_monthly_stats(1) == [
+                ("2024-01", "expense", "EUR", 15.0, 2),
+                ("2024-02", "expense", "EUR", 7.0, 1),
+                ("2024-02", "income", "USD", 100.0, 1),
+            ]
+            assert db_service.get_monthly_stats(1, transaction_type="income") == [("2024-02", "income", "USD", 100.0, 1)]
+            assert db_service.get_merchant_stats(1) == [("Shop", "EUR", 15.0, 2), ("Bar", "EUR", 7.0, 1)]
+            assert db_service.get_merchant_stats(1, limit=1) == [("Shop", "EUR", 15.0, 2)]
+            assert db_service.get_currency_stats(1) == [("EUR", "expense", 22.0, 3), ("USD", "income", 100.0, 1)]
+        assert filled == []
+
+
+class TestPagination:
+    @pytest.fixture
+    def ids(self, engine):
+        # Одинаковые даты у соседних записей — курсор различает их по id
+        with unit_of_work() as db_service:
+            return [db_service.create_transaction(user_id=1, date=datetime(2024, 1, 1 + i // 2),
+                                                  total=float(i), currency="EUR").id
+                    for i in range(7)]
+
+    def test_keyset_pages(self, ids):
+        from app.database.service import transaction_cursor
+        pages, after = [], None
+        with unit_of_work() as db_service:
+            while True:
+                page = db_service.get_transactions(1, limit=3, after=after)
+                if not page:
+                    break
+                pages.append([row.id for row in page])
+                after = transaction_cursor(page[-1])
+        assert pages == [ids[::-1][:3], ids[::-1][3:6], ids[::-1][6:]]
+
+    def test_iter_transactions(self, ids):
+        from app import storage_new
+        loaded = []
+
+        def on_load(target, context):
+            loaded.append(target)
+
+        event.listen(Transaction, "load", on_load)
+        try:
+            with unit_of_work() as db_service:
+                assert [row.id for row in db_service.iter_transactions(1, chunk=2)] == ids
+                assert [row.total for row in db_service.iter_transactions(1, chunk=3, descending=True)] == \
+                    [6.0, 5.0, 4.0, 3.0, 2.0, 1.0, 0.0]
+                assert [row.id for row in db_service.iter_transactions(
+                    1, chunk=2, start_date=datetime(2024, 1, 2), end_date=datetime(2024, 1, 3))] == ids[2:6]
+            assert [t["id"] for t in storage_new.iter_transactions(1, chunk=2)] == ids
+            assert storage_new.get_transactions(1, limit=1)[0]["total"] == 6.0
+        finally:
+            event.remove(Transaction, "load", on_load)
+        assert loaded == []
+
+    def test_export_streams_everything(self, ids):
+        from app import storage_new
+        path = storage_new.export_to_csv(1)
+        try:
+            with open(path, encoding="utf-8") as f:
+                assert len(f.read().splitlines()) == len(ids) + 1
+        finally:
+            os.unlink(path)
+        assert storage_new.export_to_csv(2) is None
+
+
+class TestBulkMigration:
+    @pytest.fixture
+    def users(self, temp_data_dir):
+        from app import storage
+        from app.rules import save_rules
+        for uid, n in ((101, 7), (102, 3)):
+            storage.add_account(uid, "Card", "EUR", 50.0)
+            storage.append_rows_csv(uid, [{"date": f"2024-01-{i + 1:02d}", "merchant": f"m{i}",
+                                           "total": -i - 1, "currency": "EUR", "category": "Food"}
+                                          for i in range(n)])
+            save_rules(uid, [{"category": "Food", "match": {"merchant": "m0"}}])
+        storage.flush_all()
+        return [101, 102]
+
+    def _totals(self, engine):
+        with engine.connect() as conn:
+            return conn.exec_driver_sql("SELECT total FROM transactions ORDER BY id").scalars().all()
+
+    def test_resume_after_failure(self, engine, users, monkeypatch):
+        from app import storage
+        from app.database import bulk
+        iter_rows = storage.iter_rows
+
+        def broken(user_id, *args, **kwargs):
+            for i, row in enumerate(iter_rows(user_id, *args, **kwargs)):
+                if i == 5:
+                    raise OSError("disk")
+                yield row
+
+        monkeypatch.setattr(storage, "iter_rows", broken)
+        with pytest.raises(OSError):
+            bulk.migrate_user(101, chunk_size=2)
+        # Две полные пачки зафиксированы вместе с прогрессом, третья откатилась
+        assert self._totals(engine) == [1.0, 2.0, 3.0, 4.0]
+
+        monkeypatch.setattr(storage, "iter_rows", iter_rows)
+        stats = bulk.migrate_user(101, chunk_size=2)
+        assert stats["resumed_from"] == 4 and stats["transactions_created"] == 3
+        assert self._totals(engine) == [1.0, 2.0, 3.0, 4.0, 5.0, 6.0, 7.0]
+        assert bulk.migrate_user(101)["skipped"]
+        with engine.connect() as conn:
+            assert conn.exec_driver_sql("SELECT count(*) FROM accounts").scalar() == 1
+            assert conn.exec_driver_sql("SELECT count(*) FROM rules").scalar() == 1
+
+    def test_parallel_users(self, engine, users):
+        from app.database import bulk
+        results = {r["user_id"]: r for r in bulk.migrate_users(users, workers=2, chunk_size=2)}
+        assert {uid: r.get("transactions_created") for uid, r in results.items()} == {101: 7, 102: 3}
+        assert _count(engine) == 10
+        with unit_of_work() as db_service:
+            user_pk = db_service.get_user(101).id
+            assert db_service.get_monthly_summary(user_pk) == [("2024-01", "expense", "Food", "EUR", 28.0, 7, 1.0, 7.0)]
+        assert all(r["skipped"] for r in bulk.migrate_users(users, workers=2))
+
+
+class TestMonthlySummary:
+    def _summary(self, db_service, user_id=1):
+        return db_service.get_monthly_summary(user_id)
+
+    def test_incremental_matches_rebuild(self, engine):
+        with unit_of_work() as db_service:
+            t = [db_service.create_transaction(user_id=1, date=datetime(2024, 1, d), total=total,
+                                               currency="EUR", category=category)
+                 for d, total, category in [(5, 10.0, "Food"), (6, 3.0, "Food"), (7, 8.0, "Food"),
+                                            (8, 4.0, None), (9, 2.0, "")]]
+            assert self._summary(db_service) == [
+                ("2024-01", "expense", "", "EUR", 6.0, 2, 2.0, 4.0),
+                ("2024-01", "expense", "Food", "EUR", 21.0, 3, 3.0, 10.0),
+            ]
+            # Удаление минимума пересчитывает min/max группы
+            db_service.delete_transaction(t[1].id)
+            # Перенос в другой месяц и категорию
+            db_service.update_transaction(t[2].id, date=datetime(2024, 2, 1), category="Cafe")
+            db_service.update_transaction(t[0].id, total=12.0)
+            db_service.delete_transaction(t[3].id)
+            db_service.delete_transaction(t[4].id)
+            incremental = self._summary(db_service)
+            assert incremental == [
+                ("2024-01", "expense", "Food", "EUR", 12.0, 1, 12.0, 12.0),
+                ("2024-02", "expense", "Cafe", "EUR", 8.0, 1, 8.0, 8.0),
+            ]
+            assert db_service.get_monthly_summary(1, month="2024-02") == incremental[1:]
+            db_service.rebuild_monthly_summary(1)
+            assert self._summary(db_service) == incremental
+
+    def test_upsert_per_dialect(self):
+        from sqlalchemy.dialects import mysql, postgresql
+        from app.database.summary import summary_upsert
+        rows = [{"user_id": 1, "month": "2024-01", "transaction_type": "expense", "category": "",
+                 "currency": "EUR", "total": 1.0, "count": 1, "min_total": 1.0, "max_total": 1.0}]
+        pg = str(summary_upsert("postgresql", rows).compile(dialect=postgresql.dialect()))
+        assert "ON CONFLICT (user_id, month, transaction_type, category, currency) DO UPDATE" in pg
+        my = str(summary_upsert("mysql", rows).compile(dialect=mysql.dialect()))
+        assert "ON DUPLICATE KEY UPDATE total = (monthly_summary.total + VALUES(total))" in my
+        assert summary_upsert("mssql", rows) is None
+
+    def test_fallback_retries_update_after_concurrent_insert(self, engine, monkeypatch):
+        from app.database import summary
+        monkeypatch.setattr(summary, "summary_upsert", lambda dialect, rows: None)
+
+        inserted = []
+
+        def concurrent_insert(conn, cursor, statement, *args):
+            # Между неудачным UPDATE и INSERT группу открывает «другая транзакция»
+            if statement.startswith("SAVEPOINT") and not inserted:
+                inserted.append(1)
+                cursor.execute("INSERT INTO monthly_summary VALUES (1, '2024-01', 'expense', '', 'EUR', 7, 1, 7, 7)")
+
+        event.listen(engine, "before_cursor_execute", concurrent_insert)
+        with unit_of_work() as db_service:
+            _add(db_service, 1, 5)
+            assert inserted
+            assert self._summary(db_service) == [("2024-01", "expense", "", "EUR", 12.0, 2, 5.0, 7.0)]
+
+    def test_remove_does_not_read_summary(self, engine):
+        with unit_of_work() as db_service:
+            t = [_add(db_service, 1, total) for total in (5, 7, 9)]
+        statements = []
+
+        def record(conn, cursor, statement, *args):
+            statements.append(" ".join(statement.split()))
+
+        event.listen(engine, "before_cursor_execute", record)
+        with unit_of_work() as db_service:
+            db_service.delete_transaction(t[0].id)
+            db_service.delete_transaction(t[1].id)
+        # Итоги меняются только UPDATE/DELETE: нет окна между чтением и записью
+        assert not [st for st in statements if st.startswith("SELECT") and "FROM monthly_summary" in st]
+        assert any(st.startswith("UPDATE monthly_summary") for st in statements)
+        with unit_of_work() as db_service:
+            assert self._summary(db_service) == [("2024-01", "expense", "", "EUR", 9.0, 1, 9.0, 9.0)]
+            db_service.delete_transaction(t[2].id)
+            assert self._summary(db_service) == []
+
+    def test_rolled_back_with_transaction(self, engine):
+        with pytest.raises(RuntimeError):
+            with unit_of_work() as db_service:
+                _add(db_service, 1, 5)
+                raise RuntimeError("boom")
+        with unit_of_work() as db_service:
+            assert self._summary(db_service) == []
+
+
+class TestBalances:
+    NOW = datetime(2024, 12, 31, 12)
+
+    @pytest.fixture
+    def history(self, engine):
+        from datetime import timedelta
+        from app.database.models import Balance
+        with engine.begin() as conn:
+            conn.execute(Balance.__table__.insert(), [
+                {"user_id": 1, "account_id": account, "balance": float(i), "currency": "EUR",
+                 "date": self.NOW - timedelta(hours=6 * i)}
+                for account in (1, 2) for i in range(4 * 1000)
+            ] + [{"user_id": 2, "account_id": 3, "balance": 1.0, "currency": "USD", "date": self.NOW}])
+
+    def _dates(self, engine, account_id=1):
+        with unit_of_work() as db_service:
+            return [row[0] for row in db_service.get_balance_history(1, account_id=account_id)]
+
+    def test_latest_per_account(self, history):
+        with unit_of_work() as db_service:
+            latest = db_service.get_latest_balances(1)
+            assert [(b.account_id, b.balance) for b in latest] == [(1, 0.0), (2, 0.0)]
+            assert len(db_service.get_balance_history(1, account_id=2)) == 4000
+
+    def test_downsample(self, engine, history):
+        from datetime import timedelta
+        with unit_of_work() as db_service:
+            removed = db_service.downsample_balances(now=self.NOW, user_id=1)
+        dates = self._dates(engine)
+        assert removed == 2 * (4000 - len(dates))
+
+        def buckets(start_days, end_days, key):
+            picked = [d for d in dates if self.NOW - timedelta(days=end_days) <= d < self.NOW - timedelta(days=start_days)]
+            return len(picked), len({key(d) for d in picked})
+
+        assert buckets(0, 7, lambda d: d) == (28, 28)
+        count, days = buckets(7, 90, lambda d: d.date())
+        assert count == days
+        count, weeks = buckets(90, 730, lambda d: d.isocalendar()[:2])
+        assert count == weeks
+        count, months = buckets(730, 10000, lambda d: d.strftime("%Y-%m"))
+        assert count == months
+        with unit_of_work() as db_service:
+            assert [(b.account_id, b.balance) for b in db_service.get_latest_balances(1)] == [(1, 0.0), (2, 0.0)]
+            # Повторный запуск ничего не удаляет, чужие счета не тронуты
+            assert db_service.downsample_balances(now=self.NOW) == 0
+            assert len(db_service.get_balance_history(2)) == 1
+
+    def test_week_does_not_split_at_new_year(self, engine):
+        from datetime import timedelta
+        from app.database.models import Balance
+        # 28.12.2020 (пн) — 03.01.2021 (вс): одна ISO-неделя 2020-W53; 04.01.2021 — уже следующая
+        days = [datetime(2020, 12, 28) + timedelta(days=i) for i in range(8)]
+        with engine.begin() as conn:
+            conn.execute(Balance.__table__.insert(), [
+                {"user_id": 1, "account_id": 1, "balance": float(i), "currency": "EUR", "date": d}
+                for i, d in enumerate(days)])
+        from app.database.retention import downsample_balances
+        with unit_of_work() as db_service:
+            downsample_balances(db_service.db, now=self.NOW, user_id=1, raw_days=0, daily_days=0,
+                                weekly_days=10000)
+        assert self._dates(engine) == [datetime(2021, 1, 3), datetime(2021, 1, 4)]
+
+    def test_retention_job(self, engine, history, monkeypatch):
+        from sqlalchemy.ext.asyncio import async_sessionmaker
+        from app.database import async_service, retention
+        from app.database.engine import create_async_database_engine
+        from app.services.balance_retention import balance_retention_job
+        async_engine = create_async_database_engine(str(engine.url))
+        monkeypatch.setattr(async_service, "AsyncSessionLocal", async_sessionmaker(async_engine, expire_on_commit=False))
+        # Все снимки старше года — остаётся по одному за месяц на счёт
+        monkeypatch.setattr(retention, "BALANCE_KEEP_RAW_DAYS", 0)
+        monkeypatch.setattr(retention, "BALANCE_KEEP_DAILY_DAYS", 0)
+        monkeypatch.setattr(retention, "BALANCE_KEEP_WEEKLY_DAYS", 0)
+
+        async def scenario():
+            try:
+                return await balance_retention_job()
+            finally:
+                await async_engine.dispose()
+
+        assert asyncio.run(scenario()) > 0
+        dates = self._dates(engine)
+        assert len(dates) == len({d.strftime("%Y-%m") for d in dates})
+
+
+def _upgrade(engine, revision: str = "head"):
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    cfg = Config(os.path.join(root, "alembic.ini"))
+    cfg.set_main_option("script_location", os.path.join(root, "migrations"))
+    cfg.attributes["configure_logger"] = False
+    with engine.begin() as conn:
+        cfg.attributes["connection"] = conn
+        command.upgrade(cfg, revision)
+
+
+class TestMigrations:
+    INDEXES = {"ix_transactions_user_date", "ix_transactions_user_type_date", "ix_transactions_user_category"}
+
+    def _indexes(self, engine):
+        return {ix["name"] for ix in inspect(engine).get_indexes("transactions")}
+
+    def test_fresh_database(self, tmp_path):
+        engine = create_engine(f"sqlite:///{tmp_path / 'new.db'}")
+        _upgrade(engine, "0001_baseline")
+        assert not self.INDEXES & self._indexes(engine)
+        _upgrade(engine)
+        assert self.INDEXES <= self._indexes(engine)
+        engine.dispose()
+
+    def test_summary_backfill(self, tmp_path):
+        engine = create_engine(f"sqlite:///{tmp_path / 'old.db'}")
+        _upgrade(engine, "0003_migration_progress")
+        with engine.begin() as conn:
+            conn.exec_driver_sql("INSERT INTO users (id, telegram_id) VALUES (1, 1)")
+            for day, total in ((1, 2.0), (2, 5.0)):
+                conn.exec_driver_sql(
+                    "INSERT INTO transactions (user_id, date, total, currency, transaction_type) "
+                    f"VALUES (1, '2024-03-0{day} 00:00:00.000000', {total}, 'EUR', 'expense')")
+        _upgrade(engine)
+        with engine.connect() as conn:
+            assert conn.exec_driver_sql("SELECT * FROM monthly_summary").fetchall() == [
+                (1, "2024-03", "expense", "", "EUR", 7.0, 2, 2.0, 5.0)]
+        engine.dispose()
+
+    def test_database_from_create_all(self, engine):
+        # Базы из init_database.py: таблицы и индексы уже есть — миграции не падают
+        _upgrade(engine)
+        assert self.INDEXES <= self._indexes(engine)
@@ -0,0 +1,93 @@
+# tests/test_locking.py
+import os
+import sys
+import time
+import threading
+import subprocess
+
+import pytest
+
+from app import locking
+
+
+@pytest.fixture
+def user_dir(tmp_path):
+    d = tmp_path / "12345"
+    d.mkdir()
+    return str(d)
+
+
+class TestDirLock:
+    def test_reentrant_and_upgrade(self, user_dir):
+        with locking.shared(user_dir):
+            with locking.shared(user_dir):
+                with locking.exclusive(user_dir):
+                    with locking.shared(user_dir):
+                        pass
+            lock = locking._dir_lock(user_dir)
+            assert lock.writer is None
+            assert lock.readers == {threading.get_ident(): 1}
+        assert lock.readers == {} and lock.mode is None
+
+    def test_readers_share_writer_waits(self, user_dir):
+        events = []
+        inside = threading.Barrier(2)
+
+        def reader(name):
+            with locking.shared(user_dir):
+                inside.wait(timeout=2)  # оба читателя внутри одновременно
+                time.sleep(0.05)
+                events.append(f"{name}-done")
+
+        def writer():
+            with locking.exclusive(user_dir):
+                events.append("writer")
+
+        readers = [threading.Thread(target=reader, args=(n,)) for n in ("r1", "r2")]
+        for t in readers:
+            t.start()
+        time.sleep(0.01)
+        w = threading.Thread(target=writer)
+        w.start()
+        for t in readers + [w]:
+            t.join(timeout=2)
+        assert events[-1] == "writer"
+        assert sorted(events[:2]) == ["r1-done", "r2-done"]
+
+    @pytest.mark.skipif(locking.fcntl is None, reason="нет fcntl")
+    def test_exclusive_across_processes(self, user_dir):
+        script = (
+            "import fcntl, os, sys, time\n"
+            "fd = os.open(sys.argv[1], os.O_RDWR | os.O_CREAT)\n"
+            "fcntl.flock(fd, fcntl.LOCK_EX)\n"
+            "print('locked', flush=True)\n"
+            "time.sleep(0.3)\n"
+        )
+        child = subprocess.Popen([sys.executable, "-c", script, os.path.join(user_dir, locking.LOCK_FILE)],
+                                 stdout=subprocess.PIPE, text=True)
+        try:
+            assert child.stdout.readline().strip() == "locked"
+            started = time.monotonic()
+            with locking.shared(user_dir):
+                waited = time.monotonic() - started
+        finally:
+            child.wait(timeout=5)
+        assert waited >= 0.1
+
+    def test_lock_dirs(self, tmp_path):
+        dirs = [str(tmp_path / uid) for uid in ("2", "1")]
+        with locking.lock_dirs(dirs, write=True):
+            assert all(locking._dir_lock(d).writer == threading.get_ident() for d in dirs)
+        assert all(locking._dir_lock(d).writer is None for d in dirs)
+
+
+class TestRulesFile:
+    def test_save_rules_is_atomic(self, temp_data_dir):
+        from app.rules import save_rules, load_rules, _rules_path
+        save_rules(1, [{"category": "Food", "match": {"merchant": "Shop"}}])
+        # Сбой посреди записи (значение не сериализуется) — прежний файл цел
+        with pytest.raises(TypeError):
+            save_rules(1, [{"category": "Bad", "match": object()}])
+        assert load_rules(1) == [{"category": "Food", "match": {"merchant": "Shop"}}]
+        folder = os.path.dirname(_rules_path(1))
+        assert [n for n in os.listdir(folder) if n.endswith(".tmp")] == []
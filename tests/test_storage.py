@@ -2,10 +2,21 @@
 import pytest
 import tempfile
 import os
+import csv
+import json
+import asyncio
+from datetime import date
+
+import app.storage as storage
+from app.models import TransactionRecord, row_amount, row_date
 from app.storage import (
     ensure_csv, read_rows, append_row_csv, undo_last_row,
+    update_last_row, update_row_from_end, delete_row_from_end, find_last_row,
+    rows_cache_stats, clear_rows_cache, is_partitioned, migrate_to_partitions, iter_rows,
     set_balance, get_balances, dec_balance,
-    list_accounts, add_account, set_account_amount, dec_account
+    list_accounts, add_account, set_account_amount, dec_account, inc_account,
+    flush_all, user_lock, apply_batch, transfer_between_accounts, append_rows_csv,
+    update_row_by_id, delete_row_by_id
 )
 
 
@@ -45,6 +56,511 @@ class TestCSVOperations:
         assert len(read_rows(user_id)) == 1
 
 
+class TestTailIndex:
+    def _fill(self, user_id, n):
+        for i in range(n):
+            append_row_csv(user_id, {"date": "2024-01-01", "merchant": f"m{i}",
+                                     "total": -(i + 1), "currency": "eur"}, source="test")
+
+    def test_undo_truncates_file(self, temp_data_dir, mock_user):
+        """Undo отрезает последнюю строку, не трогая остальные"""
+        user_id = mock_user.id
+        self._fill(user_id, 3)
+        csv_path = os.path.join(temp_data_dir, str(user_id), "finance.csv")
+        size_before = os.path.getsize(csv_path)
+
+        assert undo_last_row(user_id)
+        assert os.path.getsize(csv_path) < size_before
+        assert [r["merchant"] for r in read_rows(user_id)] == ["m0", "m1"]
+
+        append_row_csv(user_id, {"merchant": "m3", "total": -4, "currency": "EUR"})
+        assert [r["merchant"] for r in read_rows(user_id)] == ["m0", "m1", "m3"]
+
+    def test_undo_empty(self, temp_data_dir, mock_user):
+        ensure_csv(mock_user.id)
+        assert undo_last_row(mock_user.id) is False
+
+    def test_update_row_from_end(self, temp_data_dir, mock_user):
+        """Правка n-й с конца записи меняет только её"""
+        user_id = mock_user.id
+        self._fill(user_id, 5)
+
+        old, new = update_row_from_end(user_id, 3, merchant="Очень длинное новое имя", total="-9,5")
+        assert old["merchant"] == "m2"
+        assert new["total"] == -9.5
+
+        rows = read_rows(user_id)
+        assert [r["merchant"] for r in rows] == ["m0", "m1", "Очень длинное новое имя", "m3", "m4"]
+
+        old, new = update_last_row(user_id, currency="usd")
+        assert old["merchant"] == "m4" and new["currency"] == "USD"
+        assert undo_last_row(user_id)
+        assert read_rows(user_id)[-1]["merchant"] == "m3"
+
+        with pytest.raises(ValueError):
+            update_row_from_end(user_id, 10, merchant="x")
+
+    def test_delete_row_from_end(self, temp_data_dir, mock_user):
+        user_id = mock_user.id
+        self._fill(user_id, 4)
+        removed = delete_row_from_end(user_id, 2)
+        assert removed["merchant"] == "m2"
+        assert [r["merchant"] for r in read_rows(user_id)] == ["m0", "m1", "m3"]
+
+    def test_multiline_notes(self, temp_data_dir, mock_user):
+        """Поля с переводом строки в кавычках не ломают индекс"""
+        user_id = mock_user.id
+        append_row_csv(user_id, {"merchant": "a", "total": 1, "currency": "EUR", "notes": "line1\nline2"})
+        append_row_csv(user_id, {"merchant": "b", "total": 2, "currency": "EUR"})
+        assert undo_last_row(user_id)
+        rows = read_rows(user_id)
+        assert len(rows) == 1 and rows[0]["notes"] == "line1\nline2"
+
+    def test_index_rebuilt_after_external_edit(self, temp_data_dir, mock_user):
+        """Если CSV правили в обход storage, индекс перестраивается"""
+        user_id = mock_user.id
+        self._fill(user_id, 2)
+        csv_path = os.path.join(temp_data_dir, str(user_id), "finance.csv")
+        with open(csv_path, "a", newline="", encoding="utf-8") as f:
+            f.write("2024-02-01,external,-1.0,EUR,,,,\r\n")
+
+        _, new = update_last_row(user_id, merchant="patched")
+        assert [r["merchant"] for r in read_rows(user_id)] == ["m0", "m1", "patched"]
+
+    def test_find_last_row(self, temp_data_dir, mock_user):
+        user_id = mock_user.id
+        append_row_csv(user_id, {"merchant": "income", "total": 100, "currency": "EUR"})
+        self._fill(user_id, 80)
+
+        n, row = find_last_row(user_id, lambda r: float(r["total"]) > 0)
+        assert n == 81 and row["merchant"] == "income"
+        assert find_last_row(user_id, lambda r: r["merchant"] == "nope") is None
+
+
+class TestRowIds:
+    def _fill(self, user_id, n):
+        for i in range(n):
+            append_row_csv(user_id, {"date": "2024-01-01", "merchant": f"m{i}", "total": -1, "currency": "EUR"})
+
+    def test_ids_are_monotonic(self, temp_data_dir, mock_user):
+        user_id = mock_user.id
+        self._fill(user_id, 3)
+        assert [r.id for r in read_rows(user_id)] == [1, 2, 3]
+        undo_last_row(user_id)
+        self._fill(user_id, 1)
+        # Удалённый id повторно не выдаётся
+        assert [r.id for r in read_rows(user_id)] == [1, 2, 4]
+
+    def test_update_in_place(self, temp_data_dir, mock_user):
+        user_id = mock_user.id
+        self._fill(user_id, 5)
+        csv_path = os.path.join(temp_data_dir, str(user_id), "finance.csv")
+        read_rows(user_id)
+        size = os.path.getsize(csv_path)
+
+        old, new = update_row_by_id(user_id, 2, merchant="x")
+        assert old["merchant"] == "m1" and new["merchant"] == "x"
+        assert os.path.getsize(csv_path) == size
+        rows = read_rows(user_id)
+        assert [r["merchant"] for r in rows] == ["m0", "x", "m2", "m3", "m4"]
+        assert [r.id for r in rows] == [1, 2, 3, 4, 5]
+        clear_rows_cache()
+        assert [r["merchant"] for r in read_rows(user_id)] == ["m0", "x", "m2", "m3", "m4"]
+
+    def test_edited_row_exports_clean_id(self, temp_data_dir, mock_user):
+        user_id = mock_user.id
+        self._fill(user_id, 3)
+        # Укороченная строка дополняется пробелами в поле id, чтобы не сдвигать хвост
+        update_row_by_id(user_id, 2, merchant="")
+        with open(storage.csv_export_path(user_id), newline="", encoding="utf-8") as f:
+            exported = list(csv.DictReader(f))
+        assert [(r["id"], r["merchant"]) for r in exported] == [("1", "m0"), ("2", ""), ("3", "m2")]
+
+    def test_update_growing_row_and_delete(self, temp_data_dir, mock_user):
+        user_id = mock_user.id
+        self._fill(user_id, 4)
+        update_row_by_id(user_id, 2, merchant="a much longer merchant name")
+        removed = delete_row_by_id(user_id, 3)
+        assert removed["merchant"] == "m2" and removed["id"] == 3
+        rows = read_rows(user_id)
+        assert [(r.id, r["merchant"]) for r in rows] == [(1, "m0"), (2, "a much longer merchant name"), (4, "m3")]
+        with pytest.raises(ValueError):
+            update_row_by_id(user_id, 3, merchant="gone")
+        # Позиционные операции продолжают работать поверх правок по id
+        assert update_last_row(user_id, merchant="last")[1]["merchant"] == "last"
+
+    def test_legacy_file_backfilled(self, temp_data_dir, mock_user):
+        user_id = mock_user.id
+        user_dir = os.path.join(temp_data_dir, str(user_id))
+        os.makedirs(user_dir)
+        with open(os.path.join(user_dir, "finance.csv"), "w", newline="", encoding="utf-8") as f:
+            f.write("date,merchant,total,currency,category,payment_method,source\r\n"
+                    "2024-01-01,a,-1.0,EUR,,,\r\n2024-01-02,b,-2.0,EUR,,,\r\n")
+        with open(os.path.join(user_dir, "finance.idx"), "wb") as f:
+            f.write(b"\0" * 24)  # индекс старого формата
+
+        update_row_by_id(user_id, 2, merchant="B")
+        append_row_csv(user_id, {"merchant": "c", "total": -3, "currency": "EUR"})
+        assert [(r.id, r["merchant"]) for r in read_rows(user_id)] == [(1, "a"), (2, "B"), (3, "c")]
+
+
+class TestCompaction:
+    def _fill(self, user_id, n=5):
+        for i in range(n):
+            append_row_csv(user_id, {"date": f"2024-03-{i + 1:02d}", "merchant": f"M{i}", "total": -i,
+                                     "currency": "EUR"})
+
+    def test_reclaims_padding_and_keeps_ids(self, temp_data_dir, mock_user):
+        user_id = mock_user.id
+        self._fill(user_id)
+        path = storage._csv_path(user_id)
+        ids = [r.id for r in read_rows(user_id)]
+        # Перенос в конец файла — id последней записи добивается пробелами
+        update_row_by_id(user_id, ids[1], merchant="Longer merchant name")
+        update_row_by_id(user_id, ids[-1], merchant="X")
+        before = os.path.getsize(path)
+        with open(path, "rb") as f:
+            assert b" \r\n" in f.read()
+
+        saved = storage.compact_user(user_id)
+        assert saved > 0 and os.path.getsize(path) == before - saved
+        rows = read_rows(user_id)
+        assert [r.id for r in rows] == ids
+        assert [r["merchant"] for r in rows] == ["M0", "Longer merchant name", "M2", "M3", "X"]
+        assert storage._index_is_valid(path)
+        update_row_by_id(user_id, ids[2], total=-100)
+        assert float(read_rows(user_id)[2]["total"]) == -100.0
+        append_row_csv(user_id, {"date": "2024-03-09", "merchant": "New", "total": 1, "currency": "EUR"})
+        assert read_rows(user_id)[-1].id == ids[-1] + 1
+        assert storage.compact_user(user_id) == 0
+
+    def test_rows_appended_during_pass_are_kept(self, temp_data_dir, mock_user):
+        user_id = mock_user.id
+        self._fill(user_id)
+        ids = [r.id for r in read_rows(user_id)]
+        update_row_by_id(user_id, ids[-1], merchant="X")
+        plan = storage._compact_prepare(storage._csv_path(user_id))
+        append_row_csv(user_id, {"date": "2024-03-09", "merchant": "Late", "total": 1, "currency": "EUR"})
+        assert storage._compact_commit(plan) > 0
+        assert [r["merchant"] for r in read_rows(user_id)][-2:] == ["X", "Late"]
+        assert storage._index_is_valid(storage._csv_path(user_id))
+
+    def test_edit_during_pass_postpones(self, temp_data_dir, mock_user):
+        user_id = mock_user.id
+        self._fill(user_id)
+        ids = [r.id for r in read_rows(user_id)]
+        update_row_by_id(user_id, ids[-1], merchant="X")
+        plan = storage._compact_prepare(storage._csv_path(user_id))
+        update_row_by_id(user_id, ids[0], merchant="Edited")
+        assert storage._compact_commit(plan) == -1
+        assert not os.path.exists(plan["tmp"])
+        assert read_rows(user_id)[0]["merchant"] == "Edited"
+
+    def test_prepare_does_not_rewrite_unindexed_file(self, temp_data_dir, mock_user):
+        user_id = mock_user.id
+        self._fill(user_id)
+        path = storage._csv_path(user_id)
+        ids = [r.id for r in read_rows(user_id)]
+        update_row_by_id(user_id, ids[-1], merchant="X")
+        os.remove(storage._idx_path(path))
+        inode = os.stat(path).st_ino
+        # Без блокировки индекс не перестраивается — сжатие откладывается
+        assert storage._compact_prepare(path) is None
+        assert os.stat(path).st_ino == inode
+        # compact_user чинит индекс под блокировкой и сжимает
+        assert storage.compact_user(user_id) > 0
+        assert [r.id for r in read_rows(user_id)] == ids
+
+    def test_partitions_and_job(self, temp_data_dir, mock_user, monkeypatch):
+        from app.services.compaction import compaction_job
+        monkeypatch.setattr(storage, "STORAGE_LAYOUT", "monthly")
+        monkeypatch.setattr(storage, "ARCHIVE_KEEP_YEARS", 0)
+        user_id = mock_user.id
+        append_row_csv(user_id, {"date": "2024-02-01", "merchant": "Long name", "total": 1, "currency": "EUR"})
+        self._fill(user_id, 3)
+        ids = [r.id for r in read_rows(user_id)]
+        update_row_by_id(user_id, ids[0], merchant="B")
+
+        assert asyncio.run(compaction_job()) > 0
+        assert [r["merchant"] for r in read_rows(user_id)] == ["B", "M0", "M1", "M2"]
+        assert [r.id for r in read_rows(user_id)] == ids
+
+
+class TestSharding:
+    def test_hashed_layout(self, temp_data_dir, mock_user, monkeypatch):
+        monkeypatch.setattr(storage, "DATA_SHARDING", "hashed")
+        user_id = mock_user.id
+        append_row_csv(user_id, {"date": "2024-03-01", "merchant": "Shop", "total": -5, "currency": "EUR"})
+        add_account(user_id, "Cash", "EUR", 10.0)
+
+        path = storage.user_dir(user_id)
+        rel = os.path.relpath(path, temp_data_dir).split(os.sep)
+        assert len(rel) == 3 and rel[2] == str(user_id) and all(len(p) == 2 for p in rel[:2])
+        assert os.path.exists(os.path.join(path, "finance.csv"))
+        assert not os.path.exists(os.path.join(temp_data_dir, str(user_id)))
+        assert storage.list_user_ids() == [user_id]
+
+    def test_relocate_both_ways(self, temp_data_dir, mock_user, monkeypatch):
+        user_id = mock_user.id
+        append_row_csv(user_id, {"date": "2024-03-01", "merchant": "Shop", "total": -5, "currency": "EUR"})
+        add_account(user_id, "Cash", "EUR", 10.0)
+        add_account(99999, "Card", "USD", 1.0)
+
+        monkeypatch.setattr(storage, "DATA_SHARDING", "hashed")
+        # До переноса пользователь читается со старого места
+        assert storage.user_dir(user_id) == os.path.join(temp_data_dir, str(user_id))
+        target = storage.relocate_user_dir(user_id)
+        assert target == storage.user_dir(user_id) != os.path.join(temp_data_dir, str(user_id))
+        assert storage.relocate_user_dir(user_id) is None
+        assert [r["merchant"] for r in read_rows(user_id)] == ["Shop"]
+        assert list_accounts(user_id)["Cash"]["amount"] == 10.0
+        assert storage.list_user_ids() == [user_id, 99999]
+
+        assert storage.relocate_user_dir(user_id, "flat") == os.path.join(temp_data_dir, str(user_id))
+        monkeypatch.setattr(storage, "DATA_SHARDING", "flat")
+        assert list_accounts(user_id)["Cash"]["amount"] == 10.0
+
+
+class TestArchive:
+    @pytest.fixture(params=["single", "monthly"])
+    def layout(self, request, monkeypatch):
+        monkeypatch.setattr(storage, "STORAGE_LAYOUT", request.param)
+        return request.param
+
+    def _fill(self, user_id):
+        rows = [("2022-12-31", "Old"), ("2023-01-05", "A"), ("2023-06-01", "B"),
+                ("", "Today"), (f"{date.today().year}-01-01", "Now")]
+        for d, m in rows:
+            append_row_csv(user_id, {"date": d, "merchant": m, "total": -1, "currency": "EUR"})
+
+    def test_archive_year_moves_rows(self, temp_data_dir, mock_user, layout):
+        user_id = mock_user.id
+        self._fill(user_id)
+        ids = {r["merchant"]: r.id for r in read_rows(user_id)}
+
+        assert storage.archive_year(user_id, 2023) == 2
+        seg = storage._segment_path(user_id, 2023)
+        assert os.path.exists(seg)
+        assert sorted(storage._segment_footer(seg)["months"]) == ["2023-01", "2023-06"]
+        hot = [r["merchant"] for s in storage._data_files(user_id) for r in storage._read_file(s)]
+        assert "A" not in hot and "B" not in hot and "Today" in hot
+
+        rows = read_rows(user_id)
+        assert sorted(r["merchant"] for r in rows) == ["A", "B", "Now", "Old", "Today"]
+        assert {r["merchant"]: r.id for r in rows} == ids
+        assert [r["merchant"] for r in read_rows(user_id, date(2023, 6, 1), date(2023, 7, 1))] == ["B"]
+        with open(storage.csv_export_path(user_id), encoding="utf-8") as f:
+            assert "A," in f.read()
+        with pytest.raises(ValueError):
+            storage.archive_year(user_id, date.today().year)
+
+    def test_current_year_reads_skip_archive(self, temp_data_dir, mock_user, layout, monkeypatch):
+        user_id = mock_user.id
+        self._fill(user_id)
+        assert storage.archive_closed_years(user_id, keep_years=1) == 3
+        assert storage._archived_segments(user_id) == [storage._segment_path(user_id, y) for y in (2022, 2023)]
+        opened = []
+        monkeypatch.setattr(storage, "_read_segment_month", lambda *a: opened.append(a) or [])
+        this_year = date(date.today().year, 1, 1)
+        assert sorted(r["merchant"] for r in read_rows(user_id, this_year)) == ["Now", "Today"]
+        assert opened == []
+
+    def test_rearchive_merges_and_lzma(self, temp_data_dir, mock_user, layout, monkeypatch):
+        monkeypatch.setattr(storage, "ARCHIVE_CODEC", "lzma")
+        user_id = mock_user.id
+        self._fill(user_id)
+        storage.archive_year(user_id, 2023)
+        append_row_csv(user_id, {"date": "2023-06-02", "merchant": "Late", "total": -1, "currency": "EUR"})
+        marks, _, _ = storage.rows_since(user_id)
+        assert storage.archive_year(user_id, 2023) == 1
+        assert storage.rows_since(user_id, marks)[2] is True
+        assert storage._segment_footer(storage._segment_path(user_id, 2023))["codec"] == "lzma"
+        assert [r["merchant"] for r in read_rows(user_id, date(2023, 1, 1), date(2024, 1, 1))] == ["A", "B", "Late"]
+
+
+class TestRowsCache:
+    def test_repeated_reads_hit_cache(self, temp_data_dir, mock_user, sample_receipt_data):
+        """Повторное чтение без изменений файла не парсит CSV заново"""
+        user_id = mock_user.id
+        append_row_csv(user_id, sample_receipt_data, source="test")
+        clear_rows_cache()
+
+        first = read_rows(user_id)
+        second = read_rows(user_id)
+        assert first == second
+        assert rows_cache_stats()["misses"] == 1
+        assert rows_cache_stats()["hits"] == 1
+
+    def test_append_updates_cache(self, temp_data_dir, mock_user, sample_receipt_data):
+        """append_row_csv дописывает строку в кэш вместо сброса"""
+        user_id = mock_user.id
+        append_row_csv(user_id, sample_receipt_data, source="test")
+        clear_rows_cache()
+        read_rows(user_id)
+
+        append_row_csv(user_id, {"merchant": "next", "total": -3, "currency": "eur"}, source="s")
+        rows = read_rows(user_id)
+        assert rows_cache_stats()["hits"] == 1
+        clear_rows_cache()
+        assert rows == read_rows(user_id)
+        assert rows[-1]["total"] == "-3.0" and rows[-1]["currency"] == "EUR"
+
+    def test_rewrite_invalidates_cache(self, temp_data_dir, mock_user, sample_receipt_data):
+        user_id = mock_user.id
+        append_row_csv(user_id, sample_receipt_data, source="a")
+        append_row_csv(user_id, sample_receipt_data, source="b")
+        read_rows(user_id)
+
+        undo_last_row(user_id)
+        assert len(read_rows(user_id)) == 1
+        update_last_row(user_id, merchant="changed")
+        assert read_rows(user_id)[0]["merchant"] == "changed"
+
+    def test_external_change_is_detected(self, temp_data_dir, mock_user, sample_receipt_data):
+        user_id = mock_user.id
+        append_row_csv(user_id, sample_receipt_data, source="a")
+        read_rows(user_id)
+        csv_path = os.path.join(temp_data_dir, str(user_id), "finance.csv")
+        with open(csv_path, "a", newline="", encoding="utf-8") as f:
+            f.write("2024-02-01,external,-1.0,EUR,,,,\r\n")
+        assert read_rows(user_id)[-1]["merchant"] == "external"
+
+
+class TestTransactionRecord:
+    def test_rows_are_records(self, temp_data_dir, mock_user):
+        user_id = mock_user.id
+        append_row_csv(user_id, {"date": "2024-03-01", "merchant": "Shop", "total": "12.5",
+                                 "currency": "eur", "category": "Food"})
+        clear_rows_cache()
+        for row in (read_rows(user_id)[0], next(iter_rows(user_id)), find_last_row(user_id, lambda r: True)[1]):
+            assert isinstance(row, TransactionRecord)
+            assert row.day == date(2024, 3, 1)
+            assert row.amount == 12.5
+            assert row["total"] == "12.5"
+            assert row.get("currency") == "EUR"
+            assert row.get("unknown", "-") == "-"
+            assert dict(row)["merchant"] == "Shop"
+            assert row == {**dict(row)}
+
+    def test_legacy_and_bad_values(self):
+        row = TransactionRecord({"date": "bad", "total": "", "merchant": "X"})
+        assert row.day is None and row.amount is None
+        assert row["notes"] == ""
+        assert row_amount(row) == 0.0
+        assert row_date(row) is None
+        assert row_amount({"total": "3"}) == 3.0
+        assert row_date({"date": "2024-01-02"}) == date(2024, 1, 2)
+        with pytest.raises(KeyError):
+            row["missing"]
+
+
+class TestIterRows:
+    def _fill(self, user_id):
+        for d, cur, cat in [("2024-01-05", "EUR", "food"), ("2024-01-20", "usd", "food"),
+                            ("2024-02-03", "EUR", "fun"), ("bad-date", "EUR", "food")]:
+            append_row_csv(user_id, {"date": d, "merchant": d, "total": -1, "currency": cur, "category": cat})
+
+    def test_filters(self, temp_data_dir, mock_user):
+        user_id = mock_user.id
+        self._fill(user_id)
+        clear_rows_cache()
+
+        assert len(list(iter_rows(user_id))) == 4
+        jan = list(iter_rows(user_id, start=date(2024, 1, 1), end=date(2024, 2, 1)))
+        assert [r["date"] for r in jan] == ["2024-01-05", "2024-01-20"]
+        assert [r["date"] for r in iter_rows(user_id, currency="usd")] == ["2024-01-20"]
+        assert [r["date"] for r in iter_rows(user_id, category="food", currency="EUR")] == ["2024-01-05", "bad-date"]
+        assert rows_cache_stats()["size"] == 0  # потоковое чтение не наполняет кэш
+
+    def test_stops_after_last_partition(self, temp_data_dir, mock_user, monkeypatch):
+        monkeypatch.setattr(storage, "STORAGE_LAYOUT", "monthly")
+        user_id = mock_user.id
+        self._fill(user_id)
+        opened = []
+        real_iter_file = storage._iter_file
+        monkeypatch.setattr(storage, "_iter_file", lambda p: opened.append(os.path.basename(p)) or real_iter_file(p))
+
+        rows = list(iter_rows(user_id, start=date(2024, 1, 10), end=date(2024, 1, 31)))
+        assert [r["date"] for r in rows] == ["2024-01-20"]
+        assert opened == ["2024-01.csv"]
+
+
+class TestMonthlyPartitions:
+    @pytest.fixture(autouse=True)
+    def monthly_layout(self, temp_data_dir, monkeypatch):
+        monkeypatch.setattr(storage, "STORAGE_LAYOUT", "monthly")
+
+    def _tx(self, d, merchant, total=-1):
+        return {"date": d, "merchant": merchant, "total": total, "currency": "EUR"}
+
+    def test_ids_across_partitions(self, temp_data_dir, mock_user):
+        user_id = mock_user.id
+        for d, name in [("2024-01-10", "jan"), ("2024-03-05", "mar"), ("2024-01-20", "jan2")]:
+            append_row_csv(user_id, self._tx(d, name))
+        assert {r["merchant"]: r.id for r in read_rows(user_id)} == {"jan": 1, "jan2": 3, "mar": 2}
+
+        # Смена месяца: запись переезжает в другую партицию с тем же id
+        update_row_by_id(user_id, 1, date="2024-03-01")
+        assert [(r.id, r["merchant"]) for r in read_rows(user_id)] == [(3, "jan2"), (2, "mar"), (1, "jan")]
+        assert update_last_row(user_id, merchant="moved")[0]["merchant"] == "jan"
+        delete_row_by_id(user_id, 3)
+        assert storage._load_manifest(user_id)["partitions"] == {"2024-03": 2}
+        append_row_csv(user_id, self._tx("2024-03-09", "new"))
+        assert read_rows(user_id)[-1].id == 4
+
+    def test_rows_go_to_month_partitions(self, temp_data_dir, mock_user):
+        user_id = mock_user.id
+        append_row_csv(user_id, self._tx("2024-01-10", "jan"))
+        append_row_csv(user_id, self._tx("2024-03-05", "mar"))
+        append_row_csv(user_id, self._tx("2024-01-20", "jan2"))
+
+        tx_dir = os.path.join(temp_data_dir, str(user_id), "tx")
+        assert is_partitioned(user_id)
+        assert sorted(f for f in os.listdir(tx_dir) if f.endswith(".csv")) == ["2024-01.csv", "2024-03.csv"]
+        assert not os.path.exists(os.path.join(temp_data_dir, str(user_id), "finance.csv"))
+        assert [r["merchant"] for r in read_rows(user_id)] == ["jan", "jan2", "mar"]
+
+    def test_range_read_touches_only_overlapping_partitions(self, temp_data_dir, mock_user):
+        user_id = mock_user.id
+        append_row_csv(user_id, self._tx("2023-12-31", "dec"))
+        append_row_csv(user_id, self._tx("2024-01-10", "jan"))
+        os.remove(os.path.join(temp_data_dir, str(user_id), "tx", "2023-12.csv"))
+
+        rows = read_rows(user_id, start=date(2024, 1, 1), end=date(2024, 2, 1))
+        assert [r["merchant"] for r in rows] == ["jan"]
+
+    def test_undo_and_edit_follow_append_order(self, temp_data_dir, mock_user):
+        user_id = mock_user.id
+        append_row_csv(user_id, self._tx("2024-03-05", "mar"))
+        append_row_csv(user_id, self._tx("2024-01-10", "jan"))  # задним числом
+
+        old, new = update_last_row(user_id, merchant="jan-edited")
+        assert old["merchant"] == "jan"
+        assert find_last_row(user_id, lambda r: r["merchant"] == "mar")[0] == 2
+
+        update_last_row(user_id, date="2024-03-20")
+        assert [r["merchant"] for r in read_rows(user_id)] == ["mar", "jan-edited"]
+        assert not os.path.exists(os.path.join(temp_data_dir, str(user_id), "tx", "2024-01.csv"))
+
+        assert undo_last_row(user_id)
+        assert [r["merchant"] for r in read_rows(user_id)] == ["mar"]
+        assert undo_last_row(user_id)
+        assert undo_last_row(user_id) is False
+
+    def test_migration(self, temp_data_dir, mock_user, monkeypatch):
+        user_id = mock_user.id
+        monkeypatch.setattr(storage, "STORAGE_LAYOUT", "single")
+        for d, m in [("2024-01-10", "a"), ("2024-02-01", "b"), ("2024-01-11", "c")]:
+            append_row_csv(user_id, self._tx(d, m))
+        assert not is_partitioned(user_id)
+
+        assert migrate_to_partitions(user_id) == 3
+        assert is_partitioned(user_id)
+        assert [r["merchant"] for r in read_rows(user_id)] == ["a", "c", "b"]
+        assert update_last_row(user_id, merchant="c2")[0]["merchant"] == "c"
+        assert migrate_to_partitions(user_id) == 0
+
+
 class TestAccountOperations:
     def test_add_account(self, temp_data_dir, mock_user):
         """Тест добавления счета"""
@@ -76,6 +592,245 @@ class TestAccountOperations:
         assert accounts["Test Bank"]["amount"] == 750.0
 
 
+class TestWriteBehindState:
+    def _accounts_on_disk(self, user_id):
+        return storage.replay_ledger(user_id)["accounts"]
+
+    def test_writes_through_outside_event_loop(self, temp_data_dir, mock_user):
+        user_id = mock_user.id
+        add_account(user_id, "Cash", "EUR", 100.0)
+        dec_account(user_id, "Cash", 30.0)
+        assert self._accounts_on_disk(user_id)["Cash"]["amount"] == 70.0
+        assert not [f for f in os.listdir(os.path.join(temp_data_dir, str(user_id))) if f.endswith(".tmp")]
+
+    def test_coalesces_writes_inside_event_loop(self, temp_data_dir, mock_user, monkeypatch):
+        user_id = mock_user.id
+        add_account(user_id, "Cash", "EUR", 100.0)
+        set_balance(user_id, {"EUR": 10.0})
+        monkeypatch.setattr(storage, "STATE_FLUSH_DELAY", 0.05)
+        fsyncs = []
+        real_fsync = os.fsync
+        monkeypatch.setattr(storage.os, "fsync", lambda fd: fsyncs.append(fd) or real_fsync(fd))
+
+        async def scenario():
+            async with user_lock(user_id):
+                dec_account(user_id, "Cash", 10.0)
+                inc_account(user_id, "Cash", 5.0)
+                dec_balance(user_id, 1.0, "EUR", None)
+            assert list_accounts(user_id)["Cash"]["amount"] == 95.0
+            assert fsyncs == []
+            await asyncio.sleep(0.1)
+
+        asyncio.run(scenario())
+        assert len(fsyncs) == 1  # одна дозапись журнала на все три правки
+        assert self._accounts_on_disk(user_id)["Cash"]["amount"] == 95.0
+
+    def test_flush_all(self, temp_data_dir, mock_user, monkeypatch):
+        user_id = mock_user.id
+        add_account(user_id, "Cash", "EUR", 100.0)
+        monkeypatch.setattr(storage, "STATE_FLUSH_DELAY", 60)
+
+        async def scenario():
+            dec_account(user_id, "Cash", 40.0)
+            flush_all()
+
+        asyncio.run(scenario())
+        assert self._accounts_on_disk(user_id)["Cash"]["amount"] == 60.0
+
+    def test_external_change_is_reloaded(self, temp_data_dir, mock_user):
+        user_id = mock_user.id
+        add_account(user_id, "Cash", "EUR", 100.0)
+        path = os.path.join(temp_data_dir, str(user_id), "accounts.json")
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump({"Bank": {"currency": "USD", "amount": 1.0}}, f)
+        os.utime(path, ns=(1, 1))
+        assert list(list_accounts(user_id)) == ["Bank"]
+        assert list(self._accounts_on_disk(user_id)) == ["Bank"]
+
+    def test_external_edit_keeps_ledger_events(self, temp_data_dir, mock_user):
+        user_id = mock_user.id
+        add_account(user_id, "A", "EUR", 100.0)
+        add_account(user_id, "B", "EUR", 5.0)
+        flush_all(snapshot=True)
+        # События после снимка: accounts.json их ещё не видит
+        dec_account(user_id, "A", 30.0)
+        inc_account(user_id, "B", 1.0)
+        path = os.path.join(temp_data_dir, str(user_id), "accounts.json")
+        with open(path, encoding="utf-8") as f:
+            view = json.load(f)
+        assert view["A"]["amount"] == 100.0
+        view["C"] = {"currency": "USD", "amount": 7.0}
+        view["B"]["currency"] = "USD"
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(view, f)
+        os.utime(path, ns=(1, 1))
+
+        expected = {"A": {"currency": "EUR", "amount": 70.0}, "B": {"currency": "USD", "amount": 6.0},
+                    "C": {"currency": "USD", "amount": 7.0}}
+        assert list_accounts(user_id) == expected
+        assert self._accounts_on_disk(user_id) == expected
+
+
+class TestLedger:
+    def _ledger(self, temp_data_dir, user_id):
+        with open(os.path.join(temp_data_dir, str(user_id), "ledger.jsonl"), encoding="utf-8") as f:
+            return [json.loads(line) for line in f]
+
+    def test_edits_append_events(self, temp_data_dir, mock_user):
+        user_id = mock_user.id
+        add_account(user_id, "Cash", "EUR", 100.0)
+        set_balance(user_id, {"EUR": 100.0, "Food@EUR": 20.0})
+        dec_account(user_id, "Cash", 30.0)
+        storage.rebalance_on_edit(user_id, {"total": -5, "currency": "EUR", "category": "Food"},
+                                  {"total": -8, "currency": "EUR", "category": "Food"})
+        storage.adjust_accounts(user_id, [("Cash", 2.5), ("Missing", 1.0)])
+
+        records = self._ledger(temp_data_dir, user_id)
+        assert "snapshot" in records[0]
+        assert [(r["op"], r["key"], r["value"]) for r in records[-6:]] == [
+            ("add", "Cash", -30.0),
+            ("add", "EUR", -5.0), ("add", "Food@EUR", -5.0),
+            ("add", "EUR", 8.0), ("add", "Food@EUR", 8.0),
+            ("add", "Cash", 2.5),
+        ]
+        assert list_accounts(user_id)["Cash"]["amount"] == 72.5
+        assert get_balances(user_id) == {"EUR": 103.0, "Food@EUR": 23.0}
+        assert storage.replay_ledger(user_id) == {"accounts": list_accounts(user_id),
+                                                  "balances": get_balances(user_id)}
+
+    def test_compaction_archives_old_ledger(self, temp_data_dir, mock_user, monkeypatch):
+        monkeypatch.setattr(storage, "LEDGER_SNAPSHOT_EVERY", 3)
+        user_id = mock_user.id
+        add_account(user_id, "Cash", "EUR", 0.0)
+        for _ in range(5):
+            inc_account(user_id, "Cash", 1.0)
+
+        records = self._ledger(temp_data_dir, user_id)
+        assert records[0]["snapshot"]["accounts"]["Cash"]["amount"] == 3.0
+        assert len(records) == 3
+        archive = os.path.join(temp_data_dir, str(user_id), "ledger")
+        assert len(os.listdir(archive)) == 1
+        with open(os.path.join(temp_data_dir, str(user_id), "accounts.json"), encoding="utf-8") as f:
+            assert json.load(f)["Cash"]["amount"] == 3.0
+        storage._states.clear()
+        assert list_accounts(user_id)["Cash"]["amount"] == 5.0
+
+    def test_shutdown_snapshot_refreshes_views(self, temp_data_dir, mock_user):
+        user_id = mock_user.id
+        add_account(user_id, "Cash", "EUR", 10.0)
+        dec_account(user_id, "Cash", 4.0)
+        flush_all(snapshot=True)
+        with open(os.path.join(temp_data_dir, str(user_id), "accounts.json"), encoding="utf-8") as f:
+            assert json.load(f)["Cash"]["amount"] == 6.0
+        assert len(self._ledger(temp_data_dir, user_id)) == 1
+
+    def test_torn_tail_is_dropped(self, temp_data_dir, mock_user):
+        user_id = mock_user.id
+        add_account(user_id, "Cash", "EUR", 10.0)
+        with open(os.path.join(temp_data_dir, str(user_id), "ledger.jsonl"), "ab") as f:
+            f.write(b'{"kind": "accounts", "op": "add"')
+        storage._states.clear()
+        inc_account(user_id, "Cash", 1.0)
+        assert storage.replay_ledger(user_id)["accounts"]["Cash"]["amount"] == 11.0
+
+
+class TestApplyBatch:
+    def test_transfer_is_single_batch(self, temp_data_dir, mock_user, monkeypatch):
+        user_id = mock_user.id
+        add_account(user_id, "Cash", "EUR", 100.0)
+        add_account(user_id, "Bank", "EUR", 0.0)
+        synced, removed = [], {}
+        real_fsync, real_remove = os.fsync, os.remove
+        monkeypatch.setattr(storage.os, "fsync",
+                            lambda fd: synced.append(os.readlink(f"/proc/self/fd/{fd}")) or real_fsync(fd))
+
+        def remove(path):
+            removed[os.path.basename(path)] = list(synced)
+            real_remove(path)
+
+        monkeypatch.setattr(storage.os, "remove", remove)
+        transfer_between_accounts(user_id, "Cash", "Bank", 25.0)
+        # Журнал удаляется только после того, как на диске CSV, ledger и папка
+        folder = os.path.realpath(os.path.join(temp_data_dir, str(user_id)))
+        before = removed["journal.json"]
+        assert os.path.basename(before[0]).startswith("journal.json")
+        assert {os.path.join(folder, "finance.csv"), os.path.join(folder, "ledger.jsonl"), folder} <= set(before)
+        assert len(synced) == 4
+        acc = list_accounts(user_id)
+        assert acc["Cash"]["amount"] == 75.0
+        assert acc["Bank"]["amount"] == 25.0
+        rows = read_rows(user_id)
+        assert [float(r["total"]) for r in rows] == [-25.0, 25.0]
+        assert {r["source"] for r in rows} == {"transfer"}
+        assert not os.path.exists(os.path.join(temp_data_dir, str(user_id), "journal.json"))
+
+    def test_recovers_interrupted_batch(self, temp_data_dir, mock_user, monkeypatch):
+        user_id = mock_user.id
+        add_account(user_id, "Cash", "EUR", 100.0)
+        append_row_csv(user_id, {"date": "2024-03-01", "merchant": "Shop", "total": 5, "currency": "EUR"})
+
+        # Падение после записи журнала и половины CSV, до сохранения счетов
+        def crash(uid, journal):
+            storage._append_to_file(storage._csv_path(uid), journal["rows"][:1])
+            raise OSError("crash")
+        monkeypatch.setattr(storage, "_apply_journal", crash)
+        rows = [{"date": "2024-03-02", "merchant": f"T{i}", "total": i, "currency": "EUR"} for i in (1, 2)]
+        with pytest.raises(OSError):
+            apply_batch(user_id, rows, accounts={"Cash": {"currency": "EUR", "amount": 97.0}})
+        monkeypatch.undo()
+        monkeypatch.setattr(storage, "DATA_DIR", temp_data_dir)
+        storage._states.clear()
+
+        assert list_accounts(user_id)["Cash"]["amount"] == 97.0
+        assert [r["merchant"] for r in read_rows(user_id)] == ["Shop", "T1", "T2"]
+        assert not os.path.exists(os.path.join(temp_data_dir, str(user_id), "journal.json"))
+
+    def test_partitioned_batch(self, temp_data_dir, mock_user, monkeypatch):
+        monkeypatch.setattr(storage, "STORAGE_LAYOUT", "monthly")
+        user_id = mock_user.id
+        rows = [{"date": "2024-03-31", "merchant": "A", "total": 1, "currency": "EUR"},
+                {"date": "2024-04-01", "merchant": "B", "total": 2, "currency": "EUR"}]
+        apply_batch(user_id, rows)
+        assert is_partitioned(user_id)
+        assert [r["merchant"] for r in read_rows(user_id)] == ["A", "B"]
+        assert storage._load_manifest(user_id)["partitions"] == {"2024-03": 1, "2024-04": 1}
+
+
+class TestAppendRows:
+    def test_bulk_append_with_postings(self, temp_data_dir, mock_user, monkeypatch):
+        user_id = mock_user.id
+        add_account(user_id, "Cash", "EUR", 100.0)
+        set_balance(user_id, {"EUR": 100.0, "Food@EUR": 50.0})
+        appends = []
+        real_append = storage._append_to_file
+        monkeypatch.setattr(storage, "_append_to_file", lambda p, rows: appends.append(len(rows)) or real_append(p, rows))
+
+        rows = [
+            {"date": "2024-03-01", "merchant": "Shop", "total": -10, "currency": "eur",
+             "category": "Food", "payment_method": "Cash"},
+            {"date": "2024-03-02", "merchant": "Salary", "total": 40, "currency": "USD",
+             "category": "Зарплата", "payment_method": "Cash"},
+            {"date": "2024-03-03", "merchant": "Kiosk", "total": -5, "currency": "EUR",
+             "category": "Other", "payment_method": "Unknown"},
+        ]
+        assert append_rows_csv(user_id, rows, source="import") == 3
+
+        assert appends == [3]
+        assert [r["merchant"] for r in read_rows(user_id)] == ["Shop", "Salary", "Kiosk"]
+        assert {r["source"] for r in read_rows(user_id)} == {"import"}
+        assert list_accounts(user_id)["Cash"]["amount"] == 130.0
+        assert get_balances(user_id) == {"EUR": 85.0, "Food@EUR": 40.0, "USD": 40.0}
+
+    def test_empty_and_without_balances(self, temp_data_dir, mock_user):
+        user_id = mock_user.id
+        add_account(user_id, "Cash", "EUR", 0.0)
+        assert append_rows_csv(user_id, []) == 0
+        append_rows_csv(user_id, [{"total": 5, "currency": "EUR", "payment_method": "Cash"}],
+                        update_balances=False)
+        assert list_accounts(user_id)["Cash"]["amount"] == 5.0
+        assert get_balances(user_id) == {}
+
+
 class TestBalanceOperations:
     def test_set_balance(self, temp_data_dir, mock_user):
         """Тест установки баланса"""